@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+
+""" asyncio versions of ClientVtunTunnel and ServerVtunTunnel (this module requires Python 3.5 or later)
+"""
+
+from client_vtun_tunnel import ClientVtunTunnel
+from server_vtun_tunnel import ServerVtunTunnel, get_vtund_server_command, _is_server_listening, VTUND_START_TIMEOUT, VTUND_STOP_TIMEOUT, RELOAD_UNCHANGED, RELOAD_RELOADED, RELOAD_RESTARTED
+from output_ring_buffer import OutputRingBuffer
+from proc_net import get_listening_tcp_sockets
+from vtun_tunnel import get_child_of
+from process_teardown import send_signal, signal_process_tree
+from tunnel_metrics import start_timer, count
+
+import asyncio
+import codecs
+import os
+import signal
+import threading
+import time
+
+async def _signal_process_tree(vtund_use_sudo, pid, sig, vtund_helper = None):
+    """ Send a signal to a vtund process and its descendants (see process_teardown.signal_process_tree()), without blocking the event loop when sudo (or the helper) is needed
+    """
+    if vtund_helper is not None:
+        await asyncio.get_event_loop().run_in_executor(None, signal_process_tree, pid, sig, False, vtund_helper)  # One request to the helper, no sudo
+        return
+    try:
+        signal_process_tree(pid, sig)
+    except Exception:
+        if not vtund_use_sudo:
+            raise
+        try:
+            pgid = os.getpgid(pid)
+        except OSError:
+            return  # Already exitted
+        kill = await asyncio.create_subprocess_exec('sudo', 'kill', '-' + str(int(sig)), '--', str(-pgid), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await kill.wait()
+
+async def _terminate(vtund_use_sudo, pid, exit_task, timeout, vtund_helper = None):
+    """ Terminate a vtund process and its descendants: send SIGTERM, and escalate to SIGKILL if \p exit_task (the task collecting the exit value of vtund) is not done within \p timeout
+
+    Nothing is signalled once \p exit_task is done: vtund has then been reaped, and \p pid may have been reused by another process
+
+    If vtund is still alive 1s after SIGKILL, a 'OneOfProcessesCouldNotBeKilled' exception is raised
+    """
+    if exit_task.done():
+        return
+    await _signal_process_tree(vtund_use_sudo, pid, signal.SIGTERM, vtund_helper)
+    try:
+        await asyncio.wait_for(asyncio.shield(exit_task), timeout)
+        return
+    except asyncio.TimeoutError:    # We have reached timeout... send a SIGKILL to the slave process to force termination
+        pass
+    if exit_task.done():
+        return
+    await _signal_process_tree(vtund_use_sudo, pid, signal.SIGKILL, vtund_helper)
+    try:
+        await asyncio.wait_for(asyncio.shield(exit_task), 1)
+    except asyncio.TimeoutError:
+        raise Exception('OneOfProcessesCouldNotBeKilled')
+
+async def _spawn_with_helper(vtund_helper, args, capture_output = False):
+    """ Spawn a process via a vtund_helper.VtundHelperClient object, without blocking the event loop
+
+    \return A vtund_helper.VtundHelperProcess object
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, lambda: vtund_helper.popen(args, capture_output))
+
+async def _get_output_reader(proc):
+    """ Get an asyncio.StreamReader object reading the output of \p proc (an asyncio subprocess, or a VtundHelperProcess object whose stdout is a FIFO)
+    """
+    if isinstance(proc, asyncio.subprocess.Process):
+        return proc.stdout
+    reader = asyncio.StreamReader()
+    await asyncio.get_event_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), proc.stdout)
+    return reader
+
+async def _wait_process(proc):
+    """ Wait until \p proc (an asyncio subprocess, or a VtundHelperProcess object) exits
+
+    \return Its exit value
+    """
+    if isinstance(proc, asyncio.subprocess.Process):
+        return await proc.wait()
+    return await asyncio.get_event_loop().run_in_executor(None, proc.wait)  # The helper reaps the process, we can only poll it
+
+class AsyncClientVtunTunnel(ClientVtunTunnel):
+    """ Class representing a vtun tunnel client (connecting), with coroutine start(), stop() and wait_exit() methods
+
+    Configuration and validation are the ones of ClientVtunTunnel. The vtund console output is read from the event loop (no thread is used), and is available via get_output() and add_output_listener() like for ClientVtunTunnel
+    """
+    
+    __slots__ = ['_vtund_output_task']
+
+    def __init__(self, **kwargs): # See ClientVtunTunnel.__init__ for the inherited kwargs
+        super(AsyncClientVtunTunnel, self).__init__(**kwargs)
+        self._vtund_output_task = None    # The asyncio task reading the vtund output, its result is the vtund exit value (it never raises, so that it does not matter whether it is awaited)
+
+    async def start(self):
+        """ Start the vtund exec
+        """
+        phase_timer = start_timer('client', 'start')
+        try:
+            vtund_config_filename = self._prepare_start(phase_timer)
+            vtund_cmd = self._get_vtund_command(vtund_config_filename)
+            try:
+                if self.vtund_helper is not None:
+                    proc = await _spawn_with_helper(self.vtund_helper, vtund_cmd, True)   # The helper also runs vtund in its own session
+                else:
+                    proc = await asyncio.create_subprocess_exec(*vtund_cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+            except Exception:
+                self._release_vtund_config()
+                raise
+        except Exception as e:
+            phase_timer.done(e)
+            raise
+        phase_timer.phase('spawn')
+        self._vtun_process = proc
+        self._vtun_pid = proc.pid
+        self._vtund_output_buf = OutputRingBuffer(self.vtund_output_max_size, self._on_vtund_output_line)
+        self._vtun_process_exit_expected = threading.Event()
+        self.vtund_exit_value = None
+        self._set_state(ClientVtunTunnel.STATE_CONNECTING)
+        phase_timer.watch_connection(self)
+        self._vtund_output_task = asyncio.ensure_future(self._read_vtund_output(proc))
+        phase_timer.done()
+
+    async def _read_vtund_output(self, proc):
+        """ Read the output of the vtund subprocess \p proc until it exits
+
+        \return The exit value of \p proc
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        reader = await _get_output_reader(proc)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            self._vtund_output_buf.append(decoder.decode(data))
+        self._vtund_output_buf.close()
+        exit_value = await _wait_process(proc)
+        if proc is self._vtun_process:
+            self.vtund_exit_value = exit_value    # Store exit value
+            # If vtund died unexpectedly, this is reported to the state listeners and by wait_exit(). The PID is kept until stop() is called, which then only releases its resources (like for ClientVtunTunnel)
+            self._set_state(ClientVtunTunnel.STATE_EXITED)
+        return exit_value
+
+    async def wait_until_connected(self, timeout = None):
+        """ Wait until vtund reports that the session is opened (see ClientVtunTunnel.wait_until_connected())
+
+        \param timeout (optional) The maximum time (in seconds) to wait (wait forever if None)
+
+        \return True if the session is opened, False if \p timeout was reached
+        """
+        state_changed = asyncio.Event()
+        listener = lambda tunnel, old_state, new_state: state_changed.set()
+        self.add_state_listener(listener)   # State transitions happen in the event loop thread, as output is read from it
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not ClientVtunTunnel.wait_until_connected(self, 0):   # Raises if connection failed
+                state_changed.clear()
+                if timeout is None:
+                    await state_changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    try:
+                        await asyncio.wait_for(state_changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        return False
+            return True
+        finally:
+            self.remove_state_listener(listener)
+
+    async def wait_exit(self):
+        """ Wait until the vtund exec exits
+
+        \return The exit value of vtund. If vtund exitted without stop() having been called, an Exception('SubprocessDiedUnexpectedly') is raised
+        """
+        if self._vtund_output_task is None:
+            raise Exception('VtundNotRunning')
+        exit_value = await asyncio.shield(self._vtund_output_task)
+        if not self._vtun_process_exit_expected.is_set():
+            raise Exception('SubprocessDiedUnexpectedly')
+        return exit_value
+
+    async def stop(self, timeout = VTUND_STOP_TIMEOUT):
+        """ Stop the vtund exec
+
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM (vtund is then killed). If it is still alive even after SIGKILL, a 'OneOfProcessesCouldNotBeKilled' exception is raised
+        """
+        if self._vtun_pid is None or self._vtun_process is None:
+            raise Exception('VtundNotRunning')
+        phase_timer = start_timer('client', 'stop')
+        self._vtun_process_exit_expected.set()  # We are killing the subprocess, so expect it to exit
+        try:
+            await _terminate(self.vtund_use_sudo, self._vtun_pid, self._vtund_output_task, timeout, self.vtund_helper)
+        except Exception as e:
+            phase_timer.done(e)
+            raise
+        phase_timer.phase('terminate')  # The exit value has already been collected by the output task, there is no 'reap' phase
+        self._vtun_pid = None
+        self._vtun_process = None
+        self._release_vtund_config()
+        phase_timer.phase('release')
+        self._set_state(ClientVtunTunnel.STATE_EXITED)
+        phase_timer.done()
+
+async def _send_signal(vtund_use_sudo, pid, sig, vtund_helper = None):
+    """ Send a signal to one vtund process (not to its descendants), without blocking the event loop when sudo (or the helper) is needed
+    """
+    if vtund_helper is not None:
+        await asyncio.get_event_loop().run_in_executor(None, send_signal, pid, sig, False, vtund_helper)
+        return
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        return  # Already exitted
+    except PermissionError:
+        if not vtund_use_sudo:
+            raise
+        kill = await asyncio.create_subprocess_exec('sudo', 'kill', '-' + str(int(sig)), str(pid), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await kill.wait()
+
+class AsyncServerVtunTunnel(ServerVtunTunnel):
+    """ Class representing a vtun tunnel service (listening), with coroutine start(), stop() and wait_exit() methods
+
+    Configuration and validation are the ones of ServerVtunTunnel. Waiting for the server to be ready does not block the event loop
+    """
+    
+    __slots__ = ['_vtund_exit_task']
+
+    def __init__(self, **kwargs): # See ServerVtunTunnel.__init__ for the inherited kwargs
+        super(AsyncServerVtunTunnel, self).__init__(**kwargs)
+        self._vtund_exit_task = None    # The asyncio task waiting for the vtund (or sudo) process to exit
+
+    async def start(self, timeout = None):
+        """ Start a vtun server process to handle the service represented by this object, and wait until it accepts connections
+
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to accept connections (defaults to the vtund_start_timeout attribute). A 'VtundStartTimeout' exception is raised if it is reached, and a 'VtundExitedPrematurely' exception if vtund exits before being ready
+        """
+        phase_timer = start_timer('server', 'start')
+        try:
+            vtund_config_filename = self._prepare_start(phase_timer)
+        except Exception as e:
+            phase_timer.done(e)
+            raise
+        if timeout is None:
+            timeout = self.vtund_start_timeout
+        if timeout is None:
+            timeout = VTUND_START_TIMEOUT
+        deadline = time.time() + timeout
+        loop = asyncio.get_event_loop()
+
+        try:
+            if not self.vtun_protocol in ['tcp', 'udp']:
+                raise Exception('UnsupportedProtocol')
+            inodes_before = (await loop.run_in_executor(None, get_listening_tcp_sockets)).get(int(self.vtun_server_tcp_port), set())   # Sockets already listening on the port cannot be our vtund's (see start_vtund_server())
+            vtund_use_sudo = self.vtund_use_sudo and self.vtund_helper is None    # The helper already runs vtund as root
+            vtund_cmd = get_vtund_server_command(self.vtund_exec, vtund_use_sudo, vtund_config_filename)
+            if self.vtund_helper is not None:
+                proc = await _spawn_with_helper(self.vtund_helper, vtund_cmd)  # The helper also runs vtund in its own session
+            else:
+                proc = await asyncio.create_subprocess_exec(*vtund_cmd, stdin=asyncio.subprocess.DEVNULL, start_new_session=True)
+        except Exception as e:
+            self._release_vtund_config()
+            phase_timer.done(e)
+            raise
+        phase_timer.phase('spawn')
+        exit_task = asyncio.ensure_future(_wait_process(proc))
+        pid = None  # When using sudo, the vtund process is a child of proc, that we will find out once it has been forked
+        if not vtund_use_sudo:
+            pid = proc.pid
+        interval = 0.001
+        try:
+            while True:
+                if exit_task.done():
+                    raise Exception('VtundExitedPrematurely')
+                # /proc is read from the default executor, so that the event loop is not blocked (reading /proc/net/tcp can take a while with many sockets)
+                if pid is None:
+                    children = await loop.run_in_executor(None, get_child_of, proc.pid)
+                    if children:
+                        pid = int(children[0])
+                        phase_timer.phase('sudo')
+                if pid is not None and await loop.run_in_executor(None, _is_server_listening, pid, self.vtun_server_tcp_port, inodes_before):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception('VtundStartTimeout')
+                await asyncio.wait([exit_task], timeout=min(interval, remaining))   # Wakes up immediately if vtund exits
+                interval = min(interval * 2, 0.05)
+        except Exception as e:
+            if not exit_task.done():
+                try:
+                    await _signal_process_tree(self.vtund_use_sudo, pid or proc.pid, signal.SIGKILL, self.vtund_helper)
+                    await exit_task
+                except Exception:
+                    pass
+            self._release_vtund_config()
+            phase_timer.done(e)
+            raise e
+        phase_timer.phase('ready')
+        self._vtun_pid = pid
+        self._vtun_process = proc
+        self._vtund_exit_task = exit_task
+        phase_timer.done()
+
+    async def wait_exit(self):
+        """ Wait until the vtun server process exits
+
+        \return The exit value of the vtund (or sudo) process
+        """
+        if self._vtund_exit_task is None:
+            raise Exception('VtundNotRunning')
+        return await asyncio.shield(self._vtund_exit_task)
+
+    async def stop(self, timeout = VTUND_STOP_TIMEOUT):
+        """ Stop the vtun server process handled by this object
+
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM (vtund is then killed). If it is still alive even after SIGKILL, a 'OneOfProcessesCouldNotBeKilled' exception is raised
+        """
+        if self._vtun_pid is None:    # There is not a slave vtun process running
+            raise Exception('VtundNotRunning')
+        phase_timer = start_timer('server', 'stop')
+        try:
+            await _terminate(self.vtund_use_sudo, self._vtun_pid, self._vtund_exit_task, timeout, self.vtund_helper)
+        except Exception as e:
+            phase_timer.done(e)
+            raise
+        phase_timer.phase('terminate')  # The exit value has already been collected by the exit task, there is no 'reap' phase
+        self._vtun_pid = None
+        self._vtun_process = None
+        self._vtund_exit_task = None
+        self._release_vtund_config()
+        phase_timer.phase('release')
+        phase_timer.done()
+
+    async def reload(self, timeout = None):
+        """ Bring the running vtun server process in line with the current attributes of this object, without restarting it when possible (see ServerVtunTunnel.reload())
+
+        \param timeout (optional) The timeout given to stop() and start() if vtund has to be restarted
+
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED. If vtund is not running (or has exitted, stop() must then be called to release its resources), a 'VtundNotRunning' exception is raised
+        """
+        if self._vtun_pid is None or (self._vtund_exit_task is not None and self._vtund_exit_task.done()):   # Once vtund has exitted (and has been reaped), its PID must not be signalled
+            raise Exception('VtundNotRunning')
+        action = self._update_vtund_config()
+        if action == RELOAD_RESTARTED:
+            await self.stop(timeout if timeout is not None else VTUND_STOP_TIMEOUT)
+            await self.start(timeout)
+        elif action == RELOAD_RELOADED:
+            await _send_signal(self.vtund_use_sudo, self._vtun_pid, signal.SIGHUP, self.vtund_helper)
+        count('tunnel_reloads_total', kind='server', action=action)
+        return action
+
+    async def apply(self, **kwargs):
+        """ Change attributes of this object, and if the vtun server process is running, bring it in line with them (see ServerVtunTunnel.apply())
+
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED (RELOAD_UNCHANGED if vtund is not running)
+        """
+        timeout = kwargs.pop('timeout', None)
+        self._set_attributes(kwargs)
+        if self._vtun_pid is None:
+            return RELOAD_UNCHANGED
+        return await self.reload(timeout)
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Control-plane benchmarks of pythonvtunlib, run against the stand-in vtund of this directory (fake_vtund), so that no root access nor real vtund is needed
+
+Measures configuration rendering throughput, tunnel object construction rate and memory, start/stop latency percentiles of servers and clients, and the behaviour of a fleet of 10, 100 and 1000 concurrent client tunnels.
+Results are written as JSON (see --output), and can be compared with the report of another revision (see --compare)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_vtun_tunnel import ServerVtunTunnel
+from server_vtun_tunnel_pool import ServerVtunTunnelPool
+from client_vtun_tunnel import ClientVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from tunnel_fleet import TunnelFleet
+import vtund_config_renderer
+
+import gc
+import json
+import optparse
+import platform
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+FAKE_VTUND_MEMORY = 10 * 1024 * 1024    # Estimated memory used by one fake_vtund process (in bytes), to skip the scale levels the system cannot run
+
+def _make_tunnel_kwargs(index, **kwargs):
+    tunnel_kwargs = {
+        'mode': 'L3',
+        'tunnel_ip_network': '10.' + str((index >> 14) & 255) + '.' + str((index >> 6) & 255) + '.' + str((index & 63) * 4) + '/30',
+        'tunnel_near_end_ip': '10.' + str((index >> 14) & 255) + '.' + str((index >> 6) & 255) + '.' + str((index & 63) * 4 + 1),
+        'tunnel_far_end_ip': '10.' + str((index >> 14) & 255) + '.' + str((index >> 6) & 255) + '.' + str((index & 63) * 4 + 2),
+        'vtun_tunnel_name': 'bench' + str(index),
+        'vtun_shared_secret': 'secret' + str(index),
+    }
+    tunnel_kwargs.update(kwargs)
+    return tunnel_kwargs
+
+def _make_client(server, index, vtund_exec, port):
+    return ClientVtunTunnel(**_make_tunnel_kwargs(index, vtund_exec = vtund_exec, vtun_server_tcp_port = port, vtun_server_hostname = '127.0.0.1', tunnel_near_end_ip = server.tunnel_far_end_ip, tunnel_far_end_ip = server.tunnel_near_end_ip))
+
+def get_statistics(samples):
+    """ Summarize durations
+
+    \param samples A list of durations (in seconds)
+
+    \return A dict with the number of samples, and the mean, minimum, maximum and 50th, 90th and 99th percentiles (in milliseconds)
+    """
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[max(0, int(len(samples) * p / 100.0 + 0.999999) - 1)] * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) * 1000 / len(samples),
+        'min_ms': samples[0] * 1000,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+def prepare_fake_vtund(directory):
+    """ Copy fake_vtund to \p directory, to be run by the current Python interpreter (whatever the python in PATH is)
+
+    \return The path of the executable
+    """
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_vtund')
+    path = os.path.join(directory, 'fake_vtund')
+    with open(source, 'r') as f:
+        lines = f.read().split('\n')
+    lines[0] = '#!' + sys.executable + ' -S'    # Without site packages, to keep the many fake processes small
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+    return path
+
+def get_available_memory():
+    """ \return The memory available on the system (in bytes), or None if unknown
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def bench_render(count):
+    """ Measure the rendering of vtund configurations, without cache (first rendering of each tunnel) and with cache (restarting the same tunnels)
+    """
+    results = {}
+    for (kind, make) in [('server', lambda i: ServerVtunTunnel(**_make_tunnel_kwargs(i, vtun_server_tcp_port = 5000))), ('client', lambda i: ClientVtunTunnel(**_make_tunnel_kwargs(i, vtun_server_tcp_port = 5000, vtun_server_hostname = '127.0.0.1')))]:
+        tunnels = [make(i) for i in range(count)]
+        vtund_config_renderer.clear_cache()
+        started = time.time()
+        for tunnel in tunnels:
+            tunnel.to_vtund_config()
+        cold = time.time() - started
+        started = time.time()
+        for tunnel in tunnels:
+            tunnel.to_vtund_config()
+        warm = time.time() - started
+        results[kind] = {'configs_per_s_uncached': count / cold, 'configs_per_s_cached': count / warm}
+    vtund_config_renderer.clear_cache()
+    return results
+
+def bench_objects(count):
+    """ Measure the construction rate of tunnel objects, and the memory they use (only measured under Python 3, with tracemalloc)
+    """
+    results = {}
+    for (kind, tunnel_class, extra_kwargs) in [('server', ServerVtunTunnel, {}), ('client', ClientVtunTunnel, {'vtun_server_hostname': '127.0.0.1'})]:
+        all_kwargs = [_make_tunnel_kwargs(i, vtun_server_tcp_port = 5000, **extra_kwargs) for i in range(count)]
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        started = time.time()
+        tunnels = [tunnel_class(**kwargs) for kwargs in all_kwargs]
+        duration = time.time() - started
+        results[kind] = {'objects_per_s': count / duration}
+        if tracemalloc is not None:
+            results[kind]['bytes_per_object'] = tracemalloc.get_traced_memory()[0] / float(count)
+            tracemalloc.stop()
+        del tunnels
+    return results
+
+def bench_server_latency(vtund_exec, ports, iterations):
+    """ Measure the time start() and stop() of a ServerVtunTunnel take
+    """
+    server = ServerVtunTunnel(**_make_tunnel_kwargs(0, vtund_exec = vtund_exec, vtun_server_tcp_port = ports.allocate()))
+    start_samples = []
+    stop_samples = []
+    for i in range(iterations):
+        started = time.time()
+        server.start()
+        start_samples.append(time.time() - started)
+        started = time.time()
+        server.stop()
+        stop_samples.append(time.time() - started)
+    ports.release(server.vtun_server_tcp_port)
+    return {'start': get_statistics(start_samples), 'stop': get_statistics(stop_samples)}
+
+def bench_client_latency(vtund_exec, ports, iterations):
+    """ Measure the time start() of a ClientVtunTunnel takes, the time until its session is opened, and the time stop() takes
+    """
+    server = ServerVtunTunnel(**_make_tunnel_kwargs(0, vtund_exec = vtund_exec, vtun_server_tcp_port = ports.allocate()))
+    server.start()
+    try:
+        client = _make_client(server, 0, vtund_exec, server.vtun_server_tcp_port)
+        start_samples = []
+        connect_samples = []
+        stop_samples = []
+        for i in range(iterations):
+            started = time.time()
+            client.start()
+            start_samples.append(time.time() - started)
+            if not client.wait_until_connected(30):
+                raise Exception('BenchmarkClientNotConnected')
+            connect_samples.append(time.time() - started)
+            started = time.time()
+            client.stop()
+            stop_samples.append(time.time() - started)
+    finally:
+        server.stop()
+        ports.release(server.vtun_server_tcp_port)
+    return {'start': get_statistics(start_samples), 'connected': get_statistics(connect_samples), 'stop': get_statistics(stop_samples)}
+
+def bench_scale(vtund_exec, ports, count, max_workers):
+    """ Start \p count clients concurrently (with a TunnelFleet) against one ServerVtunTunnelPool, wait until all are connected, then stop them all
+    """
+    port = ports.allocate()
+    servers = [ServerVtunTunnel(**_make_tunnel_kwargs(i, vtund_exec = vtund_exec, vtun_server_tcp_port = port)) for i in range(count)]
+    pool = ServerVtunTunnelPool(vtund_exec = vtund_exec, vtun_server_tcp_port = port, pool_name = 'bench-' + str(count), tunnels = servers)
+    clients = [_make_client(server, i, vtund_exec, port) for (i, server) in enumerate(servers)]
+    fleet = TunnelFleet(tunnels = clients, max_workers = max_workers)
+    results = {'tunnels': count}
+    pool.start()
+    try:
+        started = time.time()
+        start_results = fleet.start_all()
+        results['start_all_s'] = time.time() - started
+        results['start_errors'] = len([result for result in start_results if not result.is_success()])
+        results['threads_after_start'] = threading.active_count()
+        connected = 0
+        for result in start_results:
+            if result.is_success() and result.tunnel.wait_until_connected(60):
+                connected += 1
+        results['all_connected_s'] = time.time() - started
+        results['connected'] = connected
+        started = time.time()
+        stop_results = fleet.stop_all([result.tunnel for result in start_results if result.is_success()])
+        results['stop_all_s'] = time.time() - started
+        results['stop_errors'] = len([result for result in stop_results if not result.is_success()])
+    finally:
+        pool.stop()
+        ports.release(port)
+    return results
+
+def get_revision():
+    """ \return The git revision of the library, or None if it is not a git checkout
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = devnull)
+        return revision.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix = ''):
+    """ \return A dict containing the numeric values of \p results indexed by their path (for example 'latency.server.start.p50_ms')
+    """
+    values = {}
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def print_comparison(baseline, report):
+    """ Print the values of two reports side by side, with the relative change
+    """
+    old_values = flatten(baseline['results'])
+    new_values = flatten(report['results'])
+    print('%-55s %14s %14s %9s' % ('metric (' + str(baseline.get('revision')) + ' -> ' + str(report.get('revision')) + ')', 'baseline', 'current', 'change'))
+    for key in sorted(set(old_values) | set(new_values)):
+        old = old_values.get(key, None)
+        new = new_values.get(key, None)
+        if old is None or new is None:
+            change = 'n/a'
+        elif old == 0:
+            change = '' if new == 0 else 'inf'
+        else:
+            change = '%+.1f%%' % ((new - old) * 100.0 / old)
+        print('%-55s %14s %14s %9s' % (key, '-' if old is None else '%.3f' % old, '-' if new is None else '%.3f' % new, change))
+
+def main(argv):
+    parser = optparse.OptionParser(usage = '%prog [options]', description = 'Run the control-plane benchmarks of pythonvtunlib against a stand-in vtund, and write a JSON report')
+    parser.add_option('-o', '--output', default = 'benchmark_report.json', help = 'Path of the JSON report to write (default: %default)')
+    parser.add_option('-c', '--compare', default = None, help = 'Path of a previous JSON report to compare the results with')
+    parser.add_option('--scale', default = '10,100,1000', help = 'Comma separated numbers of concurrent tunnels to run (default: %default)')
+    parser.add_option('--iterations', type = 'int', default = 50, help = 'Number of start/stop cycles for latency measurements (default: %default)')
+    parser.add_option('--objects', type = 'int', default = 20000, help = 'Number of tunnel objects for rendering and memory measurements (default: %default)')
+    parser.add_option('--base-port', type = 'int', default = 15000, help = 'First TCP port used by the fake vtund servers (default: %default)')
+    parser.add_option('--max-workers', type = 'int', default = TunnelFleet.MAX_WORKERS, help = 'Number of concurrent operations of the TunnelFleet (default: %default)')
+    (options, args) = parser.parse_args(argv)
+
+    ports = TcpPortAllocator(options.base_port, options.base_port + 99)
+    directory = tempfile.mkdtemp(prefix = 'vtunbench-')
+    os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(directory, 'vtund.pid')
+    vtund_exec = prepare_fake_vtund(directory)
+    report = {
+        'format': 1,
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'parameters': {'iterations': options.iterations, 'objects': options.objects, 'max_workers': options.max_workers},
+        'results': {},
+    }
+    results = report['results']
+    try:
+        print('Rendering ' + str(options.objects) + ' configurations...')
+        results['render'] = bench_render(options.objects)
+        print('Creating ' + str(options.objects) + ' tunnel objects...')
+        results['objects'] = bench_objects(options.objects)
+        print('Starting and stopping a server ' + str(options.iterations) + ' times...')
+        results['latency'] = {'server': bench_server_latency(vtund_exec, ports, options.iterations)}
+        print('Starting and stopping a client ' + str(options.iterations) + ' times...')
+        results['latency']['client'] = bench_client_latency(vtund_exec, ports, options.iterations)
+        results['scale'] = {}
+        for count in [int(count) for count in options.scale.split(',') if count]:
+            available_memory = get_available_memory()
+            if available_memory is not None and (count + 1) * FAKE_VTUND_MEMORY > available_memory * 0.8:
+                print('Skipping ' + str(count) + ' concurrent tunnels (not enough memory)')
+                results['scale'][str(count)] = {'tunnels': count, 'skipped': 'not enough memory'}
+                continue
+            print('Running ' + str(count) + ' concurrent tunnels...')
+            results['scale'][str(count)] = bench_scale(vtund_exec, ports, count, options.max_workers)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent = 2, sort_keys = True)
+    print('Report written to ' + options.output)
+    if options.compare is not None:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+        print_comparison(baseline, report)
+    else:
+        print(json.dumps(results, indent = 2, sort_keys = True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
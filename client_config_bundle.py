@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Batch generation of the client configurations matching many ServerVtunTunnel objects, to ship them to devices in one go
+
+Servers are processed one at a time and each client configuration is written out as soon as it is rendered, so that memory use does not depend on the number of tunnels (servers can come from a generator).
+Two output formats are supported:
+- write_tar_bundle(): a tar archive containing, for each tunnel, a directory named after the tunnel with two files: vtund.conf (the vtund client configuration) and server (the hostname to give to vtund on its command line)
+- write_json_lines(): one JSON object per line, with the tunnel name, server hostname and port, and configuration
+"""
+
+from __future__ import print_function
+
+from client_vtun_tunnel import ClientVtunTunnel
+
+import json
+import tarfile
+import time
+
+TAR_MEMBER_MODE = 0o600 # Configurations contain the shared secret of the tunnel
+
+class ClientConfigError(object):
+    """ Class describing a server for which no client configuration could be generated """
+
+    def __init__(self, server, error):
+        """ Constructor
+
+        \param server The ServerVtunTunnel object
+        \param error The exception raised while building or rendering the client configuration
+        """
+        self.server = server
+        self.error = error
+
+    def __repr__(self):
+        return '<ClientConfigError ' + str(self.server.vtun_tunnel_name) + ': ' + str(self.error) + '>'
+
+def _get_server_hostname(hostnames, server):
+    if callable(hostnames):
+        hostname = hostnames(server)
+    else:
+        hostname = hostnames.get(server.vtun_tunnel_name, None)
+    if hostname is None:
+        raise Exception('NoServerHostname:' + str(server.vtun_tunnel_name))
+    return hostname
+
+def iter_client_configs(servers, hostnames, **kwargs):
+    """ Build and render the client configuration matching each server, one server at a time
+
+    Clients are built with ClientVtunTunnel(from_server=...), which reuses the (already validated) addresses of the server, and their configuration is rendered without going through the render cache (each one is only rendered once)
+
+    \param servers An iterable of ServerVtunTunnel objects
+    \param hostnames A dict giving the hostname (or IP address) clients connect to, indexed by vtun_tunnel_name, or a function taking a ServerVtunTunnel object and returning this hostname
+    \param client_class (optional) The class of the client objects to build (ClientVtunTunnel by default)
+    \param kwargs Other constructor arguments given to all clients (for example vtun_connection_timeout)
+
+    \return A generator of tuples (server, client, config, error): \p client is the ClientVtunTunnel object and \p config its vtund configuration string, or both are None if the configuration could not be generated, in which case \p error is a ClientConfigError object
+    """
+    client_class = kwargs.pop('client_class', ClientVtunTunnel)
+    for server in servers:
+        try:
+            client = client_class(from_server = server, vtun_server_hostname = _get_server_hostname(hostnames, server), **kwargs)
+            if not client.is_valid():
+                raise Exception('InvalidTunnel')
+            config = client.to_vtund_config(use_cache = False)
+        except Exception as e:
+            yield (server, None, None, ClientConfigError(server, e))
+            continue
+        yield (server, client, config, None)
+
+def _to_bytes(data):
+    return data.encode('utf-8') if not isinstance(data, bytes) else data
+
+def _write_tar_member(f, name, data, mtime):
+    """ Write one regular file to a tar stream
+
+    \return The number of bytes written
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = TAR_MEMBER_MODE
+    info.mtime = mtime
+    header = info.tobuf(tarfile.GNU_FORMAT)
+    padding = -len(data) % tarfile.BLOCKSIZE
+    f.write(header)
+    f.write(data)
+    if padding:
+        f.write(b'\0' * padding)
+    return len(header) + len(data) + padding
+
+def write_tar_bundle(f, servers, hostnames, **kwargs):
+    """ Write the client configurations matching \p servers to a tar archive (see the module documentation for its layout)
+
+    The archive is streamed: each member is written as soon as its configuration is rendered, and nothing is kept about the previous ones (unlike tarfile.TarFile, which keeps the header of every member)
+
+    \param f A file object opened for writing in binary mode (it can be a gzip.GzipFile object, to compress the archive). It is not closed
+    \param servers An iterable of ServerVtunTunnel objects
+    \param hostnames The hostnames of the servers (see iter_client_configs())
+    \param kwargs Other arguments of iter_client_configs()
+
+    \return A tuple (count, errors) containing the number of configurations written, and the list of ClientConfigError objects describing the servers that were skipped
+    """
+    mtime = int(time.time())
+    size = 0
+    count = 0
+    errors = []
+    for (server, client, config, error) in iter_client_configs(servers, hostnames, **kwargs):
+        if error is None:
+            name = str(client.vtun_tunnel_name)
+            if not name or '/' in name or name in ['.', '..']:    # The name is used as a directory name
+                error = ClientConfigError(server, Exception('InvalidTunnelName:' + name))
+        if error is not None:
+            errors.append(error)
+            continue
+        size += _write_tar_member(f, name + '/vtund.conf', _to_bytes(config), mtime)
+        size += _write_tar_member(f, name + '/server', _to_bytes(str(client.vtun_server_hostname) + '\n'), mtime)
+        count += 1
+    end = b'\0' * (2 * tarfile.BLOCKSIZE)   # End of archive marker, then padding up to a whole record, like tarfile does
+    size += len(end)
+    f.write(end + b'\0' * (-size % tarfile.RECORDSIZE))
+    return (count, errors)
+
+def write_json_lines(f, servers, hostnames, **kwargs):
+    """ Write the client configurations matching \p servers as JSON lines, each line being an object with the keys vtun_tunnel_name, vtun_server_hostname, vtun_server_tcp_port and config
+
+    \param f A file object opened for writing in text mode. It is not closed
+    \param servers An iterable of ServerVtunTunnel objects
+    \param hostnames The hostnames of the servers (see iter_client_configs())
+    \param kwargs Other arguments of iter_client_configs()
+
+    \return A tuple (count, errors) containing the number of configurations written, and the list of ClientConfigError objects describing the servers that were skipped
+    """
+    count = 0
+    errors = []
+    for (server, client, config, error) in iter_client_configs(servers, hostnames, **kwargs):
+        if error is not None:
+            errors.append(error)
+            continue
+        record = {'vtun_tunnel_name': client.vtun_tunnel_name, 'vtun_server_hostname': client.vtun_server_hostname, 'vtun_server_tcp_port': client.vtun_server_tcp_port, 'config': config}
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return (count, errors)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from client_vtun_tunnel import ClientVtunTunnel
+from tunnel_journal import get_tunnel_definition, make_tunnel
+from vtund_config_delivery import CONFIG_DELIVERY_FILE, CONFIG_DELIVERY_PRIVATE_DIR
+
+import threading
+import time
+
+_FAILED_STATES = [ClientVtunTunnel.STATE_AUTH_FAILED, ClientVtunTunnel.STATE_DISCONNECTED, ClientVtunTunnel.STATE_EXITED]
+
+class ClientEndpointAttempt(object):
+    """ Class representing the connection attempt of a ClientEndpointRace to one server endpoint """
+
+    def __init__(self, endpoint, tunnel):
+        """ Constructor
+
+        \param endpoint A tuple (hostname, port) (port being None if the tunnel's vtun_server_tcp_port is used)
+        \param tunnel The ClientVtunTunnel object connecting to this endpoint
+        """
+        self.endpoint = endpoint
+        self.tunnel = tunnel
+        self.started_at = None  # The time the vtund client was started (None if the attempt has not been started)
+        self.duration = None    # The time (in seconds) until the session was opened or the attempt failed
+        self.error = None   # The exception that made the attempt fail (Exception('TunnelAuthenticationFailed') or Exception('TunnelConnectionFailed') when vtund reported it), None if it did not fail
+        self.stopped = False
+        self.denied = False # Set (by the state listener of connect()) as soon as vtund reports that the server denied the connection, as vtund exits right after that
+
+    def is_connected(self):
+        """ Check if the session of this attempt is opened
+
+        \return True if vtund reported that the session is opened (and it has not been closed since)
+        """
+        return self.error is None and self.tunnel.get_state() == ClientVtunTunnel.STATE_CONNECTED
+
+    def __repr__(self):
+        if self.started_at is None:
+            status = 'not started'
+        elif self.error is not None:
+            status = 'error: ' + str(self.error)
+        else:
+            status = self.tunnel.get_state()
+        return '<ClientEndpointAttempt ' + str(self.endpoint[0]) + ':' + str(self.endpoint[1] or self.tunnel.vtun_server_tcp_port) + ' ' + status + '>'
+
+class ClientEndpointRace(object):
+    """ Class connecting a client tunnel to the first of several vtund servers (endpoints) that opens a session, happy eyeballs style
+
+    Endpoints are tried in order, but without waiting for an endpoint to time out: the next one is started attempt_delay seconds after the previous one (or right away if the previous one failed), while the previous ones keep trying.
+    The first attempt whose session opens wins, and all other attempts are stopped, so that the connection time depends on the fastest healthy server, not on the timeout of the dead ones.
+    Each attempt runs its own vtund client (a copy of the template tunnel, see connect()). Note that until losers are stopped, several sessions may be opened at the same time, with the same tunnel addresses
+    """
+
+    ATTEMPT_DELAY = 0.5 # Default delay (in seconds) before starting the next attempt while the previous ones are still trying
+
+    def __init__(self, tunnel, endpoints, **kwargs):
+        """ Constructor
+
+        \param tunnel A ClientVtunTunnel object (not started) used as a template for the tunnel of each attempt. Its vtun_server_hostname is ignored
+        \param endpoints An ordered list of endpoints (most preferred first), each being a hostname (or IP address) string, or a tuple (hostname, port) to connect to another port than the vtun_server_tcp_port of \p tunnel
+        \param attempt_delay (optional) The delay (in seconds) between attempts (defaults to ATTEMPT_DELAY)
+        """
+        if not isinstance(tunnel, ClientVtunTunnel):
+            raise Exception('WrongTunnelObject')
+        self.template = tunnel
+        self.endpoints = []
+        for endpoint in endpoints:
+            if isinstance(endpoint, tuple):
+                (hostname, port) = endpoint
+                self.endpoints.append((hostname, int(port) if port is not None else None))
+            else:
+                self.endpoints.append((endpoint, None))
+        if not self.endpoints:
+            raise Exception('NoEndpoint')
+        self.attempt_delay = float(kwargs.get('attempt_delay', ClientEndpointRace.ATTEMPT_DELAY))
+        if self.attempt_delay < 0:
+            raise Exception('InvalidAttemptDelay:' + str(self.attempt_delay))
+        self._attempts = []
+        self._winner = None
+
+    def _make_attempt(self, endpoint):
+        """ Create the tunnel object of the attempt to connect to \p endpoint, by copying the template
+        """
+        definition = get_tunnel_definition(self.template)
+        definition['vtun_server_hostname'] = endpoint[0]
+        if endpoint[1] is not None:
+            definition['vtun_server_tcp_port'] = endpoint[1]
+        ports = set([port for (hostname, port) in self.endpoints if port is not None])
+        if definition['vtund_config_delivery'] in [None, CONFIG_DELIVERY_FILE] and (len(ports) > 1 or (ports and ports != set([self.template.vtun_server_tcp_port]))):
+            definition['vtund_config_delivery'] = CONFIG_DELIVERY_PRIVATE_DIR # Attempts share the same configuration file name, but not the same configuration (port)
+        tunnel = make_tunnel('client', definition, client_class = type(self.template), vtund_helper = self.template.vtund_helper, vtund_output_reactor = self.template._vtund_output_reactor)
+        return ClientEndpointAttempt(endpoint, tunnel)
+
+    def connect(self, timeout = None):
+        """ Start attempts to connect to the endpoints, until the session of one of them opens
+
+        \param timeout (optional) The maximum time (in seconds) to wait for a session to open (defaults to the vtun_connection_timeout of the template tunnel)
+
+        \return The ClientVtunTunnel object whose session is opened (its vtun_server_hostname and vtun_server_tcp_port are those of the endpoint that won), or None if \p timeout was reached. If all attempts failed, an Exception('TunnelAuthenticationFailed') is raised if all servers denied the connection, or an Exception('TunnelConnectionFailed') otherwise. In all these cases, all other attempts have been stopped
+        """
+        if self._winner is not None:
+            raise Exception('VtundAlreadyRunning')
+        if timeout is None:
+            timeout = self.template.vtun_connection_timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        self._attempts = [self._make_attempt(endpoint) for endpoint in self.endpoints]
+        state_changed = threading.Condition()
+        attempts_by_tunnel = dict([(id(attempt.tunnel), attempt) for attempt in self._attempts])
+        def on_state_change(tunnel, old_state, new_state):
+            if new_state == ClientVtunTunnel.STATE_AUTH_FAILED:
+                attempts_by_tunnel[id(tunnel)].denied = True
+            with state_changed:
+                state_changed.notify_all()
+        next_index = 0
+        next_start = time.time()
+        try:
+            while True:
+                now = time.time()
+                winner = None
+                running = 0
+                for attempt in self._attempts[:next_index]:
+                    if attempt.error is not None:
+                        continue
+                    state = attempt.tunnel.get_state()
+                    if state == ClientVtunTunnel.STATE_CONNECTED:
+                        winner = attempt
+                        break
+                    if state in _FAILED_STATES:
+                        self._fail(attempt, Exception('TunnelAuthenticationFailed' if attempt.denied else 'TunnelConnectionFailed'))
+                        next_start = now    # Do not wait for the attempt delay to try the next endpoint
+                    else:
+                        running += 1
+                if winner is not None:
+                    winner.duration = now - winner.started_at
+                    self._winner = winner
+                    return winner.tunnel
+                if next_index < len(self._attempts) and (now >= next_start or running == 0):  # Start next attempt (right away if all previous ones failed)
+                    attempt = self._attempts[next_index]
+                    next_index += 1
+                    attempt.tunnel.add_state_listener(on_state_change)
+                    attempt.started_at = time.time()
+                    try:
+                        attempt.tunnel.start()
+                    except Exception as e:
+                        self._fail(attempt, e)
+                        continue
+                    next_start = attempt.started_at + self.attempt_delay
+                    continue
+                if running == 0:    # All attempts failed
+                    if all([str(attempt.error) == 'TunnelAuthenticationFailed' for attempt in self._attempts]):
+                        raise Exception('TunnelAuthenticationFailed')
+                    raise Exception('TunnelConnectionFailed')
+                if deadline is not None and now >= deadline:
+                    return None
+                wait = None
+                if next_index < len(self._attempts):
+                    wait = next_start - now
+                if deadline is not None and (wait is None or deadline - now < wait):
+                    wait = deadline - now
+                with state_changed:
+                    if not self._has_state_changed(next_index):
+                        state_changed.wait(wait)
+        finally:
+            for attempt in self._attempts:
+                try:
+                    attempt.tunnel.remove_state_listener(on_state_change)
+                except ValueError:
+                    pass
+                if attempt is not self._winner:
+                    self._stop_attempt(attempt)
+
+    def _has_state_changed(self, next_index):
+        """ Check if one of the started attempts has reached a state that connect() has to handle (checked while holding the condition, so that no notification is missed)
+        """
+        for attempt in self._attempts[:next_index]:
+            if attempt.error is None and attempt.tunnel.get_state() != ClientVtunTunnel.STATE_CONNECTING:
+                return True
+        return False
+
+    def _fail(self, attempt, error):
+        attempt.error = error
+        attempt.duration = time.time() - attempt.started_at
+        self._stop_attempt(attempt)
+
+    def _stop_attempt(self, attempt):
+        """ Stop the vtund client of an attempt, if it has been started, and release its configuration
+        """
+        if attempt.started_at is None or attempt.stopped:
+            return
+        attempt.stopped = True
+        try:
+            attempt.tunnel.stop()   # Also reaps vtund and releases the configuration if vtund has already exitted by itself
+        except Exception:
+            pass    # vtund could not be started (or could not be killed)
+        attempt.tunnel._release_vtund_config()  # Private directories and memfds must not outlive the attempt, even if stop() failed
+
+    def get_attempts(self):
+        """ Get the attempts of the last connect()
+
+        \return A list of ClientEndpointAttempt objects, in the order of the endpoints
+        """
+        return list(self._attempts)
+
+    def get_tunnel(self):
+        """ Get the tunnel that won the last connect()
+
+        \return A ClientVtunTunnel object, or None if no attempt opened a session
+        """
+        if self._winner is None:
+            return None
+        return self._winner.tunnel
+
+    def stop(self, timeout = None):
+        """ Stop the tunnel that won the last connect() (connect() can then be called again)
+
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM (see ClientVtunTunnel.stop())
+        """
+        if self._winner is None:
+            raise Exception('VtundNotRunning')
+        winner = self._winner
+        self._winner = None
+        winner.stopped = True
+        winner.tunnel.stop(timeout)
@@ -5,22 +5,60 @@
 from __future__ import print_function
 
 from vtun_tunnel import VtunTunnel
+from output_ring_buffer import OutputRingBuffer
+from vtund_output_reactor import get_default_reactor
+from process_teardown import popen_new_session_kwargs, terminate_process_tree
+from vtund_config_renderer import render_client_options, render_client_section
+from proc_net import get_established_tcp_socket_inodes, get_process_socket_inodes
+from tunnel_metrics import start_timer, NULL_TIMER
+from tunnel_profile import PROFILE_ATTRIBUTES, check_mtu, resolve_profile_settings, get_profile_mismatches
 import server_vtun_tunnel
 
 import subprocess
 
 import threading
 
+import codecs
+
 import os
 
+import re
+
+import time
+
+# Patterns of the vtund client console messages that change the connection state (see the STATE_* constants of ClientVtunTunnel)
+_VTUND_CONNECTING_RE = re.compile(r'Connecting to ')
+_VTUND_SESSION_OPENED_RE = re.compile(r'Session \S+\[\S+\] opened')
+_VTUND_CONNECTION_DENIED_RE = re.compile(r'Connection denied by |Denied by server')
+_VTUND_DISCONNECTED_RE = re.compile(r'Session \S+\[\S+\] closed|Connect to \S+ failed|Connection closed by other side|Connection timed out')
+
+_state_cond_creation_lock = threading.Lock()
+
 class ClientVtunTunnel(VtunTunnel):
     
     """ Class representing a vtun tunnel client (connecting) """
+    
+    STATE_STOPPED = 'stopped'   # vtund has not been started
+    STATE_CONNECTING = 'connecting' # vtund is running and is trying to connect to the server
+    STATE_CONNECTED = 'connected'   # vtund reported that the session is opened
+    STATE_AUTH_FAILED = 'auth_failed'   # The server denied the connection (wrong tunnel name or shared secret)
+    STATE_DISCONNECTED = 'disconnected' # The connection failed or the session was closed
+    STATE_EXITED = 'exited' # vtund has exitted
+    
+    __slots__ = ['vtun_server_hostname', 'vtun_protocol', 'vtun_compression', 'vtun_encryption', 'vtun_keepalive', 'vtun_connection_timeout', 'vtund_output_max_size', '_vtund_output_buf', '_vtund_output_listeners', '_vtund_output_reactor', 'vtund_exit_value', '_state', '_state_cond', '_state_listeners', '_vtun_process_exit_expected']
+    
     def __init__(self, **kwargs): # See VtunTunnel.__init__ for the inherited kwargs
         """ Constructor (see VtunTunnel.__init__ for the inherited kwargs)
-        \param from_server Create a vtun client configuration to connect to the ServerVtunTunnel object specified as \p from_server
+        \param from_server Create a vtun client configuration to connect to the ServerVtunTunnel object specified as \p from_server. Its tuning profile, MTU, protocol, compression, encryption and keepalive are inherited: if tuning_profile or one of these attributes is also provided with a different value, a 'TuningProfileMismatch' exception is raised
+        \param vtun_protocol (optional) The transport protocol ('tcp' or 'udp')
+        \param vtun_compression (optional) The compression (see vtun documentation for valid values)
+        \param vtun_encryption (optional) A boolean enabling encryption
+        \param vtun_keepalive (optional) A boolean enabling keepalives
+        Note: vtun_protocol, vtun_compression, vtun_encryption and vtun_keepalive are not written in the configuration when they are None (the default, unless built with from_server or tuning_profile), the server then decides
         \param vtun_server_hostname The hostname or IP address of the vtun server this client will connect to. If not provided at construction, a subsequent call to set_vtun_server_hostname() will be required
         \param vtun_connection_timeout The timeout limit from the client to connect.
+        \param vtund_output_max_size (optional) The maximum number of characters of vtund console output kept in memory (see get_output())
+        \param vtund_output_reactor (optional) The VtundOutputReactor object watching the vtund console output (defaults to the reactor shared by all tunnels, see get_default_reactor())
         """
         arg_from_server = kwargs.get('from_server', None) # Server from which we create a client config
         if arg_from_server is None:
@@ -28,15 +66,38 @@ class ClientVtunTunnel(VtunTunnel):
         else:   # We are building the client config to match a server config
             if not isinstance(arg_from_server, server_vtun_tunnel.ServerVtunTunnel):
                 raise Exception('WrongFromServerObject')
-            super(ClientVtunTunnel, self).__init__(vtund_exec = arg_from_server.vtund_exec, mode = arg_from_server.tunnel_mode, tunnel_ip_network = arg_from_server.tunnel_ip_network, tunnel_near_end_ip = arg_from_server.tunnel_far_end_ip, tunnel_far_end_ip = arg_from_server.tunnel_near_end_ip, vtun_server_tcp_port = arg_from_server.vtun_server_tcp_port, vtun_tunnel_name = arg_from_server.vtun_tunnel_name, vtun_shared_secret = arg_from_server.vtun_shared_secret)
+            # Addresses are copied as stored by the server (already validated strings or ipaddr objects), so that reading them does not create ipaddr objects
+            super(ClientVtunTunnel, self).__init__(vtund_exec = arg_from_server.vtund_exec, mode = arg_from_server.tunnel_mode, tunnel_ip_network = arg_from_server._tunnel_ip_network, tunnel_near_end_ip = arg_from_server._tunnel_far_end_ip, tunnel_far_end_ip = arg_from_server._tunnel_near_end_ip, vtun_server_tcp_port = arg_from_server.vtun_server_tcp_port, vtun_tunnel_name = arg_from_server.vtun_tunnel_name, vtun_shared_secret = arg_from_server.vtun_shared_secret, mtu = arg_from_server.mtu)
+            self.tuning_profile = arg_from_server.tuning_profile
+        settings = resolve_profile_settings(kwargs.get('tuning_profile', None), kwargs)
+        if settings:
+            kwargs = dict(kwargs, **settings)   # Values set by the tuning profile take precedence
+        self.vtun_protocol = kwargs.get('vtun_protocol', None)
+        self.vtun_compression = kwargs.get('vtun_compression', None)
+        self.vtun_encryption = kwargs.get('vtun_encryption', None)
+        self.vtun_keepalive = kwargs.get('vtun_keepalive', None)
+        if arg_from_server is not None:
+            if kwargs.get('mtu', None) is not None:
+                self.mtu = check_mtu(kwargs['mtu'])   # So that it is compared with the server's below
+            mismatches = get_profile_mismatches(arg_from_server, self)    # Values requested for this client (if any) must match the server's
+            if mismatches:
+                raise Exception('TuningProfileMismatch:' + ','.join(mismatches))
+            for attribute in PROFILE_ATTRIBUTES:
+                setattr(self, attribute, getattr(arg_from_server, attribute))
         self.vtun_server_hostname = kwargs.get('vtun_server_hostname', None)  # The remote host to connect to (if provided)
         # Note: in all cases, the caller will need to provide a vtun_server_hostname (it is not part of the ServerVtunTunnel object)
         self.vtun_connection_timeout = kwargs.get('vtun_connection_timeout', 300) # 5Min for default client timeout. Purely arbitary choosen value here. Might change in the future.
-        self._vtund_output_buf = None    # Attribute containing the console output of the child process
-        self._vtund_output_watcher_thread = None    # A thread to watch the console output and store it inside  self._vtund_output_buf above
+        self.vtund_output_max_size = kwargs.get('vtund_output_max_size', OutputRingBuffer.MAX_SIZE)
+        self._vtund_output_buf = None    # OutputRingBuffer object containing the most recent console output of the child process
+        self._vtund_output_listeners = None  # Functions called with each new line of console output (the list is created by add_output_listener())
+        self._vtund_output_reactor = kwargs.get('vtund_output_reactor', None)    # The reactor watching the console output and storing it inside self._vtund_output_buf above
         self._vtun_process = None
         self._vtun_pid = None
         self.vtund_exit_value = None
+        self._state = ClientVtunTunnel.STATE_STOPPED
+        self._state_cond = None    # Condition protecting self._state (created by _get_state_cond(), only for tunnels that are started)
+        self._state_listeners = None # Functions called on each connection state transition (the list is created by add_state_listener())
+        self._vtun_process_exit_expected = None
     
     def set_vtun_server_hostname(self, vtun_server_hostname):
         """ Set the remote host to connect to
@@ -48,47 +109,12 @@ class ClientVtunTunnel(VtunTunnel):
         self.vtun_server_hostname = vtun_server_hostname
     
        
-    def to_vtund_config(self):
+    def to_vtund_config(self, use_cache = True):
         """ Generate a vtund config string matching with this object attributes
+        \param use_cache (optional) If False, the tunnel section is not kept in the render cache (see vtund_config_renderer.render_client_section())
         \return A string containing a configuration to provide to the vtund exec
         """
-        indent_unit = '\t'
-        cr_lf = '\n';
-        config = ''
-        config += 'options {' + cr_lf
-        config += indent_unit + 'port ' + str(self.vtun_server_tcp_port) + ';' + cr_lf
-        config += indent_unit + 'timeout ' + str(self.vtun_connection_timeout) + ';' + cr_lf        
-        config += indent_unit + 'ppp /usr/sbin/pppd;' + cr_lf
-        config += indent_unit + 'ifconfig /sbin/ifconfig;' + cr_lf
-        config += indent_unit + 'route /sbin/route;' + cr_lf
-        config += indent_unit + 'ip /sbin/ip;' + cr_lf
-        config += '}' + cr_lf
-        config += cr_lf
-        config += self.vtun_tunnel_name + ' {' + cr_lf
-        if not self.interface_name is None:
-            config += indent_unit + 'device ' + str(self.interface_name) + ';' + cr_lf
-        config += indent_unit + 'passwd ' + str(self.vtun_shared_secret) + ';' + cr_lf
-        config += indent_unit + 'persist no;' + cr_lf
-        config += cr_lf
-        config += indent_unit + 'up {' + cr_lf
-        config += indent_unit * 2  + 'ifconfig "%% ' + str(self.tunnel_near_end_ip) + ' pointopoint ' + str(self.tunnel_far_end_ip) + ' mtu 1450";' + cr_lf
-        if not self.up_additional_commands is None:
-            for command in self.up_additional_commands:
-                if command[0] == '/':
-                    config += indent_unit*2 + 'program ' + str(command) + ';' + cr_lf
-                else:
-                    raise Exception('NotAFullPathCommand')
-        config += indent_unit + '};' + cr_lf
-        config += indent_unit + 'down {' + cr_lf
-        if not self.down_additional_commands is None:
-            for command in self.down_additional_commands:
-                if command[0] == '/':
-                    config += indent_unit*2 + 'program ' + str(command) + ';' + cr_lf
-                else:
-                    raise Exception('NotAFullPathCommand')
-        config += indent_unit + '};' + cr_lf
-        config += '}' + cr_lf
-        return config
+        return render_client_options(self.vtun_server_tcp_port, self.vtun_connection_timeout) + '\n' + render_client_section(self, use_cache)
     
     def is_valid(self): # Overload is_valid() for client tunnels... we also need a vtun_server_hostname
         """ Check if our attributes are enough to define a vtun tunnel
@@ -100,8 +126,12 @@ class ClientVtunTunnel(VtunTunnel):
             return False
         return True
     
-    def start(self):
-        """ Start the vtund exec
+    def _prepare_start(self, phase_timer = NULL_TIMER):
+        """ Check that the vtund exec can be started, and save its configuration file
+        
+        \param phase_timer (optional) The tunnel_metrics.PhaseTimer object timing the start
+        
+        \return The path of the configuration file
         """
         if not (self._vtun_pid is None and self._vtun_process is None):    # There is already a slave vtun process running
             raise Exception('VtundAlreadyRunning')
@@ -114,92 +144,282 @@ class ClientVtunTunnel(VtunTunnel):
         
         #Step 1: save configuration file
         vtund_config = self.to_vtund_config()
+        phase_timer.phase('render')
         vtund_config_filename = '/tmp/vtund-' + str(self.vtun_tunnel_name) + '-client.conf'
-        try:
-            f = open(vtund_config_filename, 'w')
-            f.write(vtund_config)
-            f.close()
-        except:
-            raise Exception('ConfigurationFileWritingIssue')
+        vtund_config_filename = self._deliver_vtund_config(vtund_config_filename, vtund_config)
+        phase_timer.phase('deliver')
+        return vtund_config_filename
+    
+    def _get_vtund_command(self, vtund_config_filename):
+        """ Get the command line to run the vtund exec in the foreground
         
-        #Step 2: Runs vtun and saves the pid and process
+        \param vtund_config_filename The path of the configuration file to provide to vtund
+        
+        \return The command line (as a list)
+        """
         vtund_cmd = []
-        if self.vtund_use_sudo:
+        if self.vtund_use_sudo and self.vtund_helper is None:   # The helper already runs vtund as root
                 vtund_cmd = ['sudo']
         vtund_cmd += [self.vtund_exec, '-n', '-f', vtund_config_filename, str(self.vtun_tunnel_name), str(self.vtun_server_hostname)]
-        proc = subprocess.Popen(vtund_cmd, shell=False, stdin=open(os.devnull, "r"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return vtund_cmd
+    
+    def start(self):
+        """ Start the vtund exec
+        """
+        phase_timer = start_timer('client', 'start')
+        try:
+            vtund_config_filename = self._prepare_start(phase_timer)
+        except Exception as e:
+            phase_timer.done(e)
+            raise e
+        
+        #Step 2: Runs vtun and saves the pid and process
+        vtund_cmd = self._get_vtund_command(vtund_config_filename)
+        try:
+            if self.vtund_helper is not None:
+                proc = self.vtund_helper.popen(vtund_cmd, capture_output=True)  # The helper also runs vtund in its own session
+            else:
+                proc = subprocess.Popen(vtund_cmd, shell=False, close_fds=True, stdin=open(os.devnull, "r"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **popen_new_session_kwargs())   # vtund gets its own process group
+        except Exception as e:
+            self._release_vtund_config()
+            phase_timer.done(e)
+            raise e
+        phase_timer.phase('spawn')
         self._vtun_process = proc
         self._vtun_pid = proc.pid
-        self._vtund_output_buf = ''
+        self._vtund_output_buf = OutputRingBuffer(self.vtund_output_max_size, self._on_vtund_output_line)
         self._vtun_process_exit_expected = threading.Event()
         self.vtund_exit_value = None
-        self._vtund_output_watcher_thread = threading.Thread(target = self._vtund_output_watcher)
-        self._vtund_output_watcher_thread.setDaemon(True) # _vtundd_output_watcher should be forced to terminate when main program exits
-        self._vtund_output_watcher_thread.start()
+        self._set_state(ClientVtunTunnel.STATE_CONNECTING)
+        phase_timer.watch_connection(self)
+        if self._vtund_output_reactor is None:
+            self._vtund_output_reactor = get_default_reactor()
+        self._vtund_output_reactor.register(proc.stdout.fileno(), self._make_vtund_output_callback(), lambda: self._on_vtund_output_eof(proc))
+        phase_timer.done()
     
-    def _checkPid(self, pid):
-        """ Check For the existence of a UNIX PID
+    def stop(self, timeout = None):
+        """ Stop the vtund exec
+        
+        vtund and its descendants (its process group) are sent SIGTERM, and SIGKILL if vtund has not exitted within \p timeout
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM (defaults to VTUND_STOP_TIMEOUT)
         """
-        try:
-            os.kill(pid, 0)
-        except OSError:
-            return False
-        else:
-            return True
-            
-    def stop(self):
         if self._vtun_pid is None or self._vtun_process is None:
             raise Exception('VtundNotRunning')
         else:
+            if timeout is None:
+                timeout = server_vtun_tunnel.VTUND_STOP_TIMEOUT
+            phase_timer = start_timer('client', 'stop')
+            proc = self._vtun_process   # The output reactor may forget about the process as soon as it has exitted
             self._vtun_process_exit_expected.set()  # We are killing the subprocess, so expect it to exit
-            if self.vtund_use_sudo:
-                pid = self._vtun_pid
-                if not self._vtun_pid is None and pid != 1:
-                    args = ['sudo', 'kill', '-SIGINT', str(pid)] # Send Ctrl+C to slave DHCP client process
-                    subprocess.call(args, stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
-                    while self._checkPid(pid): # Loop if slave process is still running
-                        time.sleep(0.1)
-                        timeout -= 0.1
-                        if timeout <= 0: # We have reached timeout... send a SIGKILL to the slave process to force termination
-                            args = ['sudo', 'kill', '-SIGKILL', str(pid)] # Send Ctrl+C to slave DHCP client process
-                            subprocess.call(args, stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
-                            break
-            else:
-                self._vtun_process.terminate()
-            self._vtun_process.wait()
+            if proc.poll() is None:
+                if not terminate_process_tree(self._vtun_pid, timeout, self.vtund_use_sudo, self.vtund_helper):
+                    e = Exception('OneOfProcessesCouldNotBeKilled')
+                    phase_timer.done(e)
+                    raise e
+            # else: vtund has already exitted (and has been reaped), its PID may have been reused by another process, so it must not be signalled
+            phase_timer.phase('terminate')
+            self.vtund_exit_value = proc.wait()
+            phase_timer.phase('reap')
             self._vtun_pid = None
             self._vtun_process = None
+            self._release_vtund_config()
+            phase_timer.phase('release')
+            self._set_state(ClientVtunTunnel.STATE_EXITED)
+            phase_timer.done()
     
-    def _vtund_output_watcher(self):
-        """ Watch the output of the vtund subprocess and store it in a buffer
+    def _reattach(self, process, vtund_config_file):
+        """ Take over a vtund process started by a previous instance of our program (see VtunTunnel._reattach())
+        
+        The console output of this vtund process cannot be read anymore (get_output() returns None), so the connection state is only set from its sockets (STATE_CONNECTED if it has a connection established to the server port), and then only tracks its exit
         """
-        if self._vtund_output_buf or self._vtun_process is None:
-            raise Exception('SubprocessOutputNotReady')
+        super(ClientVtunTunnel, self)._reattach(process, vtund_config_file)
+        self._vtun_process_exit_expected = threading.Event()
+        self.vtund_exit_value = None
+        process_inodes = get_process_socket_inodes(process.pid)
+        if process_inodes is not None and process_inodes & get_established_tcp_socket_inodes(self.vtun_server_tcp_port):
+            self._set_state(ClientVtunTunnel.STATE_CONNECTED)
+        else:
+            self._set_state(ClientVtunTunnel.STATE_CONNECTING)
+        if self._vtund_output_reactor is None:
+            self._vtund_output_reactor = get_default_reactor()
+        self._vtund_output_reactor.watch_exit(process.pid, lambda: self._on_adopted_vtund_exit(process))
+    
+    def _on_adopted_vtund_exit(self, proc):
+        """ Update the connection state once a vtund process taken over by _reattach() has exitted (called from the reactor thread)
+        """
+        if not proc is self._vtun_process:  # Process has already been stopped (and maybe restarted) in the meantime
+            return
+        self.vtund_exit_value = proc.poll()
+        self._set_state(ClientVtunTunnel.STATE_EXITED)
+        if self._vtun_process_exit_expected.is_set():
+            self._vtun_pid = None
+            self._vtun_process = None
+    
+    def _make_vtund_output_callback(self):
+        """ Build the function storing the chunks of vtund output read by the output reactor (under Python 3, bytes are decoded incrementally)
+        """
+        output_buf = self._vtund_output_buf
+        if str is bytes:
+            return output_buf.append
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        return lambda data: output_buf.append(decoder.decode(data))
+    
+    def _on_vtund_output_eof(self, proc, retry_delay = 0.001):
+        """ Handle the end of the output of the vtund subprocess \p proc (called from the output reactor thread)
         
-        try:
+        \param proc The python process object whose output reached EOF
+        \param retry_delay The delay before checking again if \p proc has not exitted yet
+        """
+        if not proc.stdout.closed:
+            proc.stdout.close()
+            if self._vtund_output_buf is not None:
+                self._vtund_output_buf.close()
+        exit_value = proc.poll()
+        if exit_value is None:  # Output is closed but process is still exitting, check again later without blocking the reactor
+            self._vtund_output_reactor.call_later(retry_delay, lambda: self._on_vtund_output_eof(proc, min(retry_delay * 2, 0.5)))
+            return
+        if not proc is self._vtun_process:  # Process has already been stopped (and maybe restarted) in the meantime
+            return
+        self.vtund_exit_value = exit_value    # Store exit value
+        if self._vtun_process_exit_expected.is_set():   # We have been informed that the subprocess would exit, so this is expected
+            self._vtun_pid = None   # Forget about slave... it is not running anymore
+            self._vtun_process = None
+        # else: vtund died unexpectedly, this is reported to the state listeners (and to the TunnelSupervisor watching this tunnel, if any). The process is kept until stop() is called, which then only releases its resources
+        self._set_state(ClientVtunTunnel.STATE_EXITED)
+    
+    def _on_vtund_output_line(self, line):
+        """ Update the connection state according to a new line of vtund console output, and dispatch the line to the registered listeners
+        """
+        self._parse_vtund_output_line(line)
+        if self._vtund_output_listeners:
+            for listener in list(self._vtund_output_listeners):
+                listener(line)
+    
+    def _parse_vtund_output_line(self, line):
+        """ Update the connection state according to one line of vtund console output (each line is parsed only once, when it arrives)
+        """
+        if _VTUND_SESSION_OPENED_RE.search(line):
+            self._set_state(ClientVtunTunnel.STATE_CONNECTED)
+        elif _VTUND_CONNECTION_DENIED_RE.search(line):
+            self._set_state(ClientVtunTunnel.STATE_AUTH_FAILED)
+        elif _VTUND_DISCONNECTED_RE.search(line):
+            if self._state != ClientVtunTunnel.STATE_AUTH_FAILED:   # Keep the reason of the failure
+                self._set_state(ClientVtunTunnel.STATE_DISCONNECTED)
+        elif _VTUND_CONNECTING_RE.search(line):
+            self._set_state(ClientVtunTunnel.STATE_CONNECTING)
+    
+    def _get_state_cond(self):
+        """ Get the condition protecting the connection state, creating it if needed
+        """
+        if self._state_cond is None:
+            with _state_cond_creation_lock:
+                if self._state_cond is None:
+                    self._state_cond = threading.Condition()
+        return self._state_cond
+    
+    def _set_state(self, new_state):
+        """ Change the connection state, waking up wait_until_connected() and calling the state listeners
+        """
+        state_cond = self._get_state_cond()
+        with state_cond:
+            old_state = self._state
+            if old_state == new_state:
+                return
+            self._state = new_state
+            state_cond.notify_all()
+        if self._state_listeners:
+            for listener in list(self._state_listeners):
+                listener(self, old_state, new_state)
+    
+    def get_state(self):
+        """ Get the connection state of this tunnel
+        
+        \return One of the STATE_* strings
+        """
+        return self._state
+    
+    def add_state_listener(self, listener):
+        """ Register a function to be called on each connection state transition
+        
+        Warning: \p listener may be called from the output reactor thread (shared by all tunnels), so it should return quickly
+        
+        \param listener A function taking the tunnel object, the old state and the new state (STATE_* strings) as arguments
+        """
+        if self._state_listeners is None:
+            self._state_listeners = []
+        self._state_listeners.append(listener)
+    
+    def remove_state_listener(self, listener):
+        """ Unregister a function previously registered with add_state_listener()
+        """
+        if self._state_listeners is None:
+            raise ValueError('Listener not registered')
+        self._state_listeners.remove(listener)
+    
+    def wait_until_connected(self, timeout = None):
+        """ Wait until vtund reports that the session is opened
+        
+        \param timeout (optional) The maximum time (in seconds) to wait (wait forever if None)
+        
+        \return True if the session is opened, False if \p timeout was reached. An Exception('TunnelAuthenticationFailed') is raised if the server denied the connection, and an Exception('TunnelConnectionFailed') if vtund disconnected or exitted before the session was opened
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        state_cond = self._get_state_cond()
+        with state_cond:
             while True:
-                new_output = self._vtun_process.stdout.read(1)
-                if new_output == '':
-                    poll_result = self._vtun_process.poll()
-                    if poll_result is None:   # Process actually died
-                        self.vtund_exit_value = poll_result    # Store exit value
-                        if self._vtun_process_exit_expected.is_set():   # We have been informed that the subprocess would exit, so this is expected
-                            del self._vtun_process_exit_expected    # Remove this event from attributes
-                            self._vtun_pid = None   # Forget about slave... it is not running anymore
-                            self._vtun_process = None
-                            break   # No need to continue parsing output, process has exitted
-                        else:   # Subprocess died unexpectedly
-                            raise Exception('SubprocessDiedUnexpectedly')
-                    else:   # Got eof but process is still alive
-                        raise Exception('GotEofFromSubprocess')
+                if self._state == ClientVtunTunnel.STATE_CONNECTED:
+                    return True
+                if self._state == ClientVtunTunnel.STATE_AUTH_FAILED:
+                    raise Exception('TunnelAuthenticationFailed')
+                if self._state in [ClientVtunTunnel.STATE_DISCONNECTED, ClientVtunTunnel.STATE_EXITED]:
+                    raise Exception('TunnelConnectionFailed')
+                if self._state == ClientVtunTunnel.STATE_STOPPED:
+                    raise Exception('VtundNotRunning')
+                if timeout is None:
+                    state_cond.wait()
                 else:
-                    self._vtund_output_buf += new_output    # Continue building output buffer
-        except AttributeError:    # AttributeError NoneType exceptions happen when our objects were deleted (subprocessed was killed) while in the loop
-            pass    # Just discard and exit the thread
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    state_cond.wait(remaining)
+    
+    def add_output_listener(self, listener):
+        """ Register a function to be called with each new line of vtund console output (for this run and subsequent ones)
         
+        Warning: \p listener is called from the output reactor thread (shared by all tunnels), so it should return quickly
+        
+        \param listener A function taking the line (a string without trailing newline) as argument
+        """
+        if self._vtund_output_listeners is None:
+            self._vtund_output_listeners = []
+        self._vtund_output_listeners.append(listener)
+    
+    def remove_output_listener(self, listener):
+        """ Unregister a function previously registered with add_output_listener()
+        """
+        if self._vtund_output_listeners is None:
+            raise ValueError('Listener not registered')
+        self._vtund_output_listeners.remove(listener)
+    
+    def iter_output_lines(self, timeout = None, from_start = True):
+        """ Stream the lines of console output from the child vtund process, as they arrive
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for a new line (wait forever if None)
+        \param from_start (optional) If True (default), first yield the lines already received, otherwise only yield new lines
+        
+        \return A generator of strings (lines without their trailing newline), ending when vtund exits or when \p timeout is reached
+        """
+        if self._vtund_output_buf is None:
+            raise Exception('SubprocessOutputNotReady')
+        return self._vtund_output_buf.iter_lines(timeout, from_start)
+    
     def get_output(self):
         """ Get the console output (stdout and stderr) from the child vtund process
         
-        \return A string containing the full output (or None if we could not get the output)
+        \return A string containing the most recent output (at most vtund_output_max_size characters, or None if we could not get the output)
         """
-        return self._vtund_output_buf
+        if self._vtund_output_buf is None:
+            return None
+        return self._vtund_output_buf.get_output()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+class OutputRingBuffer(object):
+    """ Class storing the most recent console output of a process, within a bounded size
+
+    Output is appended by chunks. Complete lines are also kept (within the same bound) so that readers can stream them with iter_lines(), and they can be pushed to a callback as they arrive
+    """
+
+    MAX_SIZE = 65536
+
+    def __init__(self, max_size = None, line_callback = None):
+        """ Constructor
+
+        \param max_size (optional) The maximum number of characters of output to keep (defaults to MAX_SIZE). Older output is discarded
+        \param line_callback (optional) A function called (from the thread appending output) with each new complete line (without its trailing newline)
+        """
+        if max_size is None:
+            max_size = OutputRingBuffer.MAX_SIZE
+        self.max_size = int(max_size)
+        if self.max_size <= 0:
+            raise Exception('InvalidBufferSize:' + str(max_size))
+        self._line_callback = line_callback
+        self._chunks = collections.deque()
+        self._size = 0
+        self._joined = ''   # Cache for get_output()
+        self._joined_valid = True
+        self._partial_line = ''
+        self._lines = collections.deque()   # Most recent complete lines
+        self._lines_size = 0
+        self._first_line_index = 0  # Absolute index of self._lines[0] since the buffer was created
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def append(self, data):
+        """ Append a chunk of output
+
+        \param data A string containing the new output
+        """
+        if not data:
+            return
+        with self._cond:
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size - len(self._chunks[0]) >= self.max_size:  # Drop whole chunks as long as we keep at least max_size characters
+                self._size -= len(self._chunks.popleft())
+            if self._size > self.max_size:  # Trim the oldest chunk
+                excess = self._size - self.max_size
+                self._chunks[0] = self._chunks[0][excess:]
+                self._size -= excess
+            self._joined_valid = False
+
+            new_lines = (self._partial_line + data).split('\n')
+            self._partial_line = new_lines.pop()
+            if len(self._partial_line) > self.max_size:
+                self._partial_line = self._partial_line[-self.max_size:]
+            for line in new_lines:
+                self._store_line(line)
+            if new_lines:
+                self._cond.notify_all()
+        if self._line_callback is not None:
+            for line in new_lines:
+                self._line_callback(line)
+
+    def _store_line(self, line):
+        self._lines.append(line)
+        self._lines_size += len(line) + 1
+        while self._lines_size > self.max_size and len(self._lines) > 1:
+            self._lines_size -= len(self._lines.popleft()) + 1
+            self._first_line_index += 1
+
+    def close(self):
+        """ Signal that no more output will be appended (the process exitted). A trailing incomplete line is then considered complete
+        """
+        with self._cond:
+            if self._closed:
+                return
+            last_line = self._partial_line
+            self._partial_line = ''
+            if last_line:
+                self._store_line(last_line)
+            self._closed = True
+            self._cond.notify_all()
+        if last_line and self._line_callback is not None:
+            self._line_callback(last_line)
+
+    def is_closed(self):
+        return self._closed
+
+    def get_output(self):
+        """ Get the most recent output (at most max_size characters)
+
+        \return A string containing the output
+        """
+        with self._cond:
+            if not self._joined_valid:
+                self._joined = ''.join(self._chunks)
+                self._chunks.clear()
+                if self._joined:
+                    self._chunks.append(self._joined)   # Keep the joined string as the only chunk, so that next calls do not join again
+                self._joined_valid = True
+            return self._joined
+
+    def iter_lines(self, timeout = None, from_start = True):
+        """ Iterate over complete lines of output, waiting for new lines as they arrive
+
+        Iteration stops when the buffer is closed (and all lines have been read), or when no new line arrived within \p timeout.
+        If the reader is too slow and lines have been discarded from the buffer, iteration resumes at the oldest line still available
+
+        \param timeout (optional) The maximum time (in seconds) to wait for a new line (wait forever if None)
+        \param from_start (optional) If True (default), first yield the lines already in the buffer, otherwise only yield new lines
+
+        \return A generator of strings (lines without their trailing newline)
+        """
+        with self._cond:
+            if from_start:
+                index = self._first_line_index
+            else:
+                index = self._first_line_index + len(self._lines)
+        while True:
+            with self._cond:
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while index >= self._first_line_index + len(self._lines) and not self._closed:
+                    if timeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return
+                        self._cond.wait(remaining)
+                if index >= self._first_line_index + len(self._lines):    # Closed and no more lines
+                    return
+                index = max(index, self._first_line_index)
+                line = self._lines[index - self._first_line_index]
+            index += 1
+            yield line
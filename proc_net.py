@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+
+TCP_ESTABLISHED = '01' # TCP_ESTABLISHED state, as found in /proc/net/tcp
+TCP_LISTEN = '0A'   # TCP_LISTEN state, as found in /proc/net/tcp
+
+def get_listening_tcp_sockets():
+    """ Get all listening TCP sockets of the system in one pass over /proc/net/tcp and /proc/net/tcp6
+
+    \return A dict containing the listening TCP ports as keys, and a set of the socket inodes listening on this port as values
+    """
+    sockets = {}
+    for table in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            f = open(table, 'r')
+        except IOError:
+            continue    # No IPv6 support for example
+        try:
+            f.readline()    # Skip header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 10 or fields[3] != TCP_LISTEN:
+                    continue
+                port = int(fields[1].rsplit(':', 1)[1], 16)
+                sockets.setdefault(port, set()).add(fields[9])
+        finally:
+            f.close()
+    return sockets
+
+def get_established_tcp_socket_inodes(remote_port = None):
+    """ Get the inodes of all established TCP connections of the system in one pass over /proc/net/tcp and /proc/net/tcp6
+
+    \param remote_port (optional) Only get the connections to this TCP port
+
+    \return A set of strings containing the socket inodes
+    """
+    inodes = set()
+    for table in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            f = open(table, 'r')
+        except IOError:
+            continue    # No IPv6 support for example
+        try:
+            f.readline()    # Skip header
+            for line in f:
+                fields = line.split()
+                if len(fields) < 10 or fields[3] != TCP_ESTABLISHED:
+                    continue
+                if remote_port is not None and int(fields[2].rsplit(':', 1)[1], 16) != int(remote_port):
+                    continue
+                inodes.add(fields[9])
+        finally:
+            f.close()
+    return inodes
+
+def get_listening_tcp_ports():
+    """ Get all listening TCP ports of the system in one pass
+
+    \return A set of int containing the listening TCP ports
+    """
+    return set(get_listening_tcp_sockets().keys())
+
+def is_tcp_port_listening(port):
+    """ Check if a TCP port is listening on the system (without connecting to it)
+
+    \param port A string or an int containing the TCP port
+
+    \return True if some socket is listening on \p port
+    """
+    return int(port) in get_listening_tcp_sockets()
+
+def get_process_socket_inodes(pid):
+    """ Get the inodes of all sockets opened by a process
+
+    \param pid The PID of the process
+
+    \return A set of strings containing the socket inodes (as found in /proc/net/tcp), or None if we are not allowed to inspect the file descriptors of \p pid
+    """
+    fd_dir = '/proc/' + str(pid) + '/fd'
+    inodes = set()
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return None
+    for fd in fds:
+        try:
+            target = os.readlink(fd_dir + '/' + fd)
+        except OSError:
+            continue    # fd has been closed in the meantime
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+    return inodes
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+_SYS_PIDFD_OPEN = 434   # Same syscall number on all Linux architectures
+
+_libc = None
+
+def popen_new_session_kwargs():
+    """ Get the subprocess.Popen() keyword arguments making the child process the leader of a new session (and thus of a new process group), so that it can be torn down with all its descendants at once
+
+    \return A dict of keyword arguments
+    """
+    if sys.version_info[0] >= 3:
+        return {'start_new_session': True}
+    else:
+        return {'preexec_fn': os.setsid}
+
+def get_child_pids(pid):
+    """ Get the PIDs of the children of a process, from /proc (without running any external process)
+
+    \param pid The PID of the parent process
+
+    \return A list of int containing the PIDs of the children processes
+    """
+    pid = int(pid)
+    try:
+        with open('/proc/' + str(pid) + '/task/' + str(pid) + '/children', 'r') as f:  # Only lists children of the main thread, which is where vtund forks from
+            return [int(child) for child in f.read().split()]
+    except IOError:
+        pass    # Kernel without CONFIG_PROC_CHILDREN, scan all processes instead
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat', 'r') as f:
+                stat = f.read()
+        except IOError:
+            continue    # Process exitted in the meantime
+        fields = stat[stat.rfind(')') + 2:].split()  # Process name (2nd field) may contain spaces, fields after it start with state, ppid
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+def _is_process_gone(pid):
+    """ Check if a process has exitted (including if it is a zombie not yet reaped)
+
+    \return True if the process does not exist or is a zombie
+    """
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'r') as f:
+            stat = f.read()
+    except IOError:
+        return True
+    return stat[stat.rfind(')') + 2] in ['Z', 'X']
+
+def pidfd_open(pid):
+    """ Get a file descriptor that becomes readable when a process exits (Linux 5.3 or later)
+
+    \param pid The PID of the process
+
+    \return A file descriptor (to close with os.close()), or None if pidfds are not supported or the process does not exist
+    """
+    if hasattr(os, 'pidfd_open'):
+        try:
+            return os.pidfd_open(int(pid))
+        except OSError:
+            return None
+    global _libc
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = _libc.syscall(_SYS_PIDFD_OPEN, int(pid), 0)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return fd
+
+def wait_for_exit(pid, timeout):
+    """ Wait until a process has exitted (without reaping it)
+
+    A pidfd is used when available, we otherwise fall back to checking /proc with a backoff from 1ms to 50ms
+
+    \param pid The PID of the process
+    \param timeout The maximum time (in seconds) to wait
+
+    \return True if the process has exitted, False if \p timeout was reached
+    """
+    deadline = time.time() + timeout
+    pidfd = pidfd_open(pid)
+    if pidfd is not None:
+        try:
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            while True:
+                remaining = deadline - time.time()
+                try:
+                    if poller.poll(max(0, remaining) * 1000):
+                        return True
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if remaining <= 0:
+                    return _is_process_gone(pid)
+        finally:
+            os.close(pidfd)
+    interval = 0.001
+    while not _is_process_gone(pid):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 0.05)
+    return True
+
+def send_signal(pid, sig, use_sudo = False, helper = None):
+    """ Send a signal to one single process
+
+    \param pid The PID of the process
+    \param sig The signal number to send
+    \param use_sudo A boolean indicating whether the process runs as root, in which case 'sudo kill' is used if we are not allowed to signal it ourselves
+    \param helper (optional) A VtundHelperClient object that spawned the process, used instead of sudo if we are not allowed to signal it ourselves
+
+    \return False if the process did not exist anymore, True otherwise
+    """
+    return _send_signal_to_targets([int(pid)], sig, use_sudo, helper)
+
+def signal_process_tree(pid, sig, use_sudo = False, helper = None):
+    """ Send a signal to a process and its descendants
+
+    If \p pid is in its own process group (it has been started with popen_new_session_kwargs(), possibly via sudo), the whole group is signalled at once, otherwise \p pid and its direct children are signalled
+
+    \param pid The PID of the process
+    \param sig The signal number to send
+    \param use_sudo A boolean indicating whether the processes run as root (see send_signal())
+    \param helper (optional) A VtundHelperClient object (see send_signal())
+
+    \return False if the process did not exist anymore, True otherwise
+    """
+    pid = int(pid)
+    try:
+        pgid = os.getpgid(pid)
+    except OSError:
+        return False
+    if pgid != os.getpgid(0):
+        return _send_signal_to_targets([-pgid], sig, use_sudo, helper)
+    else:   # Never signal our own process group
+        return _send_signal_to_targets([pid] + get_child_pids(pid), sig, use_sudo, helper)
+
+def _send_signal_to_targets(targets, sig, use_sudo, helper = None):
+    """ Send a signal to processes (positive PIDs) or process groups (negative PGIDs), with one single 'sudo kill' (or helper request) for all those we are not allowed to signal
+
+    \return False if none of the targets existed, True otherwise
+    """
+    found = False
+    denied = []
+    for target in targets:
+        try:
+            if target < 0:
+                os.killpg(-target, sig)
+            else:
+                os.kill(target, sig)
+            found = True
+        except OSError as e:
+            if e.errno == errno.EPERM:
+                denied.append(target)
+    if denied:
+        if helper is not None:
+            helper.send_signals(denied, sig)
+            return True
+        if not use_sudo:
+            raise Exception('ProcessCouldNotBeSignalled:' + str(denied[0]))
+        args = ['sudo', 'kill', '-' + str(int(sig)), '--'] + [str(target) for target in denied]
+        subprocess.call(args, stdout=open(os.devnull, 'wb'), stderr=subprocess.STDOUT)
+        found = True
+    return found
+
+def terminate_process_tree(pid, timeout, use_sudo = False, helper = None):
+    """ Terminate a process and its descendants: send SIGTERM, and escalate to SIGKILL if the process has not exitted within \p timeout
+
+    \param pid The PID of the process
+    \param timeout The maximum time (in seconds) to wait for the process to exit after SIGTERM
+    \param use_sudo A boolean indicating whether the processes run as root (see signal_process_tree())
+    \param helper (optional) A VtundHelperClient object (see signal_process_tree())
+
+    \return True if the process has exitted, False if it is still alive even after SIGKILL
+    """
+    if not signal_process_tree(pid, signal.SIGTERM, use_sudo, helper):
+        return True
+    if wait_for_exit(pid, timeout):
+        return True
+    signal_process_tree(pid, signal.SIGKILL, use_sudo, helper)
+    return wait_for_exit(pid, 1)
+
+def get_process_identity(pid):
+    """ Get what identifies a process beyond its PID (PIDs are reused once processes have exitted)
+
+    \param pid The PID of the process
+
+    \return A tuple (start_time, cmdline) containing the start time of the process (in clock ticks since boot, as an int) and its command line (as a list of strings), or None if the process does not exist (or is a zombie)
+    """
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'r') as f:
+            stat = f.read()
+        with open('/proc/' + str(pid) + '/cmdline', 'rb') as f:
+            cmdline = f.read()
+    except IOError:
+        return None
+    fields = stat[stat.rfind(')') + 2:].split()  # Fields after the process name start with state (3rd field), start time is the 22nd field
+    if fields[0] in ['Z', 'X']:
+        return None
+    return (int(fields[19]), [arg.decode('utf-8', 'replace') for arg in cmdline.split(b'\0')[:-1]])
+
+class AdoptedProcess(object):
+    """ Class providing the subset of the subprocess.Popen interface used by tunnel objects, for a running process that is not our child (for example a vtund process started by a previous instance of our program)
+
+    As the process cannot be reaped by us, its exit value is unknown: UNKNOWN_EXIT_VALUE is reported once it has exitted
+    """
+
+    UNKNOWN_EXIT_VALUE = 255
+
+    def __init__(self, pid, start_time):
+        """ Constructor
+
+        \param pid The PID of the process
+        \param start_time The start time of the process (see get_process_identity()), so that a new process reusing \p pid is not mistaken for it
+        """
+        self.pid = int(pid)
+        self.stdout = None
+        self.returncode = None
+        self._start_time = start_time
+
+    def poll(self):
+        if self.returncode is None:
+            identity = get_process_identity(self.pid)
+            if identity is None or identity[0] != self._start_time:
+                self.returncode = AdoptedProcess.UNKNOWN_EXIT_VALUE
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            wait_for_exit(self.pid, 1)
+        return self.returncode
@@ -4,26 +4,43 @@
 
 from __future__ import print_function
 
-from vtun_tunnel import VtunTunnel
+from vtun_tunnel import VtunTunnel, get_child_of
+from proc_net import get_listening_tcp_sockets, get_process_socket_inodes
+from process_teardown import popen_new_session_kwargs, terminate_process_tree, send_signal, pidfd_open
+from vtund_config_renderer import render_server_options, render_server_section, write_config_file
+from tunnel_metrics import start_timer, count, NULL_TIMER
+from tunnel_profile import check_mtu, get_profile_name, resolve_profile_settings
 
 import subprocess
+import errno
 import os
+import select
 import signal
-import socket
 import time
 
-vtun_pid_file = '/usr/local/var/run/vtund.pid'
+VTUND_START_TIMEOUT = 30  # Default maximum time (in seconds) to wait for a vtund server to accept connections
+VTUND_STOP_TIMEOUT = 5  # Default maximum time (in seconds) to wait for vtund to exit after SIGTERM, before sending SIGKILL
+
+RELOAD_UNCHANGED = 'unchanged'  # The running vtund configuration was already up to date
+RELOAD_RELOADED = 'reloaded'    # The configuration has been rewritten, and vtund has been told to reread it (SIGHUP)
+RELOAD_RESTARTED = 'restarted'  # The options {} section changed (vtund only reads it at startup), vtund has been restarted
 
 class ServerVtunTunnel(VtunTunnel):
     """ Class representing a vtun tunnel service (listening) """
     
+    __slots__ = ['restricted_iface', 'vtun_protocol', 'vtun_compression', 'vtun_encryption', 'vtun_keepalive', 'vtund_start_timeout']
+    
     def __init__(self, **kwargs): # See VtunTunnel.__init__ for the inherited kwargs
         super(ServerVtunTunnel, self).__init__(**kwargs)
+        settings = resolve_profile_settings(kwargs.get('tuning_profile', None), kwargs)
+        if settings:
+            kwargs = dict(kwargs, **settings)   # Values set by the tuning profile take precedence over defaults
         self.restricted_iface = None
         self.vtun_protocol = kwargs.get('vtun_protocol', 'tcp')  # valid values are tcp or udp
         self.vtun_compression = kwargs.get('vtun_compression', 'lzo:9') # See vtun documentation for valid values
         self.vtun_encryption = kwargs.get('vtun_encryption', False) 
         self.vtun_keepalive = kwargs.get('vtun_keepalive', True)
+        self.vtund_start_timeout = kwargs.get('vtund_start_timeout', VTUND_START_TIMEOUT)    # Maximum time (in seconds) start() waits for vtund to accept connections
 
     def restrict_server_to_iface(self, iface):
         """ Restrict the server to run only on specified interface(s)
@@ -40,68 +57,30 @@ class ServerVtunTunnel(VtunTunnel):
             #~ return False
         #~ return True
 
+    def to_vtund_options_config(self):
+        """ Generate the global options {} section of the vtund config matching with this object attributes
+        \return A string containing the options section of the configuration to provide to the vtund exec
+        """
+        return render_server_options(self.vtun_server_tcp_port, self.restricted_iface)
+    
+    def to_vtund_tunnel_config(self):
+        """ Generate the tunnel section of the vtund config (named after vtun_tunnel_name) matching with this object attributes
+        \return A string containing the tunnel section of the configuration to provide to the vtund exec
+        """
+        return render_server_section(self)
+        
     def to_vtund_config(self):
         """ Generate a vtund config string matching with this object attributes
         \return A string containing a configuration to provide to the vtund exec
         """
-        indent_unit = '\t'
-        cr_lf = '\n';
-        config = ''
-        config += 'options {' + cr_lf
-        config += indent_unit + 'port ' + str(self.vtun_server_tcp_port) + ';' + cr_lf
-        if self.restricted_iface:
-            config += indent_unit + 'bindaddr { iface ' + self.restricted_iface + '; };' + cr_lf
-        config += indent_unit + 'syslog daemon;' + cr_lf
+        return self.to_vtund_options_config() + '\n' + self.to_vtund_tunnel_config()
         
-        config += indent_unit + 'ppp /usr/sbin/pppd;' + cr_lf
-        config += indent_unit + 'ifconfig /sbin/ifconfig;' + cr_lf
-        config += indent_unit + 'route /sbin/route;' + cr_lf
-        config += indent_unit + 'ip /sbin/ip;' + cr_lf
-        config += '}' + cr_lf
-        config += cr_lf
-        config += self.vtun_tunnel_name + ' {' + cr_lf
-        if not self.interface_name is None:
-            config += indent_unit + 'device ' + str(self.interface_name) + ';' + cr_lf
-        config += indent_unit + 'passwd ' + str(self.vtun_shared_secret) + ';' + cr_lf
-        config += indent_unit + 'type ' + self.tunnel_mode.get_equivalent_vtun_type() + ';' + cr_lf
-        config += indent_unit + 'proto ' + self.vtun_protocol + ';' + cr_lf
-        config += indent_unit + 'compress ' + self.vtun_compression + ';' + cr_lf
-        config += indent_unit + 'encrypt '
-        if self.vtun_encryption:
-            config += 'yes'
-        else:
-            config += 'no'
-        config += ';' + cr_lf
-        config += indent_unit + 'keepalive '
-        if self.vtun_keepalive:
-            config += 'yes'
-        else:
-            config += 'no'
-        config += ';' + cr_lf
+    def _prepare_start(self, phase_timer = NULL_TIMER):
+        """ Check that the vtun server process can be started, and save its configuration file
         
-        config += ' ' + cr_lf
-        config += indent_unit + 'up {' + cr_lf
-        config += indent_unit*2 + 'ifconfig "%% ' + str(self.tunnel_near_end_ip) + ' pointopoint ' + str(self.tunnel_far_end_ip) + ' mtu 1450";' + cr_lf
-        if not self.up_additional_commands is None:
-            for command in self.up_additional_commands:
-                if command[0] == '/':
-                    config += indent_unit*2 + 'program ' + str(command) + ';' + cr_lf
-                else:
-                    raise Exception('NotAFullPathCommand')
-        config += indent_unit + '};' + cr_lf
-        config += indent_unit + 'down {' + cr_lf
-        if not self.down_additional_commands is None:
-            for command in self.down_additional_commands:
-                if command[0] == '/':
-                    config += indent_unit*2 + 'program ' + str(command) + ';' + cr_lf
-                else:
-                    raise Exception('NotAFullPathCommand')
-        config += indent_unit + '};' + cr_lf
-        config += '}' + cr_lf
-        return config
+        \param phase_timer (optional) The tunnel_metrics.PhaseTimer object timing the start
         
-    def start(self):
-        """ Start a vtun server process to handle the service represented by this object
+        \return The path of the configuration file
         """
         if not (self._vtun_pid is None and self._vtun_process is None):    # There is already a slave vtun process running
             raise Exception('VtundAlreadyRunning')
@@ -111,86 +90,302 @@ class ServerVtunTunnel(VtunTunnel):
         
         #Step 1: save configuration file
         vtund_config = self.to_vtund_config()
+        phase_timer.phase('render')
         vtund_config_filename = '/tmp/vtund-' + self.vtun_tunnel_name + '-server.conf'
+        vtund_config_filename = self._deliver_vtund_config(vtund_config_filename, vtund_config)
+        phase_timer.phase('deliver')
+        return vtund_config_filename
+    
+    def start(self, timeout = None):
+        """ Start a vtun server process to handle the service represented by this object
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to accept connections (defaults to the vtund_start_timeout attribute). A 'VtundStartTimeout' exception is raised if it is reached, and a 'VtundExitedPrematurely' exception if vtund exits before being ready
+        """
+        phase_timer = start_timer('server', 'start')
         try:
-            f = open(vtund_config_filename, 'w')
-            f.write(vtund_config)
-            f.close()
-        except:
-            raise Exception('ConfigurationFileWritingIssue')
+            vtund_config_filename = self._prepare_start(phase_timer)
+        except Exception as e:
+            phase_timer.done(e)
+            raise e
         #Step 2: Runs vtun and saves the pid and process
-        vtund_cmd = []
-        if self.vtund_use_sudo:
-                vtund_cmd = ['sudo']
-        vtund_cmd += [self.vtund_exec, '-f', vtund_config_filename, '-s']
-        proc = subprocess.Popen(vtund_cmd, shell=False)
-        proc.wait()	# Wait until child has gone to background (should be immediate)
-        
-        pid = None
-        if os.path.isfile(vtun_pid_file):
-            os.remove(vtun_pid_file)
-            while not os.path.isfile(vtun_pid_file):
-                time.sleep(0.2)
-                continue
-        pid_file = open(vtun_pid_file, "r")
-        pid = pid_file.read(10)
-        pid_file.close()
-        self._vtun_pid = pid
-        #TODO: Add a watch to detect when the tunnel goes down
-        
-        type =  None
-        if self.vtun_protocol =='tcp':
-            type = socket.SOCK_STREAM
-        elif self.vtun_protocol =='udp':
-            type = socket.SOCK_DGRAM
-        else:
-            raise Exception('UnsupportedProtocol')
-        
-        success = False
-        while not success:
-            try:
-                s = socket.socket(socket.AF_INET, type)
-                s.connect(('localhost', int(self.vtun_server_tcp_port))) #Connect is blocking therefore it while wait until connect is successful
-                s.close()
-                success = True                
-            except socket.error, exc:
-                time.sleep(0.2)
-                continue 
+        try:
+            (self._vtun_pid, self._vtun_process) = start_vtund_server(self.vtund_exec, self.vtund_use_sudo, vtund_config_filename, self.vtun_server_tcp_port, self.vtun_protocol, timeout if timeout is not None else self.vtund_start_timeout, self.vtund_helper, phase_timer)
+        except Exception as e:
+            self._release_vtund_config()
+            phase_timer.done(e)
+            raise e
+        phase_timer.done()
+        # Exits of vtund are not watched here, use tunnel_supervisor.TunnelSupervisor to detect them (and restart the tunnel)
             
-    def stop(self):
+    def stop(self, timeout = None):
         """ Stop the vtun server process handled by this object
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM, before killing it (defaults to VTUND_STOP_TIMEOUT)
         """
         #print('Stopping vtun server with tunnel name ' + str(self.vtun_tunnel_name) + '\n')
         if self._vtun_pid is None:    # There is not a slave vtun process running
             raise Exception('VtundNotRunning')
         else:
-            children = self.get_child_of(int(self._vtun_pid))
-            success = True
-            if len(children) > 0:
-                for child in children:
-                    try:
-                        os.kill(int(child), signal.SIGTERM)
-                        #print(child + ' Killed')
-                    except OSError:
-                        try:
-                            os.kill(int(child), signal.SIGKILL)
-                            #print(child + ' Killed')
-                        except OSError:
-                            #print(child + 'is not  Killed')
-                            success = False
-            
-            try:
-                os.kill(int(self._vtun_pid), signal.SIGTERM)
-                #print(self._vtun_pid + ' Killed')
-            except OSError:
+            phase_timer = start_timer('server', 'stop')
+            if self._vtun_process is None or self._vtun_process.poll() is None:
                 try:
-                    os.kill(int(self._vtun_pid), signal.SIGKILL)
-                    #print(self._vtun_pid + ' Killed')
-                except OSError:
-                    #print(self._vtun_pid + ' is not Killed')
-                    success = False
-            if success:
-                self._vtun_pid = None
-                self._vtun_process = None
+                    stop_vtund_server(self._vtun_pid, self.vtund_use_sudo, timeout, self.vtund_helper)
+                except Exception as e:
+                    phase_timer.done(e)
+                    raise e
+            # else: vtund has already exitted (and has been reaped), its PID may have been reused by another process, so it must not be signalled
+            phase_timer.phase('terminate')
+            if not self._vtun_process is None:
+                self._vtun_process.wait()   # Reap our vtund (or sudo) process
+            phase_timer.phase('reap')
+            self._vtun_pid = None
+            self._vtun_process = None
+            self._release_vtund_config()
+            phase_timer.phase('release')
+            phase_timer.done()
+    
+    def _update_vtund_config(self):
+        """ Compare the configuration matching with this object attributes with the one the running vtund uses, and rewrite it if only the tunnel section changed
+        
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED (vtund still has to be sent SIGHUP) or RELOAD_RESTARTED (vtund still has to be restarted)
+        """
+        if self._vtun_pid is None:
+            raise Exception('VtundNotRunning')
+        if not self.is_valid():
+            raise Exception('InvalidTunnelConfiguration')
+        vtund_options_config = self.to_vtund_options_config()
+        vtund_config = vtund_options_config + '\n' + self.to_vtund_tunnel_config()
+        running_config = self._vtund_config_file.config if self._vtund_config_file is not None else None
+        action = get_vtund_reload_action(running_config, vtund_options_config, vtund_config)
+        if action == RELOAD_RELOADED:
+            self._vtund_config_file.update(vtund_config)
+        return action
+    
+    def _set_attributes(self, attributes):
+        """ Change attributes of this object, all or none (see apply())
+        """
+        if attributes.get('tuning_profile', None) is not None:   # Also change the attributes set by the profile
+            settings = resolve_profile_settings(attributes['tuning_profile'], attributes)
+            attributes = dict(attributes)
+            attributes['tuning_profile'] = get_profile_name(attributes['tuning_profile'])
+            attributes.update(settings)
+        elif self.tuning_profile is not None:
+            try:
+                resolve_profile_settings(self.tuning_profile, attributes)
+            except Exception:
+                attributes = dict(attributes)
+                attributes['tuning_profile'] = None # Attributes do not follow the profile anymore
+        if 'mtu' in attributes:
+            attributes['mtu'] = check_mtu(attributes['mtu'])
+        for name in attributes:
+            if name.startswith('_') or not hasattr(type(self), name) or callable(getattr(type(self), name)):
+                raise Exception('UnknownTunnelAttribute:' + str(name))
+        previous_values = {}
+        try:
+            for (name, value) in attributes.items():
+                previous_values[name] = getattr(self, name)
+                setattr(self, name, value)
+            if not self.is_valid():
+                raise Exception('InvalidTunnelConfiguration')
+        except Exception:
+            for (name, value) in previous_values.items():
+                setattr(self, name, value)
+            raise
+    
+    def reload(self, timeout = None):
+        """ Bring the running vtun server process in line with the current attributes of this object, without restarting it when possible
+        
+        If only the tunnel section of the configuration changed, the configuration is rewritten and vtund is sent SIGHUP to reread it. Sessions already connected keep their settings until they reconnect.
+        If the options {} section changed (vtun_server_tcp_port or restricted_iface), vtund is restarted
+        
+        \param timeout (optional) The timeout given to stop() and start() if vtund has to be restarted
+        
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED. If vtund is not running (or has exitted, stop() must then be called to release its resources), a 'VtundNotRunning' exception is raised
+        """
+        if self._vtun_pid is None or (self._vtun_process is not None and self._vtun_process.poll() is not None):   # Once vtund has exitted (and has been reaped), its PID may have been reused by another process, so it must not be signalled
+            raise Exception('VtundNotRunning')
+        action = self._update_vtund_config()
+        if action == RELOAD_RESTARTED:
+            self.stop(timeout)
+            self.start(timeout)
+        elif action == RELOAD_RELOADED:
+            send_signal(self._vtun_pid, signal.SIGHUP, self.vtund_use_sudo, self.vtund_helper)
+        count('tunnel_reloads_total', kind='server', action=action)
+        return action
+    
+    def apply(self, **kwargs):
+        """ Change attributes of this object, and if the vtun server process is running, bring it in line with them (see reload())
+        
+        \param timeout (optional) The timeout given to stop() and start() if vtund has to be restarted
+        \param kwargs The attributes to change, for example up_additional_commands, down_additional_commands, vtun_compression or tuning_profile (which changes all the attributes set by the profile). If the resulting configuration is invalid, no attribute is changed and an 'InvalidTunnelConfiguration' exception is raised
+        
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED (RELOAD_UNCHANGED if vtund is not running)
+        """
+        timeout = kwargs.pop('timeout', None)
+        self._set_attributes(kwargs)
+        if self._vtun_pid is None:
+            return RELOAD_UNCHANGED
+        return self.reload(timeout)
+
+def get_vtund_reload_action(running_config, vtund_options_config, vtund_config):
+    """ Find out what a running vtund server needs to apply a new configuration
+    
+    \param running_config A string containing the configuration vtund is running with (or None if unknown)
+    \param vtund_options_config A string containing the options {} section of the new configuration
+    \param vtund_config A string containing the new configuration (starting with \p vtund_options_config followed by an empty line)
+    
+    \return RELOAD_UNCHANGED if the configurations are identical, RELOAD_RELOADED if only the tunnel sections changed, RELOAD_RESTARTED otherwise
+    """
+    if running_config == vtund_config:
+        return RELOAD_UNCHANGED
+    if running_config is None or not running_config.startswith(vtund_options_config + '\n'):
+        return RELOAD_RESTARTED
+    return RELOAD_RELOADED
+
+def write_vtund_config_file(vtund_config_filename, vtund_config):
+    """ Save a vtund configuration to a file (the file is left untouched if its content is already \p vtund_config, see vtund_config_renderer.write_config_file())
+    
+    \param vtund_config_filename The path of the file to write
+    \param vtund_config A string containing the vtund configuration
+    """
+    try:
+        write_config_file(vtund_config_filename, vtund_config)
+    except Exception:
+        raise Exception('ConfigurationFileWritingIssue')
+
+def get_vtund_server_command(vtund_exec, vtund_use_sudo, vtund_config_filename):
+    """ Get the command line to run a vtund server in the foreground
+    
+    \param vtund_exec The exec name for the vtund utility
+    \param vtund_use_sudo A boolean indicating whether vtund_exec needs to be run via sudo
+    \param vtund_config_filename The path of the configuration file to provide to vtund
+    
+    \return The command line (as a list)
+    """
+    vtund_cmd = []
+    if vtund_use_sudo:
+            vtund_cmd = ['sudo']
+    vtund_cmd += [vtund_exec, '-n', '-f', vtund_config_filename, '-s']
+    return vtund_cmd
+
+def start_vtund_server(vtund_exec, vtund_use_sudo, vtund_config_filename, vtun_server_tcp_port, vtun_protocol = 'tcp', timeout = None, vtund_helper = None, phase_timer = None):
+    """ Run a vtund server process and wait until it accepts connections
+    
+    vtund is run in the foreground (-n), so that we track our own server process via its subprocess handle rather than via the system-wide vtund pid file (several servers can thus be started concurrently)
+    Readiness is detected by checking the kernel socket table until this very process listens on \p vtun_server_tcp_port (without connecting to it). There is no kernel notification for a socket starting to listen, so this is checked with a backoff, but the exit of vtund interrupts the wait right away (through a pidfd)
+    When the sockets of vtund cannot be inspected (vtund run as root), only a socket that started listening on the port after vtund was launched is accepted: a stale or foreign server already listening on this port is never mistaken for ours
+    
+    \param vtund_exec The exec name for the vtund utility
+    \param vtund_use_sudo A boolean indicating whether vtund_exec needs to be run via sudo
+    \param vtund_config_filename The path of the configuration file to provide to vtund
+    \param vtun_server_tcp_port The TCP port on which the vtund server listens
+    \param vtun_protocol The tunnel protocol (tcp or udp). Note that in both cases, vtund accepts sessions on a TCP socket
+    \param timeout (optional) The maximum time (in seconds) to wait for the server to be ready (defaults to VTUND_START_TIMEOUT). If reached, a 'VtundStartTimeout' exception is raised
+    \param vtund_helper (optional) A VtundHelperClient object that will spawn vtund as root (\p vtund_use_sudo is then ignored)
+    \param phase_timer (optional) A tunnel_metrics.PhaseTimer object, that will record the 'spawn', 'sudo' and 'ready' phases
+    
+    \return A tuple (pid, process) containing the PID of the vtund server process (as an int) and the python process object we launched (which is sudo's when \p vtund_use_sudo is True, and a VtundHelperProcess when \p vtund_helper is provided)
+    """
+    if not vtun_protocol in ['tcp', 'udp']:
+        raise Exception('UnsupportedProtocol')
+    if timeout is None:
+        timeout = VTUND_START_TIMEOUT
+    if phase_timer is None:
+        phase_timer = NULL_TIMER
+    deadline = time.time() + timeout
+    inodes_before = get_listening_tcp_sockets().get(int(vtun_server_tcp_port), set())   # Sockets already listening on the port cannot be our vtund's
+    
+    if vtund_helper is not None:
+        vtund_use_sudo = False
+        proc = vtund_helper.popen(get_vtund_server_command(vtund_exec, False, vtund_config_filename))   # The helper also runs vtund in its own session
+    else:
+        vtund_cmd = get_vtund_server_command(vtund_exec, vtund_use_sudo, vtund_config_filename)
+        proc = subprocess.Popen(vtund_cmd, shell=False, close_fds=True, stdin=open(os.devnull, 'r'), **popen_new_session_kwargs())   # vtund gets its own process group, that also contains its sessions
+    
+    phase_timer.phase('spawn')
+    
+    vtund = {'pid': None}    # When using sudo, the vtund process is a child of proc, that we will find out once it has been forked
+    if not vtund_use_sudo:
+        vtund['pid'] = proc.pid
+    
+    def server_ready():
+        if proc.poll() is not None:
+            raise Exception('VtundExitedPrematurely')
+        if vtund['pid'] is None:
+            children = get_child_of(proc.pid)
+            if not children:
+                return False
+            vtund['pid'] = int(children[0])
+            phase_timer.phase('sudo')
+        return _is_server_listening(vtund['pid'], vtun_server_tcp_port, inodes_before)
+    
+    try:
+        _wait_until(server_ready, deadline, proc.pid)
+    except Exception as e:
+        try:
+            stop_vtund_server(vtund['pid'] or proc.pid, vtund_use_sudo, vtund_helper = vtund_helper)
+            proc.wait()
+        except Exception:
+            pass
+        raise e
+    phase_timer.phase('ready')
+    return (vtund['pid'], proc)
+
+def _is_server_listening(vtun_pid, vtun_server_tcp_port, inodes_before):
+    """ Check if a vtund server process is listening
+    
+    \param vtun_pid The PID of the vtund server process
+    \param vtun_server_tcp_port The TCP port on which the vtund server should listen
+    \param inodes_before The set of the inodes of the sockets that were listening on \p vtun_server_tcp_port before vtund was launched
+    
+    \return True if the server listens on \p vtun_server_tcp_port. If we are not allowed to inspect the sockets of \p vtun_pid (vtund run as root), only a listening socket that is not part of \p inodes_before is accepted
+    """
+    listening_inodes = get_listening_tcp_sockets().get(int(vtun_server_tcp_port), None)
+    if not listening_inodes:
+        return False
+    process_inodes = get_process_socket_inodes(vtun_pid)
+    if process_inodes is None:
+        return len(listening_inodes - inodes_before) > 0
+    return len(listening_inodes & process_inodes) > 0
+
+def _wait_until(condition, deadline, pid = None):
+    """ Wait until \p condition returns True, with a check interval backing off from 1ms to 50ms
+    
+    \param condition A function returning True when the wait is over
+    \param deadline The time (as returned by time.time()) after which a 'VtundStartTimeout' exception is raised
+    \param pid (optional) The PID of a process whose exit interrupts the wait between two checks right away (when pidfds are supported), so that \p condition can notice it
+    """
+    pidfd = pidfd_open(pid) if pid is not None else None
+    try:
+        interval = 0.001
+        while not condition():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception('VtundStartTimeout')
+            if pidfd is None:
+                time.sleep(min(interval, remaining))
             else:
-                raise Exception('OneOfProcessesCouldNotBeKilled')
\ No newline at end of file
+                try:
+                    select.select([pidfd], [], [], min(interval, remaining))
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            interval = min(interval * 2, 0.05)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+def stop_vtund_server(vtun_pid, vtund_use_sudo = False, timeout = None, vtund_helper = None):
+    """ Stop a vtund server process and all its children (sessions)
+    
+    The whole process group of the server is sent SIGTERM at once, and SIGKILL if it has not exitted within \p timeout
+    
+    \param vtun_pid The PID of the vtund server process
+    \param vtund_use_sudo A boolean indicating whether vtund runs as root (sudo will then be used to signal it)
+    \param timeout (optional) The maximum time (in seconds) to wait for the server to exit after SIGTERM (defaults to VTUND_STOP_TIMEOUT)
+    \param vtund_helper (optional) The VtundHelperClient object that spawned vtund (it will then be used instead of sudo to signal it)
+    """
+    if timeout is None:
+        timeout = VTUND_STOP_TIMEOUT
+    if not terminate_process_tree(vtun_pid, timeout, vtund_use_sudo, vtund_helper):
+        raise Exception('OneOfProcessesCouldNotBeKilled')
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from vtun_tunnel import VtunTunnel, get_child_of
+from server_vtun_tunnel import ServerVtunTunnel, start_vtund_server, stop_vtund_server, get_vtund_reload_action, RELOAD_UNCHANGED, RELOAD_RELOADED, RELOAD_RESTARTED
+
+from process_teardown import send_signal
+from vtund_config_renderer import render_server_options
+from vtund_config_delivery import deliver_vtund_config, CONFIG_DELIVERIES
+from tunnel_metrics import start_timer, count
+
+import signal
+
+def _get_config_sections(vtund_config):
+    """ Split a vtund configuration into its top-level sections
+
+    \param vtund_config A string containing a vtund configuration (as generated by ServerVtunTunnelPool.to_vtund_config())
+
+    \return A dict containing the text of each section (from its name to its closing brace and newline), indexed by section name (the options section is indexed by 'options')
+    """
+    sections = {}
+    name = None
+    for line in vtund_config.splitlines(True):
+        if name is None:
+            if line.endswith(' {\n') and not line[0].isspace():   # Sections start with '<name> {' at the beginning of a line...
+                name = line[:-3]
+                lines = [line]
+        else:
+            lines.append(line)
+            if line == '}\n':    # ... and end with a closing brace at the beginning of a line (nested blocks are indented)
+                sections[name] = ''.join(lines)
+                name = None
+    return sections
+
+class ServerVtunTunnelPool(object):
+    """ Class representing a set of vtun tunnel services (ServerVtunTunnel objects) handled by one single vtund server process
+
+    All tunnels of the pool share the same listening TCP port and the same options {} section.
+    Adding or removing a tunnel to/from a running pool only makes vtund reread its configuration (via SIGHUP), so sessions already connected are not restarted
+    """
+
+    def __init__(self, **kwargs):
+        """ Constructor for ServerVtunTunnelPool class.
+
+        \param vtund_exec (optional) The exec name for the vtund utility (it is recommended to provide an absolute PATH here)
+        \param vtund_use_sudo (optional) A boolean indicating whether the vtund_exec needs to be run via sudo to get root access (False by default)
+        \param vtund_helper (optional) A vtund_helper.VtundHelperClient object used to spawn and signal vtund as root instead of running sudo for each operation
+        \param vtund_config_delivery (optional) How the configuration is handed over to vtund: 'file' (default), 'memfd' or 'private_dir' (see vtund_config_delivery.py)
+        \param vtun_server_tcp_port A string or an int describing the TCP port on which the shared vtund server process will listen
+        \param pool_name (optional) A string used to name the configuration file of this pool (defaults to 'pool-<vtun_server_tcp_port>')
+        \param tunnels (optional) A list of ServerVtunTunnel objects to add to the pool
+        """
+        self._vtun_pid = None    # The PID of the vtund server process handling all tunnels of this pool
+        self._vtun_process = None    # The python process object handling this pool
+
+        arg_vtund_exec = kwargs.get('vtund_exec', None)
+        if arg_vtund_exec is None:
+            self.vtund_exec = VtunTunnel.VTUND_EXEC
+        else:
+            self.vtund_exec = arg_vtund_exec
+
+        self.vtund_use_sudo = kwargs.get('vtund_use_sudo', False)  # Do we use sudo to run subprocess vtund?
+        self.vtund_helper = kwargs.get('vtund_helper', None)  # Do we use a privileged helper to run subprocess vtund?
+        self.vtund_config_delivery = kwargs.get('vtund_config_delivery', None)
+        if not (self.vtund_config_delivery is None or self.vtund_config_delivery in CONFIG_DELIVERIES):
+            raise Exception('InvalidConfigDelivery:' + str(self.vtund_config_delivery))
+        self._vtund_config_file = None  # The VtundConfigFile object containing the configuration of the running vtund
+
+        arg_vtun_server_tcp_port = kwargs.get('vtun_server_tcp_port', None)
+        if arg_vtun_server_tcp_port is None:
+            raise Exception('TcpPortMustBeProvided')
+        try:
+            tcp_port = int(arg_vtun_server_tcp_port)
+        except ValueError:
+            raise Exception('InvalidTcpPort:' + str(arg_vtun_server_tcp_port))
+        if tcp_port > 0 and tcp_port <= 65535:
+            self.vtun_server_tcp_port = tcp_port
+        else:
+            raise Exception('InvalidTcpPort:' + str(tcp_port))
+
+        self.pool_name = kwargs.get('pool_name', 'pool-' + str(self.vtun_server_tcp_port))
+        self.restricted_iface = None
+        self._tunnels = {}  # ServerVtunTunnel objects of this pool, indexed by their vtun_tunnel_name
+        self._tunnel_names = [] # Tunnel names, in the order in which tunnels have been added (to get a stable configuration file)
+
+        for tunnel in kwargs.get('tunnels', []):
+            self.add_tunnel(tunnel)
+
+    def restrict_server_to_iface(self, iface):
+        """ Restrict the shared server to run only on specified interface(s)
+
+        \param iface The network interface (as a string) on on the server should listen
+        """
+        self.restricted_iface = iface
+
+    def get_tunnel(self, name):
+        """ Get a tunnel of this pool
+
+        \param name The vtun_tunnel_name of the tunnel
+
+        \return The ServerVtunTunnel object (or None if there is no such tunnel in the pool)
+        """
+        return self._tunnels.get(name, None)
+
+    def get_tunnels(self):
+        """ Get all tunnels of this pool
+
+        \return A list of ServerVtunTunnel objects
+        """
+        return [self._tunnels[name] for name in self._tunnel_names]
+
+    def is_running(self):
+        """ Check if the shared vtund server process has been started
+
+        \return True if the pool is running
+        """
+        return self._vtun_pid is not None
+
+    def get_config_filename(self):
+        """ Get the path of the vtund configuration file used for this pool
+
+        \return A string containing the path of the configuration file
+        """
+        return '/tmp/vtund-' + str(self.pool_name) + '-server-pool.conf'
+
+    def _check_tunnel(self, tunnel):
+        """ Check that a tunnel can be part of this pool (an exception is raised otherwise)
+        """
+        if not isinstance(tunnel, ServerVtunTunnel):
+            raise Exception('WrongTunnelObject')
+        if not tunnel.is_valid():
+            raise Exception('InvalidTunnelConfiguration')
+        if tunnel.vtun_server_tcp_port is not None and int(tunnel.vtun_server_tcp_port) != self.vtun_server_tcp_port:
+            raise Exception('TunnelTcpPortMismatch:' + str(tunnel.vtun_server_tcp_port))
+
+    def add_tunnel(self, tunnel):
+        """ Add a tunnel to the pool
+
+        If the pool is running, the shared vtund server process will be told to reread its configuration, without affecting other sessions
+
+        \param tunnel A ServerVtunTunnel object. Its vtun_server_tcp_port must either be None (it will then be set to the pool's port) or match the pool's port. If vtund cannot be reloaded, the tunnel is not added and the exception is raised
+        """
+        self._check_tunnel(tunnel)
+        if tunnel.vtun_tunnel_name in self._tunnels:
+            raise Exception('TunnelNameAlreadyInPool:' + str(tunnel.vtun_tunnel_name))
+        if tunnel.vtun_server_tcp_port is None:
+            tunnel.vtun_server_tcp_port = self.vtun_server_tcp_port
+
+        tunnels = dict(self._tunnels)
+        tunnels[tunnel.vtun_tunnel_name] = tunnel
+        self._change_tunnels(tunnels, self._tunnel_names + [tunnel.vtun_tunnel_name])
+
+    def remove_tunnel(self, name):
+        """ Remove a tunnel from the pool
+
+        If the pool is running, the shared vtund server process will be told to reread its configuration, and the session of this tunnel (if any) will be terminated. Other sessions are not affected
+
+        \param name The vtun_tunnel_name of the tunnel to remove. If vtund cannot be reloaded, the tunnel is kept and the exception is raised
+
+        \return The ServerVtunTunnel object that has been removed
+        """
+        if not name in self._tunnels:
+            raise Exception('TunnelNotInPool:' + str(name))
+        tunnel = self._tunnels[name]
+        tunnels = dict(self._tunnels)
+        del tunnels[name]
+        self._change_tunnels(tunnels, [other_name for other_name in self._tunnel_names if other_name != name])
+        if self.is_running():
+            for session_pid in self.get_session_pids(name):
+                send_signal(session_pid, signal.SIGTERM, self.vtund_use_sudo, self.vtund_helper)
+        return tunnel
+
+    def _change_tunnels(self, tunnels, tunnel_names, timeout = None):
+        """ Replace the set of tunnels of this pool, and if the pool is running, bring vtund in line with it (see reload())
+
+        If reloading fails, the previous set of tunnels is restored (reload() has already restored the previous configuration file) and the exception is raised
+
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED (RELOAD_UNCHANGED if the pool is not running)
+        """
+        (previous_tunnels, previous_tunnel_names) = (self._tunnels, self._tunnel_names)
+        self._tunnels = tunnels
+        self._tunnel_names = tunnel_names
+        if not self.is_running():
+            return RELOAD_UNCHANGED
+        try:
+            return self.reload(timeout)
+        except Exception:
+            self._tunnels = previous_tunnels
+            self._tunnel_names = previous_tunnel_names
+            raise
+
+    def to_vtund_options_config(self):
+        """ Generate the global options {} section shared by all tunnels of this pool
+        \return A string containing the options section of the configuration to provide to the vtund exec
+        """
+        return render_server_options(self.vtun_server_tcp_port, self.restricted_iface)
+
+    def to_vtund_config(self):
+        """ Generate a vtund config string containing one options {} section and the sections of all tunnels of this pool
+        \return A string containing a configuration to provide to the vtund exec
+        """
+        sections = [self.to_vtund_options_config()]
+        for name in self._tunnel_names:
+            sections.append(self._tunnels[name].to_vtund_tunnel_config())
+        return '\n'.join(sections)
+
+    def start(self, timeout = None):
+        """ Start the shared vtun server process handling all tunnels of this pool
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to accept connections (see start_vtund_server())
+        """
+        if self.is_running():
+            raise Exception('VtundAlreadyRunning')
+
+        phase_timer = start_timer('pool', 'start')
+        try:
+            vtund_config = self.to_vtund_config()
+            phase_timer.phase('render')
+            self._vtund_config_file = deliver_vtund_config(self.vtund_config_delivery, self.get_config_filename(), vtund_config)
+            phase_timer.phase('deliver')
+        except Exception as e:
+            phase_timer.done(e)
+            raise e
+        try:
+            (self._vtun_pid, self._vtun_process) = start_vtund_server(self.vtund_exec, self.vtund_use_sudo, self._vtund_config_file.path, self.vtun_server_tcp_port, timeout = timeout, vtund_helper = self.vtund_helper, phase_timer = phase_timer)
+        except Exception as e:
+            self._vtund_config_file.close()
+            self._vtund_config_file = None
+            phase_timer.done(e)
+            raise e
+        phase_timer.done()
+
+    def reload(self, timeout = None):
+        """ Rewrite the configuration of this pool and make the running vtund server process reread it (sessions already connected are not restarted)
+
+        Nothing is done if the configuration did not change. If the options {} section changed (restricted_iface), vtund is restarted, as it only reads this section at startup
+        If vtund cannot be sent SIGHUP, the previous configuration is written back (so that it matches what vtund runs with) and the exception is raised
+
+        \param timeout (optional) The timeout given to stop() and start() if vtund has to be restarted
+
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED (see server_vtun_tunnel.py). If vtund is not running (or has exitted, stop() must then be called to release its resources), a 'VtundNotRunning' exception is raised
+        """
+        if not self.is_running() or self._vtun_process.poll() is not None:  # Once vtund has exitted (and has been reaped), its PID may have been reused by another process, so it must not be signalled
+            raise Exception('VtundNotRunning')
+
+        vtund_options_config = self.to_vtund_options_config()
+        vtund_config = self.to_vtund_config()
+        action = get_vtund_reload_action(self._vtund_config_file.config, vtund_options_config, vtund_config)
+        if action == RELOAD_RESTARTED:
+            self.stop(timeout)
+            self.start(timeout)
+        elif action == RELOAD_RELOADED:
+            running_config = self._vtund_config_file.config
+            self._vtund_config_file.update(vtund_config)
+            try:
+                send_signal(self._vtun_pid, signal.SIGHUP, self.vtund_use_sudo, self.vtund_helper)
+            except Exception:
+                self._vtund_config_file.update(running_config)
+                raise
+        count('tunnel_reloads_total', kind='pool', action=action)
+        return action
+
+    def apply(self, tunnels, restart_sessions = False, timeout = None):
+        """ Replace the set of tunnels of this pool, and if the pool is running, bring vtund in line with it in one single reload (see reload())
+
+        Sessions of the tunnels that are not part of \p tunnels anymore are terminated. Sessions of the tunnels that are kept are left connected
+
+        \param tunnels A list of ServerVtunTunnel objects (see add_tunnel()). Tunnels are matched with the current ones by vtun_tunnel_name. If one of them cannot be part of the pool, or if vtund cannot be reloaded, the pool is left unchanged
+        \param restart_sessions (optional) If True, the sessions of the tunnels whose configuration changed are also terminated, so that clients reconnect with the new configuration
+        \param timeout (optional) The timeout given to stop() and start() if vtund has to be restarted
+
+        \return RELOAD_UNCHANGED, RELOAD_RELOADED or RELOAD_RESTARTED (RELOAD_UNCHANGED if the pool is not running)
+        """
+        names = []
+        for tunnel in tunnels:
+            self._check_tunnel(tunnel)
+            if tunnel.vtun_tunnel_name in names:
+                raise Exception('TunnelNameAlreadyInPool:' + str(tunnel.vtun_tunnel_name))
+            names.append(tunnel.vtun_tunnel_name)
+
+        stale_names = [name for name in self._tunnel_names if not name in names]
+        if restart_sessions and self.is_running():
+            running_sections = _get_config_sections(self._vtund_config_file.config)
+            for tunnel in tunnels:
+                if tunnel.vtun_tunnel_name in self._tunnels and running_sections.get(tunnel.vtun_tunnel_name, None) != tunnel.to_vtund_tunnel_config():
+                    stale_names.append(tunnel.vtun_tunnel_name)
+
+        for tunnel in tunnels:
+            if tunnel.vtun_server_tcp_port is None:
+                tunnel.vtun_server_tcp_port = self.vtun_server_tcp_port
+        action = self._change_tunnels(dict(zip(names, tunnels)), names, timeout)
+        if action == RELOAD_RELOADED:
+            for name in stale_names:
+                for session_pid in self.get_session_pids(name):
+                    send_signal(session_pid, signal.SIGTERM, self.vtund_use_sudo, self.vtund_helper)
+        return action
+
+    def stop(self, timeout = None):
+        """ Stop the shared vtun server process and all sessions of this pool
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit after SIGTERM, before killing it (see stop_vtund_server())
+        """
+        if not self.is_running():
+            raise Exception('VtundNotRunning')
+
+        phase_timer = start_timer('pool', 'stop')
+        if self._vtun_process.poll() is None:
+            try:
+                stop_vtund_server(self._vtun_pid, self.vtund_use_sudo, timeout, self.vtund_helper)
+            except Exception as e:
+                phase_timer.done(e)
+                raise e
+        # else: vtund has already exitted (and has been reaped), its PID may have been reused by another process, so it must not be signalled
+        phase_timer.phase('terminate')
+        self._vtun_process.wait()   # Reap our vtund (or sudo) process
+        phase_timer.phase('reap')
+        self._vtun_pid = None
+        self._vtun_process = None
+        self._vtund_config_file.close()
+        self._vtund_config_file = None
+        phase_timer.phase('release')
+        phase_timer.done()
+
+    def get_session_pids(self, name):
+        """ Get the PIDs of the vtund session processes currently serving a tunnel of this pool
+
+        vtund names its session processes 'vtund[s]: <tunnel name> ...', this is what we match here
+
+        \param name The vtun_tunnel_name of the tunnel
+
+        \return A list of strings containing the PIDs of the session processes
+        """
+        if not self.is_running():
+            return []
+        session_pids = []
+        for child in get_child_of(int(self._vtun_pid)):
+            try:
+                with open('/proc/' + str(child) + '/cmdline', 'r') as f:
+                    title = f.read().replace('\0', ' ').split()
+            except IOError:
+                continue    # Child has exitted in the meantime
+            if len(title) >= 2 and title[0].startswith('vtund') and title[1] == name:
+                session_pids.append(child)
+        return session_pids
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from proc_net import get_listening_tcp_ports
+
+import collections
+import threading
+import weakref
+
+class TcpPortAllocator(object):
+    """ Class handing out vtun_server_tcp_port values for server tunnels from a range of TCP ports
+
+    Ports are handed out from a queue (released ports go to its end, so that they are reused as late as possible). Ports on which some other socket of the system listens are taken out of the queue when they are met, and only queued again once they are found free, so that allocation does not scan them again and again (it is O(1) amortized, apart from reading the listening socket table).
+    Availability is checked against the kernel listening socket table, read once per allocation (or per batch of allocations), instead of probing each port
+    """
+
+    def __init__(self, port_min, port_max):
+        """ Constructor
+
+        \param port_min The first TCP port of the range
+        \param port_max The last TCP port of the range (included)
+        """
+        port_min = int(port_min)
+        port_max = int(port_max)
+        if port_min <= 0 or port_max > 65535 or port_min > port_max:
+            raise Exception('InvalidTcpPortRange:' + str(port_min) + '-' + str(port_max))
+        self.port_min = port_min
+        self.port_max = port_max
+        self._free = collections.deque(range(port_min, port_max + 1))   # May contain ports reserved since they were queued, that are skipped
+        self._queued = set(self._free)  # Ports of _free, so that a port reserved while queued is not queued twice when it is released
+        self._busy = set()  # Ports of the range taken out of _free because some other socket listened on them
+        self._allocated = {}    # Allocated ports as keys, and a weak reference to the tunnel holding the port (or None) as values
+        self._lock = threading.RLock()  # Reentrant, as weak reference callbacks may be run by the garbage collector while we hold it
+
+    def allocate(self, tunnel = None):
+        """ Allocate a TCP port on which nothing listens yet
+
+        \param tunnel (optional) The ServerVtunTunnel (or ServerVtunTunnelPool) object that will use the port. Its vtun_server_tcp_port attribute is set, and the port is released automatically once the object is garbage collected
+
+        \return The allocated TCP port (as an int). If all ports of the range are in use, a 'TcpPortPoolExhausted' exception is raised
+        """
+        return self.allocate_many([tunnel])[0]
+
+    def allocate_many(self, tunnels):
+        """ Allocate one TCP port for each of \p tunnels, checking the listening sockets of the system only once
+
+        \param tunnels A list of tunnel objects (see allocate()), or a list of None to get ports not bound to any tunnel
+
+        \return A list of int containing the allocated TCP ports, in the same order as \p tunnels
+        """
+        listening_ports = get_listening_tcp_ports()
+        ports = []
+        with self._lock:
+            self._requeue_busy(listening_ports)
+            try:
+                for tunnel in tunnels:
+                    ports.append(self._allocate_one(tunnel, listening_ports))
+            except Exception:
+                for port in ports:  # Allocate all or nothing
+                    self._release(port)
+                raise
+        for (tunnel, port) in zip(tunnels, ports):
+            if tunnel is not None:
+                tunnel.vtun_server_tcp_port = port
+        return ports
+
+    def _requeue_busy(self, listening_ports):
+        """ Queue again the busy ports on which nothing listens anymore (lock must be held)
+        """
+        for port in [port for port in self._busy if not port in listening_ports]:
+            self._busy.discard(port)
+            if not port in self._allocated and not port in self._queued:
+                self._free.append(port)
+                self._queued.add(port)
+
+    def _allocate_one(self, tunnel, listening_ports):
+        while self._free:
+            port = self._free.popleft()
+            self._queued.discard(port)
+            if port in self._allocated:
+                continue    # Reserved after having been queued
+            if port in listening_ports: # Used by a process we do not know about, queued again once it is found free
+                self._busy.add(port)
+                continue
+            self._hold(port, tunnel)
+            return port
+        raise Exception('TcpPortPoolExhausted')
+
+    def _hold(self, port, tunnel):
+        if tunnel is None:
+            self._allocated[port] = None
+        else:
+            self._allocated[port] = weakref.ref(tunnel, lambda ref: self._release_if_held_by(port, ref))
+
+    def reserve(self, port, tunnel = None):
+        """ Mark a TCP port as used (for example by a server tunnel configured before the allocator was created)
+
+        \param port The TCP port. If it is already allocated, a 'TcpPortAlreadyAllocated' exception is raised
+        \param tunnel (optional) The tunnel object holding the port (see allocate())
+        """
+        port = int(port)
+        with self._lock:
+            if port in self._allocated:
+                raise Exception('TcpPortAlreadyAllocated:' + str(port))
+            self._hold(port, tunnel)
+
+    def release(self, port):
+        """ Give a TCP port back to the pool
+
+        \param port A TCP port previously returned by allocate() or reserved. If it is not allocated, a 'TcpPortNotAllocated' exception is raised
+        """
+        port = int(port)
+        with self._lock:
+            if not port in self._allocated:
+                raise Exception('TcpPortNotAllocated:' + str(port))
+            self._release(port)
+
+    def _release(self, port):
+        del self._allocated[port]
+        if self.port_min <= port <= self.port_max and not port in self._queued:
+            self._free.append(port)
+            self._queued.add(port)
+
+    def _release_if_held_by(self, port, ref):
+        """ Release \p port if it is still held by the garbage collected tunnel referenced by \p ref (weak reference callback) """
+        with self._lock:
+            if self._allocated.get(port, None) is ref:
+                self._release(port)
+
+    def get_holder(self, port):
+        """ Get the tunnel holding a TCP port
+
+        \param port The TCP port
+
+        \return The tunnel object given at allocation, or None if the port is not allocated or was not allocated for a tunnel
+        """
+        ref = self._allocated.get(int(port), None)
+        if ref is None:
+            return None
+        return ref()
+
+    def is_allocated(self, port):
+        """ Check if a TCP port is in use
+
+        \param port The TCP port
+
+        \return True if \p port is allocated or reserved
+        """
+        return int(port) in self._allocated
+
+    def get_free_count(self):
+        """ Get the number of ports of the range that are not allocated (some may still be in use by other processes of the system)
+
+        \return An int
+        """
+        with self._lock:
+            return (self.port_max - self.port_min + 1) - len([port for port in self._allocated if self.port_min <= port <= self.port_max])
+
+    def get_conflicts(self):
+        """ Check allocated ports against the listening sockets of the system
+
+        \return A list of int containing the ports held by tunnels that are not running while some other process listens on them (starting these tunnels would fail)
+        """
+        listening_ports = get_listening_tcp_ports()
+        conflicts = []
+        with self._lock:
+            for (port, ref) in self._allocated.items():
+                tunnel = ref() if ref is not None else None
+                if tunnel is not None and tunnel._vtun_pid is None and port in listening_ports:
+                    conflicts.append(port)
+        return sorted(conflicts)
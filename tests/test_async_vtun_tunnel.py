@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of async_vtun_tunnel (Python 3 only, run against benchmarks/fake_vtund, so that no root access is needed)
+
+Coroutines are run with run_until_complete(), so that this module can still be loaded (and skipped) by Python 2
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from tcp_port_allocator import TcpPortAllocator
+from proc_net import get_listening_tcp_sockets, get_process_socket_inodes
+from run_benchmarks import prepare_fake_vtund
+
+import shutil
+import signal
+import tempfile
+import unittest
+
+try:
+    import asyncio
+    import async_vtun_tunnel
+    from async_vtun_tunnel import AsyncClientVtunTunnel, AsyncServerVtunTunnel
+except (ImportError, SyntaxError):
+    async_vtun_tunnel = None
+
+_port_allocator = TcpPortAllocator(45000, 45999)
+
+@unittest.skipIf(async_vtun_tunnel is None, 'asyncio tunnels require Python 3.5 or later')
+class AsyncVtunTunnelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop_errors = []
+        self.loop.set_exception_handler(lambda loop, context: self.loop_errors.append(context['message']))
+        self.addCleanup(self._close_loop)
+        self.signals = []
+        original = async_vtun_tunnel._signal_process_tree
+        def recording_signal_process_tree(vtund_use_sudo, pid, sig, vtund_helper = None):
+            self.signals.append(sig)
+            return original(vtund_use_sudo, pid, sig, vtund_helper)
+        async_vtun_tunnel._signal_process_tree = recording_signal_process_tree
+        self.addCleanup(setattr, async_vtun_tunnel, '_signal_process_tree', original)
+
+    def _close_loop(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))  # Let the subprocess transports be closed
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.assertEqual(self.loop_errors, [])
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def _stop_later(self, tunnel):
+        self.addCleanup(lambda: tunnel._vtun_pid is not None and self._run(tunnel.stop()))
+
+    def _make_server(self, name):
+        server = AsyncServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+        self._stop_later(server)
+        return server
+
+    def _make_client(self, name, port):
+        client = AsyncClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_hostname = '127.0.0.1', vtun_server_tcp_port = port, vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+        self._stop_later(client)
+        return client
+
+    def test_client_connects_to_server(self):
+        server = self._make_server('async1')
+        self._run(server.start())
+        self.assertTrue(get_listening_tcp_sockets()[server.vtun_server_tcp_port] & get_process_socket_inodes(server._vtun_pid))
+        client = self._make_client('async1', server.vtun_server_tcp_port)
+        self._run(client.start())
+        self.assertTrue(self._run(client.wait_until_connected(5)))
+        self.assertEqual(client.get_state(), AsyncClientVtunTunnel.STATE_CONNECTED)
+        self.assertTrue('Session async1[127.0.0.1] opened' in client.get_output())
+        self._run(client.stop())
+        self.assertEqual((client.get_state(), client._vtun_pid), (AsyncClientVtunTunnel.STATE_EXITED, None))
+        self._run(server.stop())
+        self.assertFalse(server.vtun_server_tcp_port in get_listening_tcp_sockets())
+        self.assertEqual(self.signals, [signal.SIGTERM, signal.SIGTERM])
+
+    def test_client_exit_is_reported(self):
+        client = self._make_client('async2', _port_allocator.allocate())    # Nothing listens on this port
+        self._run(client.start())
+        self.assertRaises(Exception, self._run, client.wait_until_connected(5))
+        try:
+            self._run(client.wait_exit())
+        except Exception as e:
+            self.assertEqual(str(e), 'SubprocessDiedUnexpectedly')
+        else:
+            self.fail('No exception raised')
+        self.assertEqual(client.vtund_exit_value, 1)
+        self.assertTrue(client._vtun_pid is not None)   # Kept until stop()
+        self._run(client.stop())
+        self.assertEqual(self.signals, [])  # vtund has already exitted and been reaped, its PID must not be signalled
+
+    def test_server_reload_after_vtund_exitted(self):
+        server = self._make_server('async3')
+        self._run(server.start())
+        os.kill(server._vtun_pid, signal.SIGKILL)
+        self._run(asyncio.sleep(0.2))
+        self.assertRaises(Exception, self._run, server.reload())
+        self._run(server.stop())
+        self.assertEqual(self.signals, [])
+        self.assertEqual(server._vtun_pid, None)
+
+if __name__ == '__main__':
+    unittest.main()
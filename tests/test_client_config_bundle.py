@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of client_config_bundle (archives are read back with the tarfile module)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client_config_bundle import write_tar_bundle, write_json_lines, iter_client_configs, TAR_MEMBER_MODE
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+
+import gzip
+import io
+import json
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+def _make_server(name, index):
+    return ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.%d.0/30' % index, tunnel_near_end_ip = '10.0.%d.1' % index, tunnel_far_end_ip = '10.0.%d.2' % index, vtun_tunnel_name = name, vtun_shared_secret = 'secret%d' % index, vtun_server_tcp_port = 5000 + index, tuning_profile = 'low_latency')
+
+def _iter_servers(count):
+    """ Generator of servers, so that the bundles cannot rely on getting a list """
+    for index in range(count):
+        yield _make_server('tunnel%d' % index, index)
+
+class ClientConfigBundleTest(unittest.TestCase):
+
+    def _expected_config(self, server, hostname):
+        return ClientVtunTunnel(from_server = server, vtun_server_hostname = hostname).to_vtund_config()
+
+    def _read_tar(self, data, mode = 'r:'):
+        archive = tarfile.open(fileobj = io.BytesIO(data), mode = mode)
+        try:
+            return dict([(member.name, (member.mode, member.isfile(), archive.extractfile(member).read().decode('utf-8'))) for member in archive.getmembers()])
+        finally:
+            archive.close()
+
+    def test_tar_layout(self):
+        f = io.BytesIO()
+        (count, errors) = write_tar_bundle(f, _iter_servers(3), lambda server: 'vpn.example.com')
+        self.assertEqual((count, errors), (3, []))
+        data = f.getvalue()
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        members = self._read_tar(data)
+        self.assertEqual(sorted(members.keys()), ['tunnel0/server', 'tunnel0/vtund.conf', 'tunnel1/server', 'tunnel1/vtund.conf', 'tunnel2/server', 'tunnel2/vtund.conf'])
+        for index in range(3):
+            self.assertEqual(members['tunnel%d/vtund.conf' % index], (TAR_MEMBER_MODE, True, self._expected_config(_make_server('tunnel%d' % index, index), 'vpn.example.com')))
+            self.assertEqual(members['tunnel%d/server' % index], (TAR_MEMBER_MODE, True, 'vpn.example.com\n'))
+        self.assertTrue('passwd secret1;' in members['tunnel1/vtund.conf'][2])
+        self.assertTrue('proto udp;' in members['tunnel1/vtund.conf'][2])    # The tuning profile of the server is inherited
+
+    def test_gzip_tar(self):
+        f = io.BytesIO()
+        gzip_file = gzip.GzipFile(fileobj = f, mode = 'wb')
+        write_tar_bundle(gzip_file, _iter_servers(2), {'tunnel0': 'server0', 'tunnel1': 'server1'})
+        gzip_file.close()
+        members = self._read_tar(f.getvalue(), 'r:gz')
+        self.assertEqual([members['tunnel%d/server' % index][2] for index in range(2)], ['server0\n', 'server1\n'])
+
+    def test_empty_tar(self):
+        f = io.BytesIO()
+        self.assertEqual(write_tar_bundle(f, [], {}), (0, []))
+        self.assertEqual(self._read_tar(f.getvalue()), {})
+
+    def test_errors(self):
+        servers = [_make_server('tunnel0', 0), _make_server('a/b', 1), _make_server('unknown', 2), _make_server('..', 3)]
+        f = io.BytesIO()
+        (count, errors) = write_tar_bundle(f, servers, {'tunnel0': 'server0', 'a/b': 'server1', '..': 'server3'})
+        self.assertEqual(count, 1)
+        self.assertEqual([(error.server.vtun_tunnel_name, str(error.error)) for error in errors], [('a/b', 'InvalidTunnelName:a/b'), ('unknown', 'NoServerHostname:unknown'), ('..', 'InvalidTunnelName:..')])
+        self.assertEqual(sorted(self._read_tar(f.getvalue()).keys()), ['tunnel0/server', 'tunnel0/vtund.conf'])
+        results = list(iter_client_configs(servers, {'a/b': 'server1'}))
+        self.assertEqual([(client is None, config is None, error is None) for (server, client, config, error) in results], [(True, True, False), (False, False, True), (True, True, False), (True, True, False)])   # Only the tar bundle needs the name to be a valid directory name
+
+    def test_json_lines(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'bundle.jsonl')
+        with open(path, 'w') as f:
+            (count, errors) = write_json_lines(f, _iter_servers(2), lambda server: 'vpn' + server.vtun_tunnel_name[-1], vtun_connection_timeout = 10)
+        self.assertEqual((count, errors), (2, []))
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        for (index, line) in enumerate(lines):
+            record = json.loads(line)
+            self.assertEqual(sorted(record.keys()), ['config', 'vtun_server_hostname', 'vtun_server_tcp_port', 'vtun_tunnel_name'])
+            self.assertEqual((record['vtun_tunnel_name'], record['vtun_server_hostname'], record['vtun_server_tcp_port']), ('tunnel%d' % index, 'vpn%d' % index, 5000 + index))
+            self.assertEqual(record['config'], self._expected_config(_make_server('tunnel%d' % index, index), 'vpn%d' % index).replace('timeout 300;', 'timeout 10;'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of client_endpoint_race.ClientEndpointRace (run against benchmarks/fake_vtund, so that no root access is needed)
+
+Besides fake_vtund servers, endpoints can be a socket that accepts TCP connections but never answers (a server that hangs), or a port on which nothing listens (connection refused)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from client_endpoint_race import ClientEndpointRace
+from client_vtun_tunnel import ClientVtunTunnel
+from server_vtun_tunnel import ServerVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from process_teardown import wait_for_exit
+from run_benchmarks import prepare_fake_vtund
+
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+_port_allocator = TcpPortAllocator(49000, 49999)
+
+class ClientEndpointRaceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+        cls.servers = {}
+        for name in ['race', 'other']:  # The 'other' server denies the 'race' tunnel
+            cls.servers[name] = ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_exec = cls.vtund_exec, vtund_config_delivery = 'private_dir')
+            cls.servers[name].start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers.values():
+            server.stop()
+        shutil.rmtree(cls.directory)
+
+    def _make_template(self):
+        return ClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = 'race', vtun_shared_secret = 'secret', vtun_server_hostname = 'ignored', vtun_server_tcp_port = self.servers['race'].vtun_server_tcp_port, vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+
+    def _endpoint(self, server_name):
+        return ('127.0.0.1', self.servers[server_name].vtun_server_tcp_port)
+
+    def _hanging_endpoint(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', _port_allocator.allocate()))
+        sock.listen(5)  # Connections are never accepted
+        return sock.getsockname()
+
+    def _refused_endpoint(self):
+        return ('127.0.0.1', _port_allocator.allocate())
+
+    def _race(self, endpoints, **kwargs):
+        race = ClientEndpointRace(self._make_template(), endpoints, **kwargs)
+        self.addCleanup(lambda: race.get_tunnel() is not None and race.stop())
+        return race
+
+    def _assert_stopped(self, attempt):
+        self.assertTrue(attempt.stopped)
+        self.assertEqual(attempt.tunnel._vtun_pid, None)
+        self.assertEqual(attempt.tunnel._vtund_config_file, None)   # The private directory has been removed
+
+    def _assert_race_error(self, race, error):
+        try:
+            race.connect(5)
+        except Exception as e:
+            self.assertEqual(str(e), error)
+        else:
+            self.fail('No exception raised')
+        for attempt in race.get_attempts():
+            self._assert_stopped(attempt)
+        self.assertEqual(race.get_tunnel(), None)
+
+    def test_first_endpoint_wins(self):
+        race = self._race([self._endpoint('race'), self._hanging_endpoint()], attempt_delay = 5)
+        tunnel = race.connect(5)
+        self.assertEqual((tunnel.vtun_server_hostname, tunnel.vtun_server_tcp_port), self._endpoint('race'))
+        attempts = race.get_attempts()
+        self.assertTrue(attempts[0].is_connected())
+        self.assertEqual(attempts[1].started_at, None)  # The session opened before the attempt delay
+        self.assertRaises(Exception, race.connect)
+        race.stop()
+        self._assert_stopped(attempts[0])
+        self.assertRaises(Exception, race.stop)
+
+    def test_hanging_endpoint_loses(self):
+        race = self._race([self._hanging_endpoint(), self._endpoint('race')], attempt_delay = 0.1)
+        pids = []
+        make_attempt = race._make_attempt
+        def recording_make_attempt(endpoint):
+            attempt = make_attempt(endpoint)
+            attempt.tunnel.add_state_listener(lambda tunnel, old_state, new_state: new_state == ClientVtunTunnel.STATE_CONNECTING and pids.append(tunnel._vtun_pid))
+            return attempt
+        race._make_attempt = recording_make_attempt
+        start = time.time()
+        tunnel = race.connect(5)
+        self.assertTrue(time.time() - start < 2)
+        (loser, winner) = race.get_attempts()
+        self.assertTrue(winner.tunnel is tunnel and winner.is_connected())
+        self.assertTrue(winner.duration is not None)
+        self.assertEqual(loser.error, None)
+        self._assert_stopped(loser)     # Still connecting when the other session opened
+        self.assertEqual(len(pids), 2)
+        self.assertTrue(wait_for_exit(pids[0], 1))
+
+    def test_failed_endpoints_are_skipped(self):
+        race = self._race([self._refused_endpoint(), self._endpoint('other'), self._endpoint('race')], attempt_delay = 5)
+        start = time.time()
+        tunnel = race.connect(5)
+        self.assertTrue(time.time() - start < 4)    # The attempt delay is not waited for after a failure
+        self.assertTrue(tunnel is race.get_attempts()[2].tunnel)
+        self.assertEqual([str(attempt.error) for attempt in race.get_attempts()[:2]], ['TunnelConnectionFailed', 'TunnelAuthenticationFailed'])
+        for attempt in race.get_attempts()[:2]:
+            self._assert_stopped(attempt)
+
+    def test_all_denied(self):
+        self._assert_race_error(self._race([self._endpoint('other'), self._endpoint('other')], attempt_delay = 0.1), 'TunnelAuthenticationFailed')
+
+    def test_all_failed(self):
+        self._assert_race_error(self._race([self._endpoint('other'), self._refused_endpoint()], attempt_delay = 0.1), 'TunnelConnectionFailed')
+
+    def test_timeout(self):
+        race = self._race([self._hanging_endpoint(), self._hanging_endpoint()], attempt_delay = 0.05)
+        start = time.time()
+        self.assertEqual(race.connect(0.3), None)
+        self.assertTrue(time.time() - start >= 0.3)
+        for attempt in race.get_attempts():
+            self.assertEqual(attempt.error, None)
+            self._assert_stopped(attempt)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(Exception, ClientEndpointRace, self._make_template(), [])
+        self.assertRaises(Exception, ClientEndpointRace, self._make_template(), ['127.0.0.1'], attempt_delay = -1)
+        self.assertRaises(Exception, ClientEndpointRace, self.servers['race'], ['127.0.0.1'])
+        race = ClientEndpointRace(self._make_template(), ['server1', ('server2', '5001'), ('server3', None)])
+        self.assertEqual(race.endpoints, [('server1', None), ('server2', 5001), ('server3', None)])
+
+if __name__ == '__main__':
+    unittest.main()
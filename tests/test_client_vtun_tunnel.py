@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the connection state of client tunnels (run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from client_vtun_tunnel import ClientVtunTunnel
+from server_vtun_tunnel import ServerVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from run_benchmarks import prepare_fake_vtund
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+_port_allocator = TcpPortAllocator(46000, 46999)
+
+def _make_client(name, port, **kwargs):
+    return ClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_hostname = '127.0.0.1', vtun_server_tcp_port = port, **kwargs)
+
+class ClientStateTest(unittest.TestCase):
+    """ Connection states set from the vtund console messages """
+
+    def setUp(self):
+        self.client = _make_client('state', 5000)
+        self.transitions = []
+        self.client.add_state_listener(lambda tunnel, old_state, new_state: self.transitions.append(new_state))
+
+    def _feed(self, *lines):
+        for line in lines:
+            self.client._on_vtund_output_line(line)
+
+    def test_session_opened_and_closed(self):
+        self.assertEqual(self.client.get_state(), ClientVtunTunnel.STATE_STOPPED)
+        self._feed('vtund[42]: Connecting to 192.168.0.1', 'vtund[42]: Use SSL-aware challenge/response', 'vtund[42]: Session state[192.168.0.1] opened')
+        self.assertTrue(self.client.wait_until_connected(0))
+        self._feed('vtund[42]: Session state[192.168.0.1] closed')
+        self.assertEqual(self.transitions, [ClientVtunTunnel.STATE_CONNECTING, ClientVtunTunnel.STATE_CONNECTED, ClientVtunTunnel.STATE_DISCONNECTED])
+        self.assertRaises(Exception, self.client.wait_until_connected, 0)
+
+    def test_denied(self):
+        for denied in ['vtund[42]: Connection denied by 192.168.0.1', 'vtund[42]: Denied by server']:
+            self._feed('vtund[42]: Connecting to 192.168.0.1', denied, 'vtund[42]: Connection closed by other side')
+            self.assertEqual(self.client.get_state(), ClientVtunTunnel.STATE_AUTH_FAILED)   # The reason of the failure is kept
+            try:
+                self.client.wait_until_connected(0)
+            except Exception as e:
+                self.assertEqual(str(e), 'TunnelAuthenticationFailed')
+            else:
+                self.fail('No exception raised')
+
+    def test_connection_failures(self):
+        for failure in ['vtund[42]: Connect to 192.168.0.1 failed', 'vtund[42]: Connection timed out']:
+            self._feed('vtund[42]: Connecting to 192.168.0.1')
+            self.assertEqual(self.client.wait_until_connected(0), False)
+            self._feed(failure)
+            self.assertEqual(self.client.get_state(), ClientVtunTunnel.STATE_DISCONNECTED)
+        self.assertEqual(len(self.transitions), 4)
+
+    def test_output_listeners(self):
+        lines = []
+        self.client.add_output_listener(lines.append)
+        self._feed('vtund[42]: Connecting to 192.168.0.1', 'other message')
+        self.client.remove_output_listener(lines.append)
+        self._feed('vtund[42]: Session state[192.168.0.1] opened')
+        self.assertEqual(lines, ['vtund[42]: Connecting to 192.168.0.1', 'other message'])
+
+class RunningClientStateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+        cls.server = ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 'running', vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_exec = cls.vtund_exec, vtund_config_delivery = 'private_dir')
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.directory)
+
+    def _start_client(self, name, state_listener = None):
+        client = _make_client(name, self.server.vtun_server_tcp_port, vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+        if state_listener is not None:
+            client.add_state_listener(state_listener)
+        client.start()
+        self.addCleanup(lambda: client._vtun_pid is not None and client.stop())
+        return client
+
+    def test_connected(self):
+        client = self._start_client('running')
+        lines = []
+        for line in client.iter_output_lines(timeout = 5):
+            lines.append(line)
+            if 'opened' in line:
+                break
+        self.assertTrue(client.wait_until_connected(5))
+        self.assertTrue(lines[0].endswith('Connecting to 127.0.0.1'))
+        client.stop()
+        self.assertEqual(client.get_state(), ClientVtunTunnel.STATE_EXITED)
+        self.assertRaises(Exception, client.stop)
+
+    def test_denied(self):
+        transitions = []
+        client = self._start_client('unknown', lambda tunnel, old_state, new_state: transitions.append(new_state))  # No section for this tunnel in the server configuration
+        self.assertRaises(Exception, client.wait_until_connected, 5)
+        self.assertEqual(transitions[:2], [ClientVtunTunnel.STATE_CONNECTING, ClientVtunTunnel.STATE_AUTH_FAILED])
+
+    def test_unexpected_exit(self):
+        exitted = threading.Event()
+        client = self._start_client('unknown', lambda tunnel, old_state, new_state: new_state == ClientVtunTunnel.STATE_EXITED and exitted.set())
+        self.assertTrue(exitted.wait(5))
+        self.assertEqual(client.vtund_exit_value, 1)
+        self.assertTrue(client._vtun_pid is not None)   # Kept until stop(), which only releases resources
+        client.stop()
+        self.assertEqual(client._vtun_pid, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of output_ring_buffer.OutputRingBuffer
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_ring_buffer import OutputRingBuffer
+
+import threading
+import time
+import unittest
+
+class OutputRingBufferTest(unittest.TestCase):
+
+    def test_output_is_bounded(self):
+        buf = OutputRingBuffer(10)
+        buf.append('0123')
+        buf.append('4567')
+        self.assertEqual(buf.get_output(), '01234567')
+        buf.append('89ab')
+        self.assertEqual(buf.get_output(), '23456789ab')   # Oldest chunk trimmed
+        buf.append('cdefghijklmn')
+        self.assertEqual(buf.get_output(), 'efghijklmn')   # Chunk larger than the buffer
+        self.assertEqual(buf.get_output(), 'efghijklmn')
+        buf.append('')
+        self.assertEqual(buf.get_output(), 'efghijklmn')
+        self.assertRaises(Exception, OutputRingBuffer, 0)
+
+    def test_lines_split_across_chunks(self):
+        lines = []
+        buf = OutputRingBuffer(line_callback = lines.append)
+        buf.append('Connecting to ser')
+        self.assertEqual(lines, [])
+        buf.append('ver\nSession opened\nSess')
+        self.assertEqual(lines, ['Connecting to server', 'Session opened'])
+        buf.close()
+        self.assertEqual(lines, ['Connecting to server', 'Session opened', 'Sess'])  # The trailing incomplete line is complete once closed
+        buf.close()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(buf.is_closed())
+        self.assertEqual(list(buf.iter_lines()), lines)
+
+    def test_iter_lines_waits_for_new_lines(self):
+        buf = OutputRingBuffer()
+        buf.append('old\n')
+        def writer():
+            time.sleep(0.05)
+            buf.append('new1\nnew2\n')
+            time.sleep(0.05)
+            buf.close()
+        thread = threading.Thread(target = writer)
+        thread.start()
+        self.assertEqual(list(buf.iter_lines(from_start = False)), ['new1', 'new2'])
+        thread.join()
+        self.assertEqual(list(buf.iter_lines()), ['old', 'new1', 'new2'])
+
+    def test_iter_lines_timeout(self):
+        buf = OutputRingBuffer()
+        buf.append('line\n')
+        start = time.time()
+        self.assertEqual(list(buf.iter_lines(timeout = 0.1)), ['line'])
+        self.assertTrue(time.time() - start >= 0.1)
+
+    def test_slow_reader_resumes_at_oldest_line(self):
+        buf = OutputRingBuffer(12)
+        buf.append('a1\na2\n')
+        lines = buf.iter_lines(timeout = 0)
+        self.assertEqual(next(lines), 'a1')
+        buf.append('b1\nb2\nb3\nb4\n')  # a2 is discarded before being read
+        self.assertEqual(list(lines), ['b1', 'b2', 'b3', 'b4'])
+
+if __name__ == '__main__':
+    unittest.main()
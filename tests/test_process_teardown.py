@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of process_teardown (run on sh and sleep processes)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_teardown import popen_new_session_kwargs, get_child_pids, send_signal, signal_process_tree, terminate_process_tree, wait_for_exit, _is_process_gone
+
+import signal
+import subprocess
+import time
+import unittest
+
+class ProcessTeardownTest(unittest.TestCase):
+
+    def _spawn(self, script, new_session = True):
+        """ Run \p script with sh, which prints the PIDs of its children (one per line) once they are started
+        """
+        kwargs = popen_new_session_kwargs() if new_session else {}
+        proc = subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE, **kwargs)
+        self.addCleanup(self._kill, proc)
+        return proc
+
+    def _kill(self, proc):
+        if proc.poll() is None:
+            if os.getpgid(proc.pid) != os.getpgid(0):
+                os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+            else:
+                proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+    def _read_pids(self, proc, count):
+        return [int(proc.stdout.readline()) for i in range(count)]
+
+    def test_get_child_pids(self):
+        proc = self._spawn('sleep 10 & echo $!; sleep 10 & echo $!; wait')
+        children = self._read_pids(proc, 2)
+        self.assertEqual(sorted(get_child_pids(proc.pid)), sorted(children))
+        self.assertEqual(get_child_pids(children[0]), [])
+
+    def test_process_group_is_terminated(self):
+        proc = self._spawn('sleep 10 & echo $!; (sleep 10 & echo $!; wait) & wait')   # A child and a grandchild
+        descendants = self._read_pids(proc, 2)
+        start = time.time()
+        self.assertTrue(terminate_process_tree(proc.pid, 5))
+        self.assertTrue(time.time() - start < 4)
+        proc.wait()
+        for pid in descendants:
+            self.assertTrue(wait_for_exit(pid, 1))
+
+    def test_sigkill_escalation(self):
+        proc = self._spawn('trap "" TERM; echo ready; while true; do sleep 0.01; done')
+        proc.stdout.readline()
+        start = time.time()
+        self.assertTrue(terminate_process_tree(proc.pid, 0.2))
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(proc.wait(), -signal.SIGKILL)
+
+    def test_own_process_group_is_not_signalled(self):
+        proc = self._spawn('sleep 10 & echo $!; wait', new_session = False)
+        child = self._read_pids(proc, 1)[0]
+        self.assertTrue(signal_process_tree(proc.pid, signal.SIGTERM))  # Signals proc and its children only (not us)
+        self.assertEqual(proc.wait(), -signal.SIGTERM)
+        self.assertTrue(wait_for_exit(child, 1))
+
+    def test_gone_processes(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        self.assertFalse(send_signal(proc.pid, 0))
+        self.assertFalse(signal_process_tree(proc.pid, signal.SIGTERM))
+        self.assertTrue(terminate_process_tree(proc.pid, 1))
+        self.assertTrue(_is_process_gone(proc.pid))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the reconfiguration of running server tunnels (run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from server_vtun_tunnel import ServerVtunTunnel, get_vtund_reload_action, RELOAD_UNCHANGED, RELOAD_RELOADED, RELOAD_RESTARTED
+from tcp_port_allocator import TcpPortAllocator
+from run_benchmarks import prepare_fake_vtund
+import server_vtun_tunnel
+
+import shutil
+import signal
+import tempfile
+import unittest
+
+_port_allocator = TcpPortAllocator(41000, 41999)
+
+def _make_server(name, **kwargs):
+    tunnel_kwargs = {'mode': 'L3', 'tunnel_ip_network': '10.0.0.0/30', 'tunnel_near_end_ip': '10.0.0.1', 'tunnel_far_end_ip': '10.0.0.2', 'vtun_tunnel_name': name, 'vtun_shared_secret': 'secret', 'vtund_config_delivery': 'private_dir'}
+    tunnel_kwargs.update(kwargs)
+    return ServerVtunTunnel(**tunnel_kwargs)
+
+class ReloadActionTest(unittest.TestCase):
+
+    OPTIONS = 'options {\n\tport 5000;\n}\n'
+
+    def test_unchanged(self):
+        config = ReloadActionTest.OPTIONS + '\nt1 {\n}\n'
+        self.assertEqual(get_vtund_reload_action(config, ReloadActionTest.OPTIONS, config), RELOAD_UNCHANGED)
+
+    def test_tunnel_section_changed(self):
+        self.assertEqual(get_vtund_reload_action(ReloadActionTest.OPTIONS + '\nt1 {\n}\n', ReloadActionTest.OPTIONS, ReloadActionTest.OPTIONS + '\nt2 {\n}\n'), RELOAD_RELOADED)
+
+    def test_options_changed(self):
+        options = 'options {\n\tport 5001;\n}\n'
+        self.assertEqual(get_vtund_reload_action(ReloadActionTest.OPTIONS + '\nt1 {\n}\n', options, options + '\nt1 {\n}\n'), RELOAD_RESTARTED)
+
+    def test_unknown_running_config(self):
+        self.assertEqual(get_vtund_reload_action(None, ReloadActionTest.OPTIONS, ReloadActionTest.OPTIONS + '\n'), RELOAD_RESTARTED)
+
+class RunningReloadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def _start_server(self, name, **kwargs):
+        server = _make_server(name, vtund_exec = self.vtund_exec, vtun_server_tcp_port = _port_allocator.allocate(), **kwargs)
+        server.start()
+        self.addCleanup(lambda: server._vtun_pid is not None and server.stop())
+        return server
+
+    def test_server_apply(self):
+        server = self._start_server('reload1')
+        pid = server._vtun_pid
+        self.assertEqual(server.apply(up_additional_commands = []), RELOAD_UNCHANGED)
+        self.assertEqual(server.apply(up_additional_commands = ['/bin/true']), RELOAD_RELOADED)
+        self.assertEqual(server._vtun_pid, pid)
+        self.assertEqual(server._vtund_config_file.config.split('\n', 1)[1], server.to_vtund_config().split('\n', 1)[1])
+        server.restrict_server_to_iface('lo')
+        self.assertEqual(server.reload(), RELOAD_RESTARTED)
+        self.assertNotEqual(server._vtun_pid, pid)
+
+    def test_reload_when_not_running(self):
+        server = _make_server('reload2', vtund_exec = self.vtund_exec, vtun_server_tcp_port = _port_allocator.allocate())
+        self.assertRaises(Exception, server.reload)
+        self.assertEqual(server.apply(up_additional_commands = ['/bin/true']), RELOAD_UNCHANGED)
+
+    def test_reload_after_vtund_exitted(self):
+        server = self._start_server('reload3')
+        os.kill(server._vtun_pid, signal.SIGKILL)
+        server._vtun_process.wait()
+        signalled = []
+        original_send_signal = server_vtun_tunnel.send_signal
+        server_vtun_tunnel.send_signal = lambda *args: signalled.append(args)
+        try:
+            try:
+                server.apply(up_additional_commands = ['/bin/true'])
+            except Exception as e:
+                self.assertEqual(str(e), 'VtundNotRunning')
+            else:
+                self.fail('No exception raised')
+        finally:
+            server_vtun_tunnel.send_signal = original_send_signal
+        self.assertEqual(signalled, []) # Its PID may have been reused
+        server.stop()
+        self.assertEqual(server._vtund_config_file, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the start and stop of vtund servers (run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from server_vtun_tunnel import ServerVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from proc_net import get_listening_tcp_sockets, get_established_tcp_socket_inodes, get_process_socket_inodes
+from process_teardown import pidfd_open
+from run_benchmarks import prepare_fake_vtund
+import server_vtun_tunnel
+
+import select
+import shutil
+import socket
+import stat
+import tempfile
+import time
+import unittest
+
+_port_allocator = TcpPortAllocator(44000, 44999)
+
+def _listen(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1)
+    return sock
+
+class ServerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def _make_server(self, name, **kwargs):
+        tunnel_kwargs = {'mode': 'L3', 'tunnel_ip_network': '10.0.0.0/30', 'tunnel_near_end_ip': '10.0.0.1', 'tunnel_far_end_ip': '10.0.0.2', 'vtun_tunnel_name': name, 'vtun_shared_secret': 'secret', 'vtun_server_tcp_port': _port_allocator.allocate(), 'vtund_exec': self.vtund_exec, 'vtund_config_delivery': 'private_dir'}
+        tunnel_kwargs.update(kwargs)
+        server = ServerVtunTunnel(**tunnel_kwargs)
+        self.addCleanup(lambda: server._vtun_pid is not None and server.stop())
+        return server
+
+    def _make_script(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + content + '\n')
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+class ProcNetTest(unittest.TestCase):
+
+    def test_sockets_are_found(self):
+        port = _port_allocator.allocate()
+        listener = _listen(port)
+        self.addCleanup(listener.close)
+        inodes = get_listening_tcp_sockets().get(port, set())
+        self.assertEqual(len(inodes), 1)
+        self.assertTrue(inodes <= get_process_socket_inodes(os.getpid()))
+        client = socket.create_connection(('127.0.0.1', port))
+        self.addCleanup(client.close)
+        established = get_established_tcp_socket_inodes(port)
+        self.assertEqual(len(established), 1)   # Only our side of the connection has port as its remote port
+        self.assertTrue(established <= get_process_socket_inodes(os.getpid()))
+
+class ReadinessTest(ServerTestCase):
+
+    def test_start_waits_until_listening(self):
+        os.environ['FAKE_VTUND_START_DELAY'] = '0.3'
+        self.addCleanup(os.environ.pop, 'FAKE_VTUND_START_DELAY')
+        server = self._make_server('ready')
+        start = time.time()
+        server.start()
+        self.assertTrue(time.time() - start >= 0.3)
+        inodes = get_listening_tcp_sockets()[server.vtun_server_tcp_port]
+        self.assertTrue(inodes & get_process_socket_inodes(server._vtun_pid))
+
+    def test_start_timeout(self):
+        os.environ['FAKE_VTUND_START_DELAY'] = '10'
+        self.addCleanup(os.environ.pop, 'FAKE_VTUND_START_DELAY')
+        server = self._make_server('slow')
+        self.assertRaises(Exception, server.start, timeout = 0.2)
+        self.assertEqual((server._vtun_pid, server._vtun_process, server._vtund_config_file), (None, None, None))
+
+    def test_foreign_listener_is_not_mistaken_for_vtund(self):
+        server = self._make_server('foreign')
+        listener = _listen(server.vtun_server_tcp_port)  # vtund will not be able to listen on this port
+        self.addCleanup(listener.close)
+        server.vtund_exec = self._make_script('sleep_vtund', 'exec sleep 10')
+        self.assertRaises(Exception, server.start, timeout = 0.3)
+        original = server_vtun_tunnel.get_process_socket_inodes
+        server_vtun_tunnel.get_process_socket_inodes = lambda pid: None  # Like when vtund runs as root
+        self.addCleanup(setattr, server_vtun_tunnel, 'get_process_socket_inodes', original)
+        inodes_before = get_listening_tcp_sockets()[server.vtun_server_tcp_port]
+        self.assertFalse(server_vtun_tunnel._is_server_listening(os.getpid(), server.vtun_server_tcp_port, inodes_before))
+        self.assertTrue(server_vtun_tunnel._is_server_listening(os.getpid(), server.vtun_server_tcp_port, set()))
+
+    def test_exit_interrupts_the_wait(self):
+        if pidfd_open(os.getpid()) is None:
+            self.skipTest('pidfds are not supported')
+        server = self._make_server('exitting', vtund_exec = self._make_script('exitting_vtund', 'sleep 0.3; exit 1'))
+        selects = []
+        original_select = select.select
+        def recording_select(rlist, wlist, xlist, timeout):
+            result = original_select(rlist, wlist, xlist, timeout)
+            selects.append((time.time(), result[0]))
+            return result
+        server_vtun_tunnel.select.select = recording_select
+        self.addCleanup(setattr, server_vtun_tunnel.select, 'select', original_select)
+        try:
+            server.start(timeout = 10)
+        except Exception as e:
+            self.assertEqual(str(e), 'VtundExitedPrematurely')
+        else:
+            self.fail('No exception raised')
+        self.assertTrue(selects[-1][1]) # The pidfd of vtund became readable, instead of the wait reaching its timeout
+        self.assertEqual(server._vtun_pid, None)
+
+class ServerProcessTest(ServerTestCase):
+
+    def test_concurrent_servers_are_tracked_separately(self):
+        servers = [self._make_server('server' + str(i)) for i in range(3)]
+        for server in servers:
+            server.start()
+        self.assertEqual(len(set([server._vtun_pid for server in servers])), 3)
+        for server in servers:
+            self.assertEqual(server._vtun_pid, server._vtun_process.pid)    # Our own vtund, not the one of the (shared) pid file
+            self.assertTrue(get_listening_tcp_sockets()[server.vtun_server_tcp_port] & get_process_socket_inodes(server._vtun_pid))
+        process = servers[1]._vtun_process
+        servers[1].stop()
+        self.assertTrue(process.poll() is not None)  # Reaped
+        self.assertFalse(servers[1].vtun_server_tcp_port in get_listening_tcp_sockets())
+        for server in [servers[0], servers[2]]:
+            self.assertEqual(server._vtun_process.poll(), None)
+        self.assertRaises(Exception, servers[1].stop)
+
+    def test_vtund_pid_is_the_child_of_sudo(self):
+        bin_directory = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_directory)
+        self._make_script(os.path.join('bin', 'sudo'), '"$@" &\nwait $!')    # Stand-in for sudo, running its command in a child process
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_directory + os.pathsep + path
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        server = self._make_server('sudo', vtund_use_sudo = True)
+        server.start()
+        self.assertNotEqual(server._vtun_pid, server._vtun_process.pid)
+        self.assertEqual(server.get_child_of(server._vtun_process.pid), [str(server._vtun_pid)])
+        self.assertTrue(get_listening_tcp_sockets()[server.vtun_server_tcp_port] & get_process_socket_inodes(server._vtun_pid))
+        process = server._vtun_process
+        server.stop()
+        self.assertTrue(process.poll() is not None)
+
+if __name__ == '__main__':
+    unittest.main()
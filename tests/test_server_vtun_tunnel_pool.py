@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of server_vtun_tunnel_pool.ServerVtunTunnelPool (run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from server_vtun_tunnel import ServerVtunTunnel, RELOAD_RELOADED
+from tcp_port_allocator import TcpPortAllocator
+from run_benchmarks import prepare_fake_vtund
+import server_vtun_tunnel_pool
+import server_vtun_tunnel
+
+import shutil
+import signal
+import tempfile
+import unittest
+
+_port_allocator = TcpPortAllocator(43000, 43999)
+
+def _make_server(name, **kwargs):
+    tunnel_kwargs = {'mode': 'L3', 'tunnel_ip_network': '10.0.0.0/30', 'tunnel_near_end_ip': '10.0.0.1', 'tunnel_far_end_ip': '10.0.0.2', 'vtun_tunnel_name': name, 'vtun_shared_secret': 'secret'}
+    tunnel_kwargs.update(kwargs)
+    return ServerVtunTunnel(**tunnel_kwargs)
+
+class _SignalRecorder(object):
+    """ Replaces send_signal() (and the signalling of stop_vtund_server()) in a module, recording calls instead of signalling """
+
+    def __init__(self, test, module, name, error = None):
+        self.calls = []
+        original = getattr(module, name)
+        def replacement(*args, **kwargs):
+            self.calls.append(args)
+            if error is not None:
+                raise Exception(error)
+        setattr(module, name, replacement)
+        test.addCleanup(setattr, module, name, original)
+
+class PoolConfigTest(unittest.TestCase):
+
+    def test_sections_are_matched_by_name(self):
+        pool = server_vtun_tunnel_pool.ServerVtunTunnelPool(vtun_server_tcp_port = 5000, tunnels = [_make_server('t1', up_additional_commands = ['/bin/true']), _make_server('t10')])
+        sections = server_vtun_tunnel_pool._get_config_sections(pool.to_vtund_config())
+        self.assertEqual(sorted(sections), ['options', 't1', 't10'])
+        self.assertEqual(sections['t1'], pool.get_tunnel('t1').to_vtund_tunnel_config())
+        self.assertEqual(sections['t10'], pool.get_tunnel('t10').to_vtund_tunnel_config())
+        self.assertEqual(sections['options'], pool.to_vtund_options_config())
+
+    def test_tunnel_checks(self):
+        pool = server_vtun_tunnel_pool.ServerVtunTunnelPool(vtun_server_tcp_port = 5000, tunnels = [_make_server('t1')])
+        self.assertRaises(Exception, pool.add_tunnel, _make_server('t1'))
+        self.assertRaises(Exception, pool.add_tunnel, _make_server('t2', vtun_server_tcp_port = 5001))
+        tunnel = _make_server('t2')
+        pool.add_tunnel(tunnel)
+        self.assertEqual(tunnel.vtun_server_tcp_port, 5000)
+        self.assertTrue(pool.remove_tunnel('t1') is not None)
+        self.assertEqual([tunnel.vtun_tunnel_name for tunnel in pool.get_tunnels()], ['t2'])
+
+class RunningPoolTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def _start_pool(self, tunnels):
+        pool = server_vtun_tunnel_pool.ServerVtunTunnelPool(vtund_exec = self.vtund_exec, vtun_server_tcp_port = _port_allocator.allocate(), vtund_config_delivery = 'private_dir', tunnels = tunnels)
+        pool.start()
+        self.addCleanup(lambda: pool.is_running() and pool.stop())
+        return pool
+
+    def test_add_tunnel_reloads(self):
+        pool = self._start_pool([_make_server('t1')])
+        pid = pool._vtun_pid
+        pool.add_tunnel(_make_server('t2'))
+        self.assertEqual(pool._vtun_pid, pid)
+        self.assertEqual(pool._vtund_config_file.config, pool.to_vtund_config())
+
+    def test_restart_sessions_of_changed_tunnels_only(self):
+        pool = self._start_pool([_make_server('t1'), _make_server('t10')])
+        terminated = []
+        pool.get_session_pids = lambda name: terminated.append(name) or []
+        self.assertEqual(pool.apply([_make_server('t1', vtun_shared_secret = 'changed'), _make_server('t10')], restart_sessions = True), RELOAD_RELOADED)
+        self.assertEqual(terminated, ['t1'])
+        del terminated[:]
+        self.assertEqual(pool.apply([_make_server('t1', vtun_shared_secret = 'changed')], restart_sessions = True), RELOAD_RELOADED)
+        self.assertEqual(terminated, ['t10'])
+
+    def test_rollback_when_reload_fails(self):
+        pool = self._start_pool([_make_server('t1')])
+        running_config = pool._vtund_config_file.config
+        _SignalRecorder(self, server_vtun_tunnel_pool, 'send_signal', 'SignalFailed')
+        self.assertRaises(Exception, pool.add_tunnel, _make_server('t2'))
+        self.assertRaises(Exception, pool.remove_tunnel, 't1')
+        self.assertRaises(Exception, pool.apply, [_make_server('t3')])
+        self.assertEqual([tunnel.vtun_tunnel_name for tunnel in pool.get_tunnels()], ['t1'])
+        self.assertEqual(pool._vtund_config_file.config, running_config)
+        with open(pool._vtund_config_file.path, 'r') as f:
+            self.assertEqual(f.read(), running_config)
+
+    def test_exitted_vtund_is_not_signalled(self):
+        pool = self._start_pool([_make_server('t1')])
+        os.kill(pool._vtun_pid, signal.SIGKILL)
+        pool._vtun_process.wait()
+        reload_signals = _SignalRecorder(self, server_vtun_tunnel_pool, 'send_signal')
+        stop_signals = _SignalRecorder(self, server_vtun_tunnel, 'terminate_process_tree')   # Used by stop_vtund_server()
+        self.assertRaises(Exception, pool.reload)
+        self.assertRaises(Exception, pool.add_tunnel, _make_server('t2'))
+        self.assertEqual([tunnel.vtun_tunnel_name for tunnel in pool.get_tunnels()], ['t1'])
+        pool.stop()
+        self.assertEqual((reload_signals.calls, stop_signals.calls), ([], []))
+        self.assertFalse(pool.is_running())
+        self.assertEqual(pool._vtund_config_file, None)
+
+if __name__ == '__main__':
+    unittest.main()
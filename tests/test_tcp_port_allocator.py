@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tcp_port_allocator.TcpPortAllocator
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tcp_port_allocator import TcpPortAllocator
+
+import gc
+import socket
+import unittest
+
+class _Holder(object):
+    """ Stand-in for a tunnel object holding a port (only vtun_server_tcp_port and _vtun_pid are used) """
+
+    def __init__(self):
+        self.vtun_server_tcp_port = None
+        self._vtun_pid = None
+
+class TcpPortAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = TcpPortAllocator(40000, 40009)
+
+    def test_allocate_in_order(self):
+        self.assertEqual(self.allocator.allocate_many([None] * 3), [40000, 40001, 40002])
+
+    def test_released_port_is_reused_last(self):
+        port = self.allocator.allocate()
+        self.allocator.release(port)
+        self.assertEqual(self.allocator.allocate_many([None] * 10)[-1], port)
+
+    def test_reserve_release_does_not_queue_twice(self):
+        for i in range(100):
+            self.allocator.reserve(40005)
+            self.allocator.release(40005)
+        self.assertEqual(len(self.allocator._free), 10)
+        self.assertEqual(sorted(self.allocator.allocate_many([None] * 10)), list(range(40000, 40010)))
+        self.assertRaises(Exception, self.allocator.allocate)
+
+    def test_reserved_port_is_skipped(self):
+        self.allocator.reserve(40000)
+        self.assertEqual(self.allocator.allocate(), 40001)
+        self.assertEqual(self.allocator.get_free_count(), 8)
+
+    def test_reserve_out_of_range(self):
+        self.allocator.reserve(50000)
+        self.assertTrue(self.allocator.is_allocated(50000))
+        self.allocator.release(50000)
+        self.assertEqual(len(self.allocator._free), 10)
+
+    def test_double_reserve_and_release(self):
+        self.allocator.reserve(40003)
+        self.assertRaises(Exception, self.allocator.reserve, 40003)
+        self.allocator.release(40003)
+        self.assertRaises(Exception, self.allocator.release, 40003)
+
+    def test_allocate_many_all_or_nothing(self):
+        self.allocator.allocate_many([None] * 8)
+        self.assertRaises(Exception, self.allocator.allocate_many, [None] * 3)
+        self.assertEqual(self.allocator.get_free_count(), 2)
+
+    def test_listening_port_is_skipped(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            port = listener.getsockname()[1]
+            allocator = TcpPortAllocator(port, port + 1)
+            self.assertEqual(allocator.allocate_many([None] * 1), [port + 1])
+            self.assertRaises(Exception, allocator.allocate)
+            self.assertEqual((list(allocator._free), allocator._busy), ([], set([port])))    # Not scanned again by next allocations
+        finally:
+            listener.close()
+        self.assertEqual(allocator.allocate(), port)  # Queued again once nothing listens on it anymore
+        self.assertEqual(allocator._busy, set())
+
+    def test_holder_sets_port_and_releases_on_collect(self):
+        holder = _Holder()
+        port = self.allocator.allocate(holder)
+        self.assertEqual(holder.vtun_server_tcp_port, port)
+        self.assertTrue(self.allocator.get_holder(port) is holder)
+        del holder
+        gc.collect()
+        self.assertFalse(self.allocator.is_allocated(port))
+
+if __name__ == '__main__':
+    unittest.main()
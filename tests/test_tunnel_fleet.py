@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_fleet.TunnelFleet (run on stand-in tunnel objects, no vtund process is started)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_fleet import TunnelFleet
+
+import threading
+import time
+import unittest
+
+class _Tunnel(object):
+    """ Stand-in for a tunnel object, whose start() blocks until \p release is set """
+
+    def __init__(self, name, release = None, error = None):
+        self.vtun_tunnel_name = name
+        self.release = release
+        self.error = error
+        self.calls = []
+
+    def start(self, **kwargs):
+        self.calls.append(('start', kwargs))
+        if self.release is not None:
+            self.release.wait(10)
+        if self.error is not None:
+            raise Exception(self.error)
+
+    def stop(self, **kwargs):
+        self.calls.append(('stop', kwargs))
+
+class TunnelFleetTest(unittest.TestCase):
+
+    def _release_later(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        return release
+
+    def test_results_in_order(self):
+        tunnels = [_Tunnel('t' + str(i), error = 'StartFailed' if i % 2 else None) for i in range(10)]
+        results = TunnelFleet(tunnels = tunnels, max_workers = 3).restart_all()
+        self.assertEqual([result.tunnel for result in results], tunnels)
+        self.assertEqual([result.is_success() for result in results], [i % 2 == 0 for i in range(10)])
+        self.assertEqual([str(result.error) for result in results if result.error is not None], ['StartFailed'] * 5)
+        self.assertEqual([call[0] for call in tunnels[0].calls], ['stop', 'start'])
+
+    def test_hung_operation_times_out(self):
+        release = self._release_later()
+        tunnels = [_Tunnel('hung', release = release), _Tunnel('quick')]
+        results = TunnelFleet(tunnels = tunnels, max_workers = 2).start_all(timeout = 0.2)
+        self.assertEqual([(result.timed_out, result.finished) for result in results], [(True, False), (False, True)])
+        self.assertEqual(str(results[0].error), 'TunnelOperationTimeout')
+        release.set()
+        deadline = time.time() + 5
+        while not results[0].finished and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((results[0].finished, results[0].final_error), (True, None))  # The start succeeded after having been reported as timed out
+
+    def test_queued_operations_time_out_when_all_workers_are_blocked(self):
+        release = self._release_later()
+        tunnels = [_Tunnel('hung1', release = release), _Tunnel('hung2', release = release), _Tunnel('queued1'), _Tunnel('queued2')]
+        start = time.time()
+        results = TunnelFleet(tunnels = tunnels, max_workers = 2).start_all(timeout = 0.2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual([result.timed_out for result in results], [True] * 4)
+        self.assertEqual([(result.finished, result.duration) for result in results[2:]], [(True, None)] * 2)
+        self.assertEqual([tunnel.calls for tunnel in tunnels[2:]], [[], []])    # Never run, even once the workers are available again
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual([tunnel.calls for tunnel in tunnels[2:]], [[], []])
+
+    def test_admission_wait_does_not_count(self):
+        tunnels = [_Tunnel('t' + str(i)) for i in range(4)]
+        results = TunnelFleet(tunnels = tunnels, max_workers = 4, max_operations_per_second = 10, max_operations_burst = 1).start_all(timeout = 0.15)
+        self.assertEqual([result.is_success() for result in results], [True] * 4)   # The last start is only admitted after 0.3s
+
+if __name__ == '__main__':
+    unittest.main()
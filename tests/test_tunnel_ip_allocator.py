@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_ip_allocator.TunnelIpAllocator
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_ip_allocator import TunnelIpAllocator
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import ipaddr
+
+class TunnelIpAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pool.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _assert_same_state(self, first, second):
+        self.assertEqual(first._bitmap, second._bitmap)
+        self.assertEqual(first._allocated_count, second._allocated_count)
+        self.assertEqual(first._cursor, second._cursor)
+        self.assertEqual(list(first._released), list(second._released))
+
+    def _churn(self, allocator, count):
+        """ Allocate and release subnets, in a deterministic order """
+        allocated = []
+        for i in range(count):
+            if allocated and i % 3 == 2:
+                allocator.release(allocated.pop(i % len(allocated))[0])
+            else:
+                allocated.append(allocator.allocate())
+        return allocated
+
+    def test_allocate(self):
+        allocator = TunnelIpAllocator('10.1.0.0/24', 30)
+        self.assertEqual(allocator.allocate(), (ipaddr.IPv4Network('10.1.0.0/30'), ipaddr.IPv4Address('10.1.0.1'), ipaddr.IPv4Address('10.1.0.2')))
+        allocator = TunnelIpAllocator('10.1.0.0/24', 31)
+        self.assertEqual(allocator.allocate(), (ipaddr.IPv4Network('10.1.0.0/31'), ipaddr.IPv4Address('10.1.0.0'), ipaddr.IPv4Address('10.1.0.1')))
+
+    def test_released_subnet_is_reused_first(self):
+        allocator = TunnelIpAllocator('10.1.0.0/24', 30)
+        first = allocator.allocate()[0]
+        allocator.allocate()
+        allocator.release(first)
+        self.assertEqual(allocator.allocate()[0], first)
+
+    def test_reserved_subnet_is_skipped(self):
+        allocator = TunnelIpAllocator('10.1.0.0/24', 30)
+        allocator.reserve('10.1.0.0/30')
+        self.assertEqual(allocator.allocate()[0], ipaddr.IPv4Network('10.1.0.4/30'))
+        self.assertRaises(Exception, allocator.reserve, '10.1.0.4/30')
+        self.assertRaises(Exception, allocator.reserve, '10.2.0.0/30')
+
+    def test_release_reserve_then_allocate(self):
+        allocator = TunnelIpAllocator('10.1.0.0/28', 30)
+        first = allocator.allocate()[0]
+        allocator.release(first)
+        allocator.reserve(first)    # Stays on the released stack, and must be skipped
+        self.assertNotEqual(allocator.allocate()[0], first)
+        self.assertRaises(Exception, allocator.release, '10.1.0.12/30')
+
+    def test_exhaustion(self):
+        allocator = TunnelIpAllocator('10.1.0.0/28', 30)
+        for i in range(4):
+            allocator.allocate()
+        self.assertRaises(Exception, allocator.allocate)
+
+    def test_save_and_load(self):
+        allocator = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path)
+        self._churn(allocator, 500)
+        allocator.save()
+        loaded = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path)
+        self._assert_same_state(allocator, loaded)
+        self.assertEqual([allocator.allocate() for i in range(20)], [loaded.allocate() for i in range(20)])
+
+    def test_autosave_journal_is_replayed(self):
+        allocator = TunnelIpAllocator('10.1.0.0/16', 30, persistence_file = self.path, autosave = True)
+        self.addCleanup(allocator.close)
+        allocator.reserve('10.1.200.0/30')
+        self._churn(allocator, 300)
+        self.assertFalse(os.path.exists(self.path))    # Nothing compacted yet, everything is in the journal
+        loaded = TunnelIpAllocator('10.1.0.0/16', 30, persistence_file = self.path)
+        self._assert_same_state(allocator, loaded)
+
+    def test_autosave_compacts_journal(self):
+        allocator = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path, autosave = True)
+        self.addCleanup(allocator.close)
+        self._churn(allocator, TunnelIpAllocator.COMPACT_MIN_ENTRIES + 100)
+        with open(self.path + TunnelIpAllocator.JOURNAL_SUFFIX, 'r') as f:
+            self.assertTrue(len(f.readlines()) < TunnelIpAllocator.COMPACT_MIN_ENTRIES)
+        loaded = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path)
+        self._assert_same_state(allocator, loaded)
+
+    def test_journal_entries_already_saved_are_skipped(self):
+        allocator = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path, autosave = True)
+        self.addCleanup(allocator.close)
+        self._churn(allocator, 200)
+        allocator.close()
+        with open(self.path + TunnelIpAllocator.JOURNAL_SUFFIX, 'r') as f:
+            journal = f.read()
+        allocator.save()
+        with open(self.path + TunnelIpAllocator.JOURNAL_SUFFIX, 'w') as f:   # As if we crashed before the journal was truncated
+            f.write(journal)
+        loaded = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path)
+        self._assert_same_state(allocator, loaded)
+
+    def test_truncated_journal_entry_is_ignored(self):
+        allocator = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path, autosave = True)
+        self.addCleanup(allocator.close)
+        self._churn(allocator, 50)
+        allocator.close()
+        with open(self.path + TunnelIpAllocator.JOURNAL_SUFFIX, 'a') as f:
+            f.write('A 4000 1')
+        loaded = TunnelIpAllocator('10.1.0.0/20', 30, persistence_file = self.path)
+        self._assert_same_state(allocator, loaded)
+
+    def test_state_without_cursor(self):
+        allocator = TunnelIpAllocator('10.1.0.0/24', 30, persistence_file = self.path)
+        allocator.allocate()
+        allocator.save()
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        with open(self.path, 'w') as f:
+            json.dump({'network': state['network'], 'prefixlen': state['prefixlen'], 'bitmap': state['bitmap']}, f)
+        loaded = TunnelIpAllocator('10.1.0.0/24', 30, persistence_file = self.path)
+        self.assertEqual(loaded.allocate()[0], ipaddr.IPv4Network('10.1.0.4/30'))
+
+    def test_persistence_mismatch(self):
+        TunnelIpAllocator('10.1.0.0/24', 30, persistence_file = self.path).save()
+        self.assertRaises(Exception, TunnelIpAllocator, '10.2.0.0/24', 30, persistence_file = self.path)
+
+    def test_autosave_requires_persistence_file(self):
+        self.assertRaises(Exception, TunnelIpAllocator, '10.1.0.0/24', 30, autosave = True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_journal.TunnelStateJournal (run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from tunnel_journal import TunnelStateJournal, get_tunnel_definition, make_tunnel
+from process_teardown import wait_for_exit
+from run_benchmarks import prepare_fake_vtund
+
+import json
+import shutil
+import signal
+import tempfile
+import unittest
+
+_port_allocator = TcpPortAllocator(42000, 42999)
+
+class TunnelStateJournalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.path = os.path.join(self.directory, 'journal')
+        self.addCleanup(lambda: os.path.exists(self.path) and os.remove(self.path))
+
+    def _open_journal(self):
+        journal = TunnelStateJournal(self.path)
+        self.addCleanup(journal.close)
+        return journal
+
+    def _make_server(self, name):
+        return ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+
+    def _stop_later(self, tunnel):
+        self.addCleanup(lambda: tunnel._vtun_pid is not None and tunnel.stop())
+
+    def test_definition_round_trip(self):
+        server = self._make_server('journal0')
+        server.up_additional_commands = ['/bin/true']
+        copy = make_tunnel('server', json.loads(json.dumps(get_tunnel_definition(server))))
+        self.assertEqual(copy.to_vtund_config(), server.to_vtund_config())
+
+    def test_recover_running_tunnel(self):
+        journal = self._open_journal()
+        server = self._make_server('journal1')
+        journal.start_tunnel(server)
+        self._stop_later(server)
+        journal.close()
+
+        recovered_journal = self._open_journal()
+        (reattached, gone, errors) = recovered_journal.recover()
+        self.assertEqual((len(reattached), gone, errors), (1, [], []))
+        tunnel = reattached[0]
+        self.assertEqual(tunnel._vtun_pid, server._vtun_pid)
+        self.assertEqual(tunnel.to_vtund_config(), server.to_vtund_config())
+        recovered_journal.stop_tunnel(tunnel)
+        self.assertEqual(recovered_journal.get_records(), [])
+        self.assertTrue(wait_for_exit(server._vtun_pid, 1))
+        server.stop()   # Only reaps vtund (stopped via the recovered object) and releases its configuration
+
+    def test_recover_gone_tunnel(self):
+        journal = self._open_journal()
+        server = self._make_server('journal2')
+        journal.start_tunnel(server)
+        self._stop_later(server)
+        os.kill(server._vtun_pid, signal.SIGKILL)
+        server._vtun_process.wait()
+        journal.close()
+
+        recovered_journal = self._open_journal()
+        (reattached, gone, errors) = recovered_journal.recover(start_gone = False)
+        self.assertEqual((reattached, [tunnel.vtun_tunnel_name for tunnel in gone], errors), ([], ['journal2'], []))
+        self.assertEqual(recovered_journal.get_records(), [])
+        server.stop()
+
+    def test_recover_client_restarts_vtund(self):
+        server = self._make_server('journal6')
+        server.start()
+        self._stop_later(server)
+        journal = self._open_journal()
+        client = ClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = 'journal6', vtun_shared_secret = 'secret', vtun_server_hostname = '127.0.0.1', vtun_server_tcp_port = server.vtun_server_tcp_port, vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+        journal.start_tunnel(client)
+        self._stop_later(client)
+        self.assertTrue(client.wait_until_connected(5))
+        old_pid = client._vtun_pid
+        journal.close()
+
+        recovered_journal = self._open_journal()
+        (reattached, gone, errors) = recovered_journal.recover()
+        self.assertEqual((reattached, len(gone), errors), ([], 1, []))
+        tunnel = gone[0]
+        self._stop_later(tunnel)
+        self.assertTrue(wait_for_exit(old_pid, 1))  # The vtund process whose output was piped to the previous instance has been stopped...
+        self.assertNotEqual(tunnel._vtun_pid, old_pid)   # ... and replaced by a new one, whose output we read
+        self.assertTrue(tunnel.wait_until_connected(5))
+        self.assertTrue('Session journal6' in tunnel.get_output())
+        self.assertEqual([record['pid'] for record in recovered_journal.get_records()], [tunnel._vtun_pid])
+        recovered_journal.stop_tunnel(tunnel)
+        client.stop()   # Only reaps the previous vtund
+
+    def test_stopped_tunnels_are_not_recovered(self):
+        journal = self._open_journal()
+        server = self._make_server('journal3')
+        journal.start_tunnel(server)
+        journal.stop_tunnel(server)
+        journal.close()
+        self.assertEqual(self._open_journal().get_records(), [])
+
+    def test_truncated_record_is_ignored(self):
+        journal = self._open_journal()
+        server = self._make_server('journal4')
+        journal.start_tunnel(server)
+        self._stop_later(server)
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"op": "stop", "key": "server:jou')  # Crash while appending a record
+        recovered_journal = self._open_journal()
+        self.assertEqual([record['key'] for record in recovered_journal.get_records()], ['server:journal4'])
+        with open(self.path, 'r') as f:
+            self.assertTrue(f.read().endswith('\n'))    # Compacted, so that next records are not appended to the truncated one
+
+    def test_compaction(self):
+        journal = self._open_journal()
+        server = self._make_server('journal5')
+        journal.start_tunnel(server)
+        self._stop_later(server)
+        for i in range(TunnelStateJournal.COMPACT_MIN_RECORDS):
+            journal.record_start(server)
+        with open(self.path, 'r') as f:
+            self.assertTrue(len(f.readlines()) <= TunnelStateJournal.COMPACT_MIN_RECORDS)
+        journal.close()
+        self.assertEqual(len(self._open_journal().get_records()), 1)
+
+if __name__ == '__main__':
+    unittest.main()
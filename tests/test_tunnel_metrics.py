@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_metrics (the instrumented tunnels are run against benchmarks/fake_vtund, so that no root access is needed)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from tunnel_metrics import TunnelMetrics, PrometheusExporter, get_error_code, enable_metrics, disable_metrics, get_metrics, start_timer, count, NULL_TIMER, COUNTER, HISTOGRAM
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from run_benchmarks import prepare_fake_vtund
+
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+_port_allocator = TcpPortAllocator(48000, 48999)
+
+class TunnelMetricsTest(unittest.TestCase):
+
+    def test_error_code(self):
+        self.assertEqual(get_error_code(Exception('VtundStartTimeout')), 'VtundStartTimeout')
+        self.assertEqual(get_error_code(Exception('InvalidTcpPort:0')), 'InvalidTcpPort')
+        self.assertEqual(get_error_code(Exception()), 'Exception')
+        self.assertEqual(get_error_code(ValueError('x')), 'ValueError')
+
+    def test_counters(self):
+        metrics = TunnelMetrics()
+        metrics.inc('tunnel_starts_total', kind='server')
+        metrics.inc('tunnel_starts_total', 2, kind='server')
+        metrics.inc('tunnel_reloads_total', kind='pool', action='hup')
+        self.assertEqual(metrics.get_counter('tunnel_starts_total', kind='server'), 3)
+        self.assertEqual(metrics.get_counter('tunnel_starts_total', kind='client'), 0)
+        self.assertEqual(metrics.get_counter('tunnel_reloads_total', action='hup', kind='pool'), 1)   # Labels are not ordered
+
+    def test_histograms(self):
+        metrics = TunnelMetrics(buckets = [0.1, 1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            metrics.observe('tunnel_start_seconds', value, kind='server')
+        histogram = metrics.get_histogram('tunnel_start_seconds', kind='server')
+        self.assertEqual(histogram['buckets'], [(0.1, 2), (1, 3), (float('inf'), 4)])   # Bounds are inclusive
+        self.assertEqual(histogram['count'], 4)
+        self.assertAlmostEqual(histogram['sum'], 2.65)
+        self.assertEqual(metrics.get_histogram('tunnel_start_seconds', kind='client'), None)
+        self.assertRaises(Exception, TunnelMetrics, buckets = [1, 0.1])
+        self.assertRaises(Exception, TunnelMetrics, buckets = [])
+
+    def test_samples_and_reset(self):
+        metrics = TunnelMetrics(buckets = [1])
+        metrics.inc('tunnel_stops_total', kind='server')
+        metrics.observe('tunnel_start_seconds', 0.5, kind='server')
+        metrics.inc('tunnel_starts_total', kind='server')
+        metrics.inc('tunnel_starts_total', kind='client')
+        self.assertEqual([(name, metric_type, labels) for (name, metric_type, labels, value) in metrics.get_samples()], [('tunnel_start_seconds', HISTOGRAM, (('kind', 'server'),)), ('tunnel_starts_total', COUNTER, (('kind', 'client'),)), ('tunnel_starts_total', COUNTER, (('kind', 'server'),)), ('tunnel_stops_total', COUNTER, (('kind', 'server'),))])
+        metrics.reset()
+        self.assertEqual(metrics.get_samples(), [])
+
+    def test_concurrent_increments(self):
+        metrics = TunnelMetrics()
+        def increment():
+            for i in range(1000):
+                metrics.inc('tunnel_exits_total', kind='server')
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.get_counter('tunnel_exits_total', kind='server'), 4000)
+
+class PrometheusExporterTest(unittest.TestCase):
+
+    def _make_metrics(self):
+        metrics = TunnelMetrics(buckets = [0.5])
+        metrics.inc('tunnel_start_failures_total', kind='server', error='Bad"Error\n')
+        metrics.observe('tunnel_start_seconds', 0.25, kind='server')
+        return metrics
+
+    def test_render(self):
+        exporter = PrometheusExporter(labels = {'instance': 'controller1'})
+        self.assertEqual(exporter.render(self._make_metrics()).splitlines(), [
+            '# HELP vtun_tunnel_start_failures_total Failed tunnel starts, by error',
+            '# TYPE vtun_tunnel_start_failures_total counter',
+            'vtun_tunnel_start_failures_total{instance="controller1",error="Bad\\"Error\\n",kind="server"} 1',
+            '# HELP vtun_tunnel_start_seconds Duration of successful tunnel starts',
+            '# TYPE vtun_tunnel_start_seconds histogram',
+            'vtun_tunnel_start_seconds_bucket{instance="controller1",kind="server",le="0.5"} 1',
+            'vtun_tunnel_start_seconds_bucket{instance="controller1",kind="server",le="+Inf"} 1',
+            'vtun_tunnel_start_seconds_sum{instance="controller1",kind="server"} 0.25',
+            'vtun_tunnel_start_seconds_count{instance="controller1",kind="server"} 1',
+        ])
+        self.assertEqual(PrometheusExporter(prefix = '').render(TunnelMetrics()), '')
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'vtun.prom')
+        exporter = PrometheusExporter()
+        exporter.write(self._make_metrics(), path)
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), exporter.render(self._make_metrics()))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        self.assertEqual(os.listdir(directory), ['vtun.prom']) # No temporary file left
+
+class InstrumentationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.addCleanup(disable_metrics)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(get_metrics(), None)
+        self.assertTrue(start_timer('server', 'start') is NULL_TIMER)
+        count('tunnel_exits_total', kind='server')
+        metrics = enable_metrics()
+        self.assertTrue(get_metrics() is metrics)
+        self.assertEqual(metrics.get_samples(), [])
+
+    def _make_server(self, name, **kwargs):
+        server = ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = name, vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_config_delivery = 'private_dir', **kwargs)
+        self.addCleanup(lambda: server._vtun_pid is not None and server.stop())
+        return server
+
+    def test_tunnel_lifecycle(self):
+        metrics = enable_metrics(TunnelMetrics())
+        server = self._make_server('metrics', vtund_exec = self.vtund_exec)
+        server.start()
+        client = ClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = 'metrics', vtun_shared_secret = 'secret', vtun_server_hostname = '127.0.0.1', vtun_server_tcp_port = server.vtun_server_tcp_port, vtund_exec = self.vtund_exec, vtund_config_delivery = 'private_dir')
+        self.addCleanup(lambda: client._vtun_pid is not None and client.stop())
+        client.start()
+        self.assertTrue(client.wait_until_connected(5))
+        client.stop()
+        server.stop()
+        for kind in ['server', 'client']:
+            self.assertEqual(metrics.get_counter('tunnel_starts_total', kind=kind), 1)
+            self.assertEqual(metrics.get_counter('tunnel_stops_total', kind=kind), 1)
+            self.assertEqual(metrics.get_histogram('tunnel_start_seconds', kind=kind)['count'], 1)
+            for phase in ['render', 'deliver', 'spawn']:
+                self.assertEqual(metrics.get_histogram('tunnel_phase_seconds', kind=kind, operation='start', phase=phase)['count'], 1)
+            for phase in ['terminate', 'reap', 'release']:
+                self.assertEqual(metrics.get_histogram('tunnel_phase_seconds', kind=kind, operation='stop', phase=phase)['count'], 1)
+        self.assertEqual(metrics.get_histogram('tunnel_phase_seconds', kind='server', operation='start', phase='ready')['count'], 1)
+        self.assertEqual(metrics.get_counter('tunnel_connections_total', kind='client', result='connected'), 1)
+        self.assertEqual(metrics.get_histogram('tunnel_connect_seconds', kind='client')['count'], 1)
+
+    def test_start_failure(self):
+        metrics = enable_metrics(TunnelMetrics())
+        server = self._make_server('failure', vtund_exec = os.path.join(self.directory, 'missing_vtund'))
+        self.assertRaises(Exception, server.start)
+        failures = [(labels, value) for (name, metric_type, labels, value) in metrics.get_samples() if name == 'tunnel_start_failures_total']
+        self.assertEqual(len(failures), 1)
+        self.assertEqual((dict(failures[0][0])['kind'], failures[0][1]), ('server', 1))
+        self.assertEqual(metrics.get_counter('tunnel_starts_total', kind='server'), 0)
+        self.assertEqual(metrics.get_histogram('tunnel_start_seconds', kind='server'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_profile and of the tuning_profile argument of tunnels (no vtund process is started)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_profile import TunnelProfile, check_mtu, register_profile, get_profile, get_profile_names, get_profile_name, resolve_profile_settings, get_profile_mismatches
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+import tunnel_profile
+
+import unittest
+
+def _make_server(**kwargs):
+    return ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 'profile', vtun_shared_secret = 'secret', vtun_server_tcp_port = 5000, **kwargs)
+
+class TunnelProfileTest(unittest.TestCase):
+
+    def _assert_error(self, error, function, *args, **kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            self.assertEqual(str(e), error)
+        else:
+            self.fail('No exception raised')
+
+    def test_builtin_profiles(self):
+        self.assertEqual(get_profile_names(), ['bulk_throughput', 'default', 'low_cpu', 'low_latency'])
+        self.assertEqual(get_profile('default').get_settings(), {'mtu': 1450, 'vtun_protocol': 'tcp', 'vtun_compression': 'lzo:9', 'vtun_keepalive': True})    # vtun_encryption is left unchanged
+        self.assertEqual(get_profile('low_latency').get_settings(), {'mtu': 1400, 'vtun_protocol': 'udp', 'vtun_compression': 'no', 'vtun_keepalive': True})
+        self.assertEqual(get_profile('low_cpu').vtun_keepalive, False)
+        self._assert_error('UnknownTuningProfile:fast', get_profile, 'fast')
+
+    def test_profile_values_are_checked(self):
+        self.assertEqual(check_mtu('1400'), 1400)
+        for mtu in [67, 65536, 'big', None]:
+            self._assert_error('InvalidMtu:' + str(mtu), check_mtu, mtu)
+        self._assert_error('UnsupportedProtocol:sctp', TunnelProfile, 'p', vtun_protocol = 'sctp')
+        self._assert_error('InvalidCompression:lzo:10', TunnelProfile, 'p', vtun_compression = 'lzo:10')
+        self.assertEqual(TunnelProfile('p', vtun_compression = 'zlib', vtun_encryption = 1).get_settings()['vtun_encryption'], True)
+
+    def test_custom_profile(self):
+        profile = TunnelProfile('jumbo', mtu = 8000, vtun_compression = 'no')
+        self.assertTrue(get_profile(profile) is profile)
+        self.assertEqual(get_profile_name(profile), 'jumbo')
+        self.assertEqual(get_profile_name(None), None)
+        register_profile(profile)
+        self.addCleanup(tunnel_profile._profiles.pop, 'jumbo')
+        self.assertTrue(get_profile('jumbo') is profile)
+        self.assertEqual(_make_server(tuning_profile = 'jumbo').mtu, 8000)
+
+    def test_explicit_values(self):
+        self.assertEqual(resolve_profile_settings(None, {'mtu': 1000}), {})
+        self.assertEqual(resolve_profile_settings('low_latency', {'mtu': '1400', 'vtun_protocol': 'udp', 'vtun_encryption': True, 'vtun_keepalive': None}), get_profile('low_latency').get_settings())  # Same values, unset values, or values not set by the profile
+        self._assert_error('TuningProfileConflict:mtu', resolve_profile_settings, 'low_latency', {'mtu': 1450})
+        self._assert_error('TuningProfileConflict:vtun_keepalive', resolve_profile_settings, 'low_cpu', {'vtun_keepalive': 1})
+        self._assert_error('TuningProfileConflict:vtun_compression', _make_server, tuning_profile = 'low_cpu', vtun_compression = 'lzo:9')
+
+class TunnelTuningTest(unittest.TestCase):
+
+    def test_server(self):
+        server = _make_server(tuning_profile = 'low_latency', vtun_encryption = True)
+        self.assertEqual((server.tuning_profile, server.mtu, server.vtun_protocol, server.vtun_compression, server.vtun_encryption, server.vtun_keepalive), ('low_latency', 1400, 'udp', 'no', True, True))
+        config = server.to_vtund_tunnel_config()
+        for line in ['\tproto udp;\n', '\tcompress no;\n', '\tencrypt yes;\n', ' mtu 1400";\n']:
+            self.assertTrue(line in config)
+        server = _make_server(tuning_profile = get_profile('low_cpu'))
+        self.assertEqual((server.tuning_profile, server.vtun_keepalive), ('low_cpu', False))  # Only the name is kept
+        server = _make_server()
+        self.assertEqual((server.tuning_profile, server.mtu, server.vtun_compression), (None, 1450, 'lzo:9'))
+
+    def test_server_apply(self):
+        server = _make_server(tuning_profile = 'low_latency')
+        server.apply(tuning_profile = 'bulk_throughput')
+        self.assertEqual((server.tuning_profile, server.vtun_protocol, server.vtun_compression, server.mtu), ('bulk_throughput', 'tcp', 'lzo:1', 1450))
+        server.apply(vtun_compression = 'lzo:1')    # Same as the profile
+        self.assertEqual(server.tuning_profile, 'bulk_throughput')
+        server.apply(mtu = '1300')  # Attributes do not follow the profile anymore
+        self.assertEqual((server.tuning_profile, server.mtu), (None, 1300))
+        self.assertRaises(Exception, server.apply, tuning_profile = 'low_cpu', vtun_keepalive = True)
+        self.assertRaises(Exception, server.apply, mtu = 10)
+        self.assertEqual((server.tuning_profile, server.mtu, server.vtun_keepalive), (None, 1300, True)) # Unchanged
+
+    def test_client_from_server(self):
+        server = _make_server(tuning_profile = 'low_latency')
+        client = ClientVtunTunnel(from_server = server, vtun_server_hostname = 'server')
+        self.assertEqual((client.tuning_profile, client.mtu, client.vtun_protocol, client.vtun_compression, client.vtun_encryption, client.vtun_keepalive), ('low_latency', 1400, 'udp', 'no', False, True))
+        self.assertEqual(get_profile_mismatches(server, client), [])
+        self.assertEqual(ClientVtunTunnel(from_server = server, vtun_server_hostname = 'server', tuning_profile = 'low_latency', mtu = 1400).mtu, 1400)
+        try:
+            ClientVtunTunnel(from_server = server, vtun_server_hostname = 'server', tuning_profile = 'low_cpu')
+        except Exception as e:
+            self.assertEqual(str(e), 'TuningProfileMismatch:mtu,vtun_protocol,vtun_keepalive')
+        else:
+            self.fail('No exception raised')
+        self.assertRaises(Exception, ClientVtunTunnel, from_server = server, vtun_server_hostname = 'server', mtu = 1450)
+
+    def test_client_without_server(self):
+        client = ClientVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.2', tunnel_far_end_ip = '10.0.0.1', vtun_tunnel_name = 'profile', vtun_shared_secret = 'secret', vtun_server_hostname = 'server', vtun_server_tcp_port = 5000)
+        self.assertEqual((client.vtun_protocol, client.vtun_compression, client.vtun_encryption, client.vtun_keepalive), (None, None, None, None))   # The server decides
+        self.assertEqual(get_profile_mismatches(_make_server(tuning_profile = 'low_latency'), client), ['mtu'])   # The MTU is always set, on both ends
+        config = client.to_vtund_config()
+        self.assertFalse('proto ' in config or 'compress ' in config)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_stats (/proc/net/dev and sysfs contents are faked, except in the periodic sampling test, which reads the loopback interface)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_stats import read_interface_statistics, TunnelStatsCollector, COUNTERS
+from vtund_output_reactor import VtundOutputReactor
+import tunnel_stats
+
+import io
+import threading
+import time
+import unittest
+
+_PROC_NET_DEV = u"""Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:    1000      10    0    0    0     0          0         0     1000      10    0    0    0     0       0          0
+  tun0:12345678901   20    1    2    3     4          5         6      300       4    5    6    7     8       9         10
+"""
+
+class _FakeClock(object):
+    """ Stands in for the time module in tunnel_stats """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+class ReadInterfaceStatisticsTest(unittest.TestCase):
+
+    def _fake_files(self, files):
+        def fake_open(path, mode = 'r'):
+            if not path in files:
+                raise IOError(2, 'No such file or directory', path)
+            return io.StringIO(files[path])
+        tunnel_stats.open = fake_open
+        self.addCleanup(delattr, tunnel_stats, 'open')
+
+    def test_proc_net_dev(self):
+        self._fake_files({'/proc/net/dev': _PROC_NET_DEV})
+        statistics = read_interface_statistics()
+        self.assertEqual(sorted(statistics.keys()), ['lo', 'tun0'])
+        self.assertEqual(statistics['tun0'], (12345678901, 20, 1, 2, 300, 4, 5, 6))  # No space after the colon for large counters
+        self.assertEqual(read_interface_statistics(set(['tun0', 'tun1'])), {'tun0': statistics['tun0']})
+
+    def test_sysfs_fallback(self):
+        files = {}
+        for (counter, value) in zip(COUNTERS, range(len(COUNTERS))):
+            files['/sys/class/net/tun0/statistics/' + counter] = u'%d\n' % value
+        files['/sys/class/net/tun1/statistics/rx_bytes'] = u'1\n'   # Incomplete, ignored
+        self._fake_files(files)
+        self.assertEqual(read_interface_statistics(['tun0', 'tun1', 'tun2']), {'tun0': tuple(range(len(COUNTERS)))})
+        self.assertRaises(Exception, read_interface_statistics)
+
+    def test_real_proc_net_dev(self):
+        statistics = read_interface_statistics(['lo'])
+        self.assertEqual(list(statistics.keys()), ['lo'])
+        self.assertEqual(len(statistics['lo']), len(COUNTERS))
+
+class TunnelStatsCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _FakeClock()
+        self.statistics = {}
+        original_time = tunnel_stats.time
+        original_read = tunnel_stats.read_interface_statistics
+        tunnel_stats.time = self.clock
+        tunnel_stats.read_interface_statistics = lambda interfaces = None: dict([(interface, counters) for (interface, counters) in self.statistics.items() if interface in interfaces])
+        self.addCleanup(setattr, tunnel_stats, 'time', original_time)
+        self.addCleanup(setattr, tunnel_stats, 'read_interface_statistics', original_read)
+
+    def _sample(self, collector, rx_bytes):
+        """ Sample with tun0 at \p rx_bytes received bytes (None if the interface does not exist), 10 seconds after the previous sample
+        """
+        if rx_bytes is None:
+            self.statistics.pop('tun0', None)
+        else:
+            self.statistics['tun0'] = (rx_bytes, 1, 0, 0, 2 * rx_bytes, 1, 0, 0)
+        collector.sample()
+        self.clock.now += 10
+
+    def test_rates(self):
+        collector = TunnelStatsCollector()
+        collector.add_tunnel('tun0')
+        for rx_bytes in [0, 1000, 3000, None, 500, 1500]:  # Interface missing, then recreated (counters reset)
+            self._sample(collector, rx_bytes)
+        self.assertEqual(list(collector.get_rates('tun0', 'rx_bytes')), [100.0, 200.0, 100.0])
+        self.assertAlmostEqual(collector.get_rate('tun0', 'rx_bytes'), 4000 / 30.0)
+        self.assertAlmostEqual(collector.get_rate('tun0', 'tx_bytes'), 8000 / 30.0)
+        self.assertEqual(collector.get_rate('tun0', 'rx_errors'), 0)
+        self.assertEqual([collector.get_rate_percentile('tun0', 'rx_bytes', percentile) for percentile in [0, 50, 100]], [100.0, 100.0, 200.0])
+        self.assertRaises(Exception, collector.get_rate_percentile, 'tun0', 'rx_bytes', 101)
+        self.assertEqual(list(collector.get_rates('tun0', 'rx_bytes', window = 10)), [100.0])
+        self.assertEqual(collector.get_counters('tun0')['tx_bytes'], 3000)
+
+    def test_history_is_a_ring(self):
+        collector = TunnelStatsCollector(history_size = 3)
+        collector.add_tunnel('tun0')
+        for rx_bytes in [0, 5000, 6000, 7000, 9000]:
+            self._sample(collector, rx_bytes)
+        self.assertEqual(list(collector.get_rates('tun0', 'rx_bytes')), [100.0, 200.0])
+        self.assertRaises(Exception, TunnelStatsCollector, history_size = 1)
+        self.assertRaises(Exception, TunnelStatsCollector, interval = 0)
+
+    def test_missing_samples(self):
+        collector = TunnelStatsCollector()
+        collector.add_tunnel('tun0')
+        self.assertEqual((collector.get_counters('tun0'), collector.get_rate('tun0', 'rx_bytes')), (None, None))
+        self._sample(collector, 1000)
+        self.assertEqual(collector.get_rate('tun0', 'rx_bytes'), None)
+        self.assertEqual(collector.get_rate_percentile('tun0', 'rx_bytes', 95), None)
+        self._sample(collector, None)
+        self.assertEqual(collector.get_counters('tun0'), None)
+        try:
+            collector.get_counters('tun1')
+        except Exception as e:
+            self.assertEqual(str(e), 'TunnelNotCollected:tun1')
+        else:
+            self.fail('No exception raised')
+        collector.remove_tunnel('tun0')
+        self.assertRaises(Exception, collector.get_rates, 'tun0', 'rx_bytes')
+        self.assertRaises(Exception, collector.add_tunnel, None)
+
+class PeriodicSamplingTest(unittest.TestCase):
+
+    def test_start_and_stop(self):
+        sampled = threading.Event()
+        collector = TunnelStatsCollector(interval = 0.02, reactor = VtundOutputReactor())
+        collector.add_tunnel('lo')
+        original_sample = collector.sample
+        def sample():
+            result = original_sample()
+            if collector._sample_count >= 3:
+                sampled.set()
+            return result
+        collector.sample = sample
+        collector.start()
+        self.assertTrue(sampled.wait(5))
+        collector.stop()
+        count = collector._sample_count
+        time.sleep(0.1)
+        self.assertTrue(collector._sample_count - count <= 1)   # At most one sampling was already running
+        self.assertTrue(collector.get_counters('lo')['rx_bytes'] >= 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of tunnel_supervisor.TunnelSupervisor (run on stand-in tunnel and reactor objects, no vtund process is started)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_supervisor import TunnelSupervisor, TunnelSupervisorEvent
+
+import threading
+import unittest
+
+class _Reactor(object):
+    """ Stand-in for VtundOutputReactor, where exits are triggered by exit() and delayed calls are run right away """
+
+    def __init__(self):
+        self._callbacks = {}
+        self.delays = []
+
+    def watch_exit(self, pid, callback):
+        self._callbacks[pid] = callback
+
+    def unwatch_exit(self, pid, callback = None):
+        self._callbacks.pop(pid, None)
+
+    def call_later(self, delay, callback):
+        self.delays.append(delay)
+        callback()
+
+    def exit(self, pid):
+        self._callbacks.pop(pid)()
+
+class _Process(object):
+
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+class _Tunnel(object):
+    """ Stand-in for a tunnel object, whose start() blocks while \p release is not set (once \p blocking is set) """
+
+    def __init__(self, name):
+        self.vtun_tunnel_name = name
+        self._vtun_pid = None
+        self._vtun_process = None
+        self.next_pid = 1000
+        self.calls = []
+        self.blocking = False
+        self.starting = threading.Event()
+        self.release = threading.Event()
+
+    def start(self):
+        self.calls.append('start')
+        self._vtun_process = _Process()
+        self._vtun_pid = self.next_pid
+        self.next_pid += 1
+        if self.blocking:
+            self.starting.set()
+            self.release.wait(10)
+
+    def stop(self):
+        self.calls.append('stop')
+        if self._vtun_pid is None:
+            raise Exception('VtundNotRunning')
+        self._vtun_pid = None
+        self._vtun_process = None
+
+    def die(self):
+        """ Simulate an unexpected exit of vtund """
+        self._vtun_process.returncode = 1
+
+class TunnelSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = _Reactor()
+        self.supervisor = TunnelSupervisor(reactor = self.reactor, restart_delay = 1, backoff_factor = 2, jitter = 0)
+        self.events = []
+        self.restarted = threading.Event()
+        def listener(event):
+            self.events.append(event)
+            if event.kind == TunnelSupervisorEvent.RESTARTED:
+                self.restarted.set()
+        self.supervisor.add_listener(listener)
+
+    def _start(self):
+        tunnel = _Tunnel('t1')
+        self.addCleanup(tunnel.release.set)
+        self.supervisor.add_tunnel(tunnel)
+        self.supervisor.start_tunnel(tunnel)
+        return tunnel
+
+    def test_unexpected_exit_is_restarted(self):
+        tunnel = self._start()
+        tunnel.die()
+        self.reactor.exit(1000)
+        self.assertTrue(self.restarted.wait(5))
+        self.assertEqual(tunnel.calls, ['start', 'stop', 'start'])
+        self.assertEqual([(event.kind, event.pid, event.expected) for event in self.events], [(TunnelSupervisorEvent.EXIT, 1000, False), (TunnelSupervisorEvent.RESTARTED, 1001, False)])
+        self.restarted.clear()
+        tunnel.die()
+        self.reactor.exit(1001)
+        self.assertTrue(self.restarted.wait(5))
+        self.assertEqual(self.reactor.delays, [1, 2])   # Exponential backoff of consecutive restarts
+
+    def test_stopped_tunnel_is_not_restarted(self):
+        tunnel = self._start()
+        self.supervisor.stop_tunnel(tunnel)
+        self.assertEqual(self.reactor._callbacks, {})
+        self.assertEqual(tunnel.calls, ['start', 'stop'])
+
+    def test_stop_during_restart(self):
+        tunnel = self._start()
+        tunnel.blocking = True
+        tunnel.die()
+        self.reactor.exit(1000)
+        self.assertTrue(tunnel.starting.wait(5))    # The restart thread is now in start()
+        stopper = threading.Thread(target = self.supervisor.stop_tunnel, args = (tunnel,))
+        stopper.start()
+        stopper.join(0.2)
+        self.assertTrue(stopper.is_alive()) # Waits for the restart to complete
+        tunnel.release.set()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        self.assertEqual(tunnel.calls, ['start', 'stop', 'start', 'stop'])
+        self.assertEqual(tunnel._vtun_pid, None)    # The vtund started by the restart has been stopped
+        self.assertEqual(self.reactor._callbacks, {})
+        self.assertFalse(self.restarted.is_set())
+
+if __name__ == '__main__':
+    unittest.main()
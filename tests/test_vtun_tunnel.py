@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the vtun_tunnel.VtunTunnel attributes (no vtund process is started)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vtun_tunnel import VtunTunnel
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+from tunnel_mode import TunnelMode, get_tunnel_mode
+
+import ipaddr
+import unittest
+
+_TUNDEV_SHELL_CONFIG = """tunnel_mode: L3
+tunnel_ip_network: 192.168.100.0
+tunnel_ip_prefix: /30
+tunnel_near_end_ip: 192.168.100.1
+tunnel_far_end_ip: 192.168.100.2
+tunnel_vtun_server_tcp_port: 5000
+tunnel_name: tundev0
+tunnel_secret: secret
+"""
+
+class TunnelModeTest(unittest.TestCase):
+
+    def test_modes(self):
+        self.assertEqual([TunnelMode(mode).get_equivalent_vtun_type() for mode in ['L2', 'L3', 'L3_multi']], ['ether', 'tun', 'tun'])
+        self.assertEqual(str(TunnelMode('L3')), 'L3')
+        self.assertRaises(Exception, TunnelMode, 'L4')
+        mode = TunnelMode('L2')
+        mode.set_mode('L3')
+        self.assertEqual(mode.get_mode(), 'L3')
+        self.assertRaises(Exception, mode.set_mode, None)
+
+    def test_modes_are_shared(self):
+        self.assertTrue(get_tunnel_mode('L2') is get_tunnel_mode('L2'))
+        self.assertRaises(Exception, get_tunnel_mode, 'L4')
+        tunnels = [VtunTunnel(mode = mode, tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 't', vtun_shared_secret = 'secret') for mode in ['L3', TunnelMode('L3')]]
+        self.assertTrue(tunnels[0].tunnel_mode is tunnels[1].tunnel_mode)
+        self.assertRaises(Exception, VtunTunnel, mode = 'L3_multi', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 't', vtun_shared_secret = 'secret')
+
+class CompactTunnelTest(unittest.TestCase):
+
+    def _make_tunnel(self, tunnel_class = VtunTunnel, **kwargs):
+        tunnel_kwargs = {'mode': 'L3', 'tunnel_ip_network': '10.0.0.0/30', 'tunnel_near_end_ip': '10.0.0.1', 'tunnel_far_end_ip': '10.0.0.2', 'vtun_tunnel_name': 't', 'vtun_shared_secret': 'secret'}
+        tunnel_kwargs.update(kwargs)
+        return tunnel_class(**tunnel_kwargs)
+
+    def test_no_instance_dict(self):
+        for tunnel in [self._make_tunnel(), self._make_tunnel(ServerVtunTunnel), self._make_tunnel(ClientVtunTunnel, vtun_server_hostname = 'server')]:
+            self.assertFalse(hasattr(tunnel, '__dict__'))
+            self.assertRaises(AttributeError, setattr, tunnel, 'misspelled_attribute', 1)
+
+    def test_addresses_are_converted_when_read(self):
+        tunnel = self._make_tunnel()
+        self.assertEqual(tunnel._tunnel_near_end_ip, '10.0.0.1')    # Stored as a string until read
+        self.assertTrue(tunnel.is_valid())
+        self.assertEqual(tunnel._tunnel_near_end_ip, '10.0.0.1')
+        self.assertEqual(tunnel.tunnel_near_end_ip, ipaddr.IPv4Address('10.0.0.1'))
+        self.assertTrue(isinstance(tunnel._tunnel_near_end_ip, ipaddr.IPv4Address))
+        self.assertEqual(tunnel.tunnel_ip_network, ipaddr.IPv4Network('10.0.0.0/30'))
+        network = ipaddr.IPv4Network('10.1.0.0/30')
+        self.assertTrue(self._make_tunnel(tunnel_ip_network = network).tunnel_ip_network is network)    # ipaddr objects are shared as is
+
+    def test_addresses_are_validated_when_set(self):
+        self.assertRaises(Exception, self._make_tunnel, tunnel_near_end_ip = '10.0.0.256')
+        self.assertRaises(Exception, self._make_tunnel, tunnel_ip_network = 'not a network')
+        self.assertEqual(str(self._make_tunnel(tunnel_ip_network = '10.0.0.0/255.255.255.252').tunnel_ip_network), '10.0.0.0/30') # Not in the fast path, converted right away
+        tunnel = self._make_tunnel()
+        tunnel.tunnel_far_end_ip = '10.0.0.3'
+        self.assertEqual(tunnel._tunnel_far_end_ip, '10.0.0.3')
+        self.assertRaises(Exception, setattr, tunnel, 'tunnel_far_end_ip', '10.0.0')
+
+class TundevShellConfigTest(unittest.TestCase):
+
+    def _assert_error(self, error, **kwargs):
+        try:
+            VtunTunnel(**kwargs)
+        except Exception as e:
+            self.assertEqual(str(e), error)
+        else:
+            self.fail('No exception raised')
+
+    def test_tunnel_from_config_only(self):
+        tunnel = VtunTunnel(tundev_shell_config = _TUNDEV_SHELL_CONFIG, vtund_exec = '/usr/sbin/vtund')
+        self.assertEqual(str(tunnel.tunnel_mode), 'L3')
+        self.assertEqual(str(tunnel.tunnel_ip_network), '192.168.100.0/30')
+        self.assertEqual(str(tunnel.tunnel_near_end_ip), '192.168.100.1')
+        self.assertEqual(str(tunnel.tunnel_far_end_ip), '192.168.100.2')
+        self.assertEqual(tunnel.vtun_server_tcp_port, 5000)
+        self.assertEqual(tunnel.vtun_tunnel_name, 'tundev0')
+        self.assertEqual(tunnel.vtun_shared_secret, 'secret')
+        self.assertEqual(tunnel.vtund_exec, '/usr/sbin/vtund')
+        self.assertTrue(tunnel.is_valid())
+
+    def test_config_and_arguments_are_exclusive(self):
+        for (key, value) in [('vtun_tunnel_name', 'other'), ('vtun_shared_secret', 'other'), ('mode', 'L2'), ('tunnel_far_end_ip', '192.168.100.3'), ('vtun_server_tcp_port', 5001), ('mtu', 1400)]:
+            kwargs = {'tundev_shell_config': _TUNDEV_SHELL_CONFIG, key: value}
+            self._assert_error('SimultaneousConfigAndAgumentsNotAllowed:' + key, **kwargs)
+
+    def test_config_values_are_checked(self):
+        lines = _TUNDEV_SHELL_CONFIG.splitlines()
+        without = lambda prefix: '\n'.join([line for line in lines if not line.startswith(prefix)])
+        self._assert_error('TunnelNameMustBeProvided', tundev_shell_config = without('tunnel_name:'))
+        self._assert_error('TunnelSharedSecretMustBeProvided', tundev_shell_config = without('tunnel_secret:'))
+        self._assert_error('TunnelModeCannotBeNone', tundev_shell_config = without('tunnel_mode:'))
+        self._assert_error('SessionSharedSecretCannotBeOnlyDigits', tundev_shell_config = without('tunnel_secret:') + '\ntunnel_secret: 1234')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of vtund_config_delivery (the 'memfd' tests are skipped when memfd_create() is not available)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from vtund_config_delivery import deliver_vtund_config, adopt_vtund_config, VtundConfigFile, PrivateDirVtundConfigFile, _memfd_create
+from server_vtun_tunnel import ServerVtunTunnel
+from tcp_port_allocator import TcpPortAllocator
+from proc_net import get_listening_tcp_sockets
+from run_benchmarks import prepare_fake_vtund
+
+import shutil
+import stat
+import subprocess
+import tempfile
+import unittest
+
+_port_allocator = TcpPortAllocator(47000, 47999)
+
+_CONFIG = u'options {\n  port 5000;\n}\n'
+
+try:
+    os.close(_memfd_create('probe'))
+    _memfd_supported = True
+except Exception:
+    _memfd_supported = False
+
+class VtundConfigDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'vtund.conf')
+
+    def _read_from_child(self, path):
+        """ Read \p path from another process, like vtund does """
+        return subprocess.check_output(['cat', path]).decode('utf-8')
+
+    def test_file(self):
+        for delivery in [None, 'file']:
+            config_file = deliver_vtund_config(delivery, self.filename, _CONFIG)
+            self.assertEqual(type(config_file), VtundConfigFile)
+            self.assertEqual(config_file.path, self.filename)
+            self.assertEqual(self._read_from_child(config_file.path), _CONFIG)
+            config_file.update(_CONFIG + '# reloaded\n')
+            self.assertEqual(config_file.config, _CONFIG + '# reloaded\n')
+            config_file.close()
+            self.assertTrue(os.path.exists(self.filename))  # Kept for the next start
+
+    def test_private_dir(self):
+        config_file = deliver_vtund_config('private_dir', self.filename, _CONFIG)
+        self.assertFalse(config_file.path.startswith(self.directory))
+        self.assertEqual(os.path.basename(config_file.path), 'vtund.conf')
+        private_dir = os.path.dirname(config_file.path)
+        self.assertEqual(stat.S_IMODE(os.stat(private_dir).st_mode), 0o700)
+        self.assertEqual(self._read_from_child(config_file.path), _CONFIG)
+        config_file.close()
+        self.assertFalse(os.path.exists(private_dir))
+        config_file.close()    # Closing twice is harmless
+        self.assertFalse(os.path.exists(self.filename))
+
+    @unittest.skipIf(not _memfd_supported, 'memfd_create() is not available')
+    def test_memfd(self):
+        config_file = deliver_vtund_config('memfd', self.filename, _CONFIG)
+        self.assertTrue(config_file.path.startswith('/proc/' + str(os.getpid()) + '/fd/'))
+        self.assertEqual(self._read_from_child(config_file.path), _CONFIG)
+        config_file.update(u'options {}\n')    # Shorter, the memory file must be truncated
+        self.assertEqual(self._read_from_child(config_file.path), u'options {}\n')
+        config_file.close()
+        self.assertFalse(os.path.exists(config_file.path))
+        config_file.close()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def _assert_invalid_delivery(self, function, *args, **kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            self.assertEqual(str(e), 'InvalidConfigDelivery:pipe')
+        else:
+            self.fail('No exception raised')
+
+    def test_invalid_delivery(self):
+        self._assert_invalid_delivery(deliver_vtund_config, 'pipe', self.filename, _CONFIG)
+        self._assert_invalid_delivery(adopt_vtund_config, 'pipe', deliver_vtund_config('file', self.filename, _CONFIG).path)
+        self._assert_invalid_delivery(ServerVtunTunnel, mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 't', vtun_shared_secret = 'secret', vtund_config_delivery = 'pipe')
+
+    def test_adopt(self):
+        config_file = deliver_vtund_config('file', self.filename, _CONFIG)
+        adopted = adopt_vtund_config('file', config_file.path)
+        self.assertEqual((type(adopted), adopted.path, adopted.config), (VtundConfigFile, self.filename, _CONFIG))
+        config_file = deliver_vtund_config('private_dir', self.filename, _CONFIG)
+        self.addCleanup(config_file.close)
+        adopted = adopt_vtund_config('private_dir', config_file.path)
+        self.assertEqual((type(adopted), adopted.path, adopted.config), (PrivateDirVtundConfigFile, config_file.path, _CONFIG))
+        adopted.close()     # The adopted object now owns the private directory
+        self.assertFalse(os.path.exists(os.path.dirname(config_file.path)))
+
+    def test_adopt_unavailable(self):
+        self.assertEqual(adopt_vtund_config('memfd', '/proc/1/fd/3'), None)
+        self.assertEqual(adopt_vtund_config('file', None), None)
+        self.assertEqual(adopt_vtund_config('private_dir', os.path.join(self.directory, 'removed', 'vtund.conf')), None)
+
+class ServerConfigDeliveryTest(unittest.TestCase):
+    """ vtund (fake_vtund) started with each delivery method """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.vtund_exec = prepare_fake_vtund(cls.directory)
+        os.environ['FAKE_VTUND_PID_FILE'] = os.path.join(cls.directory, 'vtund.pid')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def _check_delivery(self, delivery):
+        server = ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = 'delivery', vtun_shared_secret = 'secret', vtun_server_tcp_port = _port_allocator.allocate(), vtund_exec = self.vtund_exec, vtund_config_delivery = delivery)
+        self.addCleanup(lambda: server._vtun_pid is not None and server.stop())
+        server.start()
+        self.assertTrue(server.vtun_server_tcp_port in get_listening_tcp_sockets())
+        path = server._vtund_config_file.path
+        server.stop()
+        self.assertEqual(server._vtund_config_file, None)
+        return path
+
+    def test_private_dir(self):
+        self.assertFalse(os.path.exists(os.path.dirname(self._check_delivery('private_dir'))))
+
+    @unittest.skipIf(not _memfd_supported, 'memfd_create() is not available')
+    def test_memfd(self):
+        self.assertFalse(os.path.exists(self._check_delivery('memfd')))
+
+if __name__ == '__main__':
+    unittest.main()
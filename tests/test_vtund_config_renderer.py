@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the vtund_config_renderer cache and of write_config_file()
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_vtun_tunnel import ServerVtunTunnel
+from client_vtun_tunnel import ClientVtunTunnel
+import vtund_config_renderer
+
+import shutil
+import stat
+import tempfile
+import unittest
+
+def _make_server(name, secret = 'secret'):
+    return ServerVtunTunnel(mode = 'L3', tunnel_ip_network = '10.0.0.0/30', tunnel_near_end_ip = '10.0.0.1', tunnel_far_end_ip = '10.0.0.2', vtun_tunnel_name = name, vtun_shared_secret = secret, vtun_server_tcp_port = 5000)
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        vtund_config_renderer.clear_cache()
+        self.addCleanup(vtund_config_renderer.clear_cache)
+
+    def test_cache_hits(self):
+        server = _make_server('cached')
+        config = server.to_vtund_config()
+        cache_size = len(vtund_config_renderer._render_cache)
+        self.assertEqual(_make_server('cached').to_vtund_config(), config)
+        self.assertEqual(len(vtund_config_renderer._render_cache), cache_size)  # Rendered from the cache
+        server.mtu = 1400
+        self.assertNotEqual(server.to_vtund_config(), config)
+        self.assertEqual(len(vtund_config_renderer._render_cache), cache_size + 1)
+
+    def test_secrets_are_not_cached(self):
+        config = _make_server('cached', 'first-secret').to_vtund_config()
+        other_config = _make_server('cached', 'second-secret').to_vtund_config()
+        self.assertTrue('\tpasswd first-secret;\n' in config)
+        self.assertEqual(other_config, config.replace('first-secret', 'second-secret'))
+        self.assertEqual(len(vtund_config_renderer._render_cache), 2)   # Options and section, shared by both secrets
+        self.assertFalse('secret' in repr(vtund_config_renderer._render_cache))
+        client = ClientVtunTunnel(from_server = _make_server('cached', 'client-secret'), vtun_server_hostname = 'server')
+        self.assertTrue('\tpasswd client-secret;\n' in client.to_vtund_config())
+        self.assertFalse('secret' in repr(vtund_config_renderer._render_cache))
+
+    def test_least_recently_used_sections_are_evicted(self):
+        max_size = vtund_config_renderer.RENDER_CACHE_MAX_SIZE
+        vtund_config_renderer.RENDER_CACHE_MAX_SIZE = 3
+        self.addCleanup(setattr, vtund_config_renderer, 'RENDER_CACHE_MAX_SIZE', max_size)
+        servers = [_make_server('t' + str(i)) for i in range(3)]
+        for server in servers[:2]:
+            server.to_vtund_config()    # Caches the options and 2 sections
+        servers[0].to_vtund_config()
+        servers[2].to_vtund_config()
+        keys = list(vtund_config_renderer._render_cache.keys())
+        self.assertEqual(len(keys), 3)
+        self.assertEqual([key[1] for key in keys if key[0] == 'server_section'], ['t0', 't2'])  # t1 was the least recently used
+
+class WriteConfigFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'vtund.conf')
+        vtund_config_renderer.clear_cache()
+
+    def test_unchanged_file_is_not_rewritten(self):
+        self.assertTrue(vtund_config_renderer.write_config_file(self.path, 'config 1\n'))
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        inode = os.stat(self.path).st_ino
+        self.assertFalse(vtund_config_renderer.write_config_file(self.path, 'config 1\n'))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertTrue(vtund_config_renderer.write_config_file(self.path, 'config 2\n'))
+        with open(self.path, 'r') as f:
+            self.assertEqual(f.read(), 'config 2\n')
+
+    def test_file_written_by_someone_else(self):
+        with open(self.path, 'w') as f:
+            f.write('config 1\n')
+        self.assertFalse(vtund_config_renderer.write_config_file(self.path, 'config 1\n'))    # Same content
+        with open(self.path, 'w') as f:
+            f.write('config 3\n')   # Same size, different content
+        self.assertTrue(vtund_config_renderer.write_config_file(self.path, 'config 1\n'))
+        with open(self.path, 'r') as f:
+            self.assertEqual(f.read(), 'config 1\n')
+
+if __name__ == '__main__':
+    unittest.main()
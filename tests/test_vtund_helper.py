@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of the vtund_helper protocol (the helper is run in a thread of the test process, with the permissions of the current user)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vtund_helper import VtundHelperServer, VtundHelperClient
+
+import json
+import select
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+_ALLOWED_EXECS = ['/bin/echo', '/bin/sleep']
+
+class VtundHelperTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.socket_path = os.path.join(cls.directory, 'helper.sock')
+        cls.server = VtundHelperServer(cls.socket_path, [os.getuid()], _ALLOWED_EXECS)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True    # serve_forever() never returns
+        thread.start()
+        deadline = time.time() + 5
+        while not os.path.exists(cls.socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.client = VtundHelperClient(self.socket_path)
+        self.addCleanup(self.client.close)
+
+    def _raw_request(self, data):
+        """ Send raw bytes to the helper on a new connection
+
+        \return The first line of the response (without its newline)
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(5)
+            sock.connect(self.socket_path)
+            sock.sendall(data)
+            response = b''
+            while not b'\n' in response:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+            return response.split(b'\n', 1)[0]
+        finally:
+            sock.close()
+
+    def _read_output(self, proc):
+        """ Read the captured output of \\p proc until EOF (its stdout is non-blocking, like when it is read by tunnel objects) """
+        output = b''
+        try:
+            while True:
+                select.select([proc.stdout], [], [], 5)
+                data = os.read(proc.stdout.fileno(), 65536)
+                if not data:
+                    return output
+                output += data
+        finally:
+            proc.stdout.close()
+
+    def _assert_error(self, commands, error):
+        try:
+            self.client.call(commands)
+        except Exception as e:
+            self.assertEqual(str(e).split(':', 1)[0], error)
+        else:
+            self.fail('No exception raised')
+
+    def test_spawn_with_captured_output(self):
+        proc = self.client.popen(['/bin/echo', 'hello'], True)
+        self.assertEqual(self._read_output(proc), b'hello\n')
+        self.assertEqual(proc.wait(), 0)
+        self.assertEqual(proc._fifo_dir, None)  # The FIFO has been removed
+
+    def test_batched_signals(self):
+        procs = [self.client.popen(['/bin/sleep', '10']) for i in range(2)]
+        self.assertEqual([proc.poll() for proc in procs], [None, None])
+        self.client.send_signals([procs[0].pid, -procs[1].pid], signal.SIGTERM)
+        self.assertEqual([proc.wait() for proc in procs], [-signal.SIGTERM, -signal.SIGTERM])
+        self._assert_error([{'cmd': 'poll', 'pid': procs[0].pid}], 'UnknownProcess')   # The exit value is only reported once
+
+    def test_exec_not_allowed(self):
+        self._assert_error([{'cmd': 'spawn', 'args': ['/bin/cat']}], 'ExecNotAllowed')
+        self._assert_error([{'cmd': 'spawn', 'args': []}], 'ExecNotAllowed')
+
+    def test_only_spawned_processes_can_be_signalled(self):
+        self._assert_error([{'cmd': 'signal', 'pid': os.getpid(), 'signal': 0}], 'UnknownProcess')
+        self._assert_error([{'cmd': 'poll', 'pid': os.getpid()}], 'UnknownProcess')
+
+    def test_stdout_must_be_a_fifo_of_the_client(self):
+        path = os.path.join(self.directory, 'regular')
+        open(path, 'w').close()
+        self._assert_error([{'cmd': 'spawn', 'args': ['/bin/echo'], 'stdout': path}], 'StdoutIsNotAFifo')
+        self._assert_error([{'cmd': 'spawn', 'args': ['/bin/echo'], 'stdout': '/dev/null'}], 'StdoutIsNotAFifo')
+        fifo_path = os.path.join(self.directory, 'fifo')
+        os.mkfifo(fifo_path, 0o600)
+        link_path = os.path.join(self.directory, 'link')
+        os.symlink(fifo_path, link_path)
+        self.assertRaises(Exception, self.client.call, [{'cmd': 'spawn', 'args': ['/bin/echo'], 'stdout': link_path}])
+        try:
+            self.server._open_stdout_fifo(fifo_path, os.getuid() + 1)  # Owned by another user
+        except Exception as e:
+            self.assertEqual(str(e), 'StdoutIsNotAFifo')
+        else:
+            self.fail('No exception raised')
+
+    def test_invalid_requests(self):
+        self.assertEqual(json.loads(self._raw_request(b'not json\n').decode('utf-8')), {'error': 'InvalidRequest'})
+        self._assert_error([{'cmd': 'reboot'}], 'UnknownCommand')
+        results = json.loads(self._raw_request(b'{"commands": [{"cmd": "reboot"}, {"cmd": "spawn", "args": ["/bin/cat"]}]}\n').decode('utf-8'))['results']
+        self.assertEqual([result['ok'] for result in results], [False, False])  # Each command of a batch gets its own result
+
+    def test_unauthorized_peer_is_dropped(self):
+        server = VtundHelperServer(os.path.join(self.directory, 'other.sock'), [], _ALLOWED_EXECS)
+        server._get_peer_uid = lambda conn: -1
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + 5
+        while not os.path.exists(server.socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+        client = VtundHelperClient(server.socket_path)
+        self.assertRaises(Exception, client.call, [{'cmd': 'poll', 'pid': 1}])
+        client.close()
+
+    def test_misbehaving_clients_do_not_block_others(self):
+        reset = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        reset.connect(self.socket_path)
+        reset.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        reset.sendall(b'{"commands": [{"cmd": "poll", "pid": 1}]}\n')
+        reset.close()   # Resets the connection before the response is sent
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(self.socket_path)
+        slow.setblocking(False)
+        request = b'{"commands": [' + b','.join([b'{"cmd": "poll", "pid": 1}'] * 200) + b']}\n'
+        try:
+            for i in range(2000):   # Requests, without ever reading responses
+                slow.send(request)
+        except socket.error:
+            pass
+        try:
+            start = time.time()
+            proc = self.client.popen(['/bin/echo', 'still served'], True)
+            self.assertEqual(self._read_output(proc), b'still served\n')
+            self.assertEqual(proc.wait(), 0)
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            slow.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Tests of vtund_output_reactor.VtundOutputReactor (each test runs its own reactor)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vtund_output_reactor import VtundOutputReactor
+import vtund_output_reactor
+
+import subprocess
+import threading
+import time
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+class VtundOutputReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = VtundOutputReactor()
+        self.event = threading.Event()
+
+    def _pipe(self):
+        (read_fd, write_fd) = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        return (read_fd, write_fd)
+
+    def test_pipe_data_and_eof(self):
+        (read_fd, write_fd) = self._pipe()
+        chunks = []
+        self.reactor.register(read_fd, chunks.append, self.event.set)
+        self.assertEqual(self.reactor.get_registered_count(), 1)
+        self.assertRaises(Exception, self.reactor.register, read_fd, chunks.append, self.event.set)
+        os.write(write_fd, b'Connecting\n')
+        os.write(write_fd, b'Session opened\n')
+        os.close(write_fd)
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(b''.join(chunks), b'Connecting\nSession opened\n')
+        self.assertEqual(self.reactor.get_registered_count(), 0)  # Unregistered before the EOF callback
+
+    def test_unregister(self):
+        (read_fd, write_fd) = self._pipe()
+        eofs = []
+        self.reactor.register(read_fd, lambda data: None, lambda: eofs.append(read_fd))
+        self.reactor.unregister(read_fd)
+        os.close(write_fd)
+        self.reactor.call_later(0.05, self.event.set)
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(eofs, [])
+
+    def test_call_later_order(self):
+        calls = []
+        self.reactor.call_later(0.1, lambda: calls.append('late'))
+        self.reactor.call_later(0.05, lambda: calls.append('first'))
+        self.reactor.call_later(0.05, lambda: calls.append('second'))
+        self.reactor.call_later(0, lambda: calls.append('now'))
+        self.reactor.call_later(0.15, self.event.set)
+        start = time.time()
+        self.assertTrue(self.event.wait(5))
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(calls, ['now', 'first', 'second', 'late'])
+
+    def test_failing_callback_does_not_stop_the_reactor(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        self.addCleanup(setattr, sys, 'stderr', stderr)
+        self.reactor.call_later(0, lambda: 1 / 0)
+        self.reactor.call_later(0.01, self.event.set)
+        self.assertTrue(self.event.wait(5))
+        self.assertTrue('ZeroDivisionError' in sys.stderr.getvalue())
+
+    def _check_watch_exit(self):
+        proc = subprocess.Popen(['sleep', '0.1'])
+        self.addCleanup(proc.wait)
+        exits = []
+        self.reactor.watch_exit(proc.pid, lambda: exits.append(1))
+        self.reactor.watch_exit(proc.pid, self.event.set)
+        removed = lambda: exits.append('removed')
+        self.reactor.watch_exit(proc.pid, removed)
+        self.reactor.unwatch_exit(proc.pid, removed)
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(exits, [1])
+        self.assertEqual(self.reactor._exit_watches, {})
+        self.assertEqual(self.reactor.get_registered_count(), 0)  # The pidfd (if any) has been unregistered
+
+    def test_watch_exit(self):
+        self._check_watch_exit()
+
+    def test_watch_exit_without_pidfd(self):
+        original = vtund_output_reactor.pidfd_open
+        vtund_output_reactor.pidfd_open = lambda pid: None   # Like on kernels older than 5.3
+        self.addCleanup(setattr, vtund_output_reactor, 'pidfd_open', original)
+        self._check_watch_exit()
+
+    def test_unwatch_exit(self):
+        proc = subprocess.Popen(['sleep', '0.05'])
+        self.addCleanup(proc.wait)
+        self.reactor.watch_exit(proc.pid, self.event.set)
+        self.reactor.unwatch_exit(proc.pid)
+        proc.wait()
+        time.sleep(0.05)
+        self.assertFalse(self.event.is_set())
+        self.assertEqual(self.reactor.get_registered_count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
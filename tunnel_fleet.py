@@ -0,0 +1,284 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from server_vtun_tunnel import ServerVtunTunnel
+
+import heapq
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+class TunnelFleetResult(object):
+    """ Class representing the outcome of an operation (start, stop or restart) on one tunnel of a fleet """
+
+    def __init__(self, tunnel, operation):
+        """ Constructor
+
+        \param tunnel The VtunTunnel object on which the operation is run
+        \param operation A string containing the name of the operation ('start', 'stop' or 'restart')
+        """
+        self.tunnel = tunnel
+        self.operation = operation
+        self.error = None   # The exception raised by the operation (or an Exception('TunnelOperationTimeout')), None on success
+        self.duration = None    # The time (in seconds) the operation took, from its admission (see TunnelFleet), None if it timed out before being run
+        self.completed = False
+        self.timed_out = False  # True if the operation has been reported as timed out (it then keeps running in its worker thread, see finished)
+        self.finished = False   # True once the operation has actually returned (possibly after having been reported as timed out)
+        self.final_error = None # The exception raised by the operation once finished (None if it succeeded): for an operation that timed out, this tells whether it later succeeded (a tunnel may then be running although its start timed out)
+        self._started_at = None # The time the operation was admitted
+        self._deadline = None   # The time the current phase of the operation times out
+
+    def is_success(self):
+        """ Check if the operation succeeded
+
+        \return True if the operation completed without error
+        """
+        return self.completed and self.error is None
+
+    def __repr__(self):
+        if not self.completed:
+            status = 'pending'
+        elif self.error is None:
+            status = 'ok'
+        else:
+            status = 'error: ' + str(self.error)
+        return '<TunnelFleetResult ' + self.operation + ' ' + str(self.tunnel.vtun_tunnel_name) + ' ' + status + '>'
+
+class _TokenBucket(object):
+    """ Rate limiter allowing at most \p rate acquisitions per second, with bursts of at most \p burst """
+
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = self._burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+class TunnelFleet(object):
+    """ Class allowing to start and stop many ClientVtunTunnel and ServerVtunTunnel objects concurrently
+
+    Operations are run on a bounded pool of worker threads. An optional rate limit (admission control) prevents a mass start or restart from launching too many vtund (and sudo) processes at once.
+    Bulk operations never abort on the first failure: they return one TunnelFleetResult per tunnel
+    """
+
+    MAX_WORKERS = 16
+
+    def __init__(self, **kwargs):
+        """ Constructor
+
+        \param tunnels (optional) A list of VtunTunnel objects to manage
+        \param max_workers (optional) The maximum number of operations run concurrently (defaults to MAX_WORKERS)
+        \param max_operations_per_second (optional) The maximum number of tunnel operations (start or stop) launched per second (no limit if None, the default)
+        \param max_operations_burst (optional) The number of operations that can be launched at once before \p max_operations_per_second applies (defaults to max_workers)
+        \param operation_timeout (optional) The default maximum time (in seconds) an operation on one tunnel may take (no limit if None, the default)
+        """
+        self._tunnels = list(kwargs.get('tunnels', []))
+        self.max_workers = int(kwargs.get('max_workers', TunnelFleet.MAX_WORKERS))
+        if self.max_workers <= 0:
+            raise Exception('InvalidMaxWorkers:' + str(self.max_workers))
+        self.operation_timeout = kwargs.get('operation_timeout', None)
+        max_operations_per_second = kwargs.get('max_operations_per_second', None)
+        if max_operations_per_second is None:
+            self._rate_limiter = None
+        else:
+            self._rate_limiter = _TokenBucket(max_operations_per_second, kwargs.get('max_operations_burst', self.max_workers))
+
+    def add_tunnel(self, tunnel):
+        """ Add a tunnel to the fleet
+
+        \param tunnel A ClientVtunTunnel or ServerVtunTunnel object
+        """
+        self._tunnels.append(tunnel)
+
+    def remove_tunnel(self, tunnel):
+        """ Remove a tunnel from the fleet (the tunnel is not stopped)
+
+        \param tunnel A tunnel previously added to the fleet
+        """
+        self._tunnels.remove(tunnel)
+
+    def get_tunnels(self):
+        """ Get all tunnels of the fleet
+
+        \return A list of VtunTunnel objects
+        """
+        return list(self._tunnels)
+
+    def start_all(self, tunnels = None, timeout = None):
+        """ Start tunnels concurrently
+
+        \param tunnels (optional) The tunnels to start (defaults to all tunnels of the fleet)
+        \param timeout (optional) The maximum time (in seconds) each start may take (defaults to the operation_timeout attribute). The start() method of ClientVtunTunnel objects is not given \p timeout: it only spawns vtund, without waiting for the connection (see ClientVtunTunnel.wait_until_connected())
+
+        \return A list of TunnelFleetResult objects, in the same order as \p tunnels
+        """
+        return self._run('start', tunnels, timeout)
+
+    def stop_all(self, tunnels = None, timeout = None):
+        """ Stop tunnels concurrently
+
+        \param tunnels (optional) The tunnels to stop (defaults to all tunnels of the fleet)
+        \param timeout (optional) The maximum time (in seconds) each stop may take (defaults to the operation_timeout attribute)
+
+        \return A list of TunnelFleetResult objects, in the same order as \p tunnels
+        """
+        return self._run('stop', tunnels, timeout)
+
+    def restart_all(self, tunnels = None, timeout = None):
+        """ Restart (stop then start) tunnels concurrently
+
+        \param tunnels (optional) The tunnels to restart (defaults to all tunnels of the fleet)
+        \param timeout (optional) The maximum time (in seconds) the stop and the start of each restart may take, each one (so a restart may take up to twice \p timeout, not counting the time waiting for admission). Defaults to the operation_timeout attribute
+
+        \return A list of TunnelFleetResult objects, in the same order as \p tunnels
+        """
+        return self._run('restart', tunnels, timeout)
+
+    def _run_operation(self, result, timeout, admitted):
+        """ Run one operation on one tunnel (called from a worker thread)
+
+        \param admitted A function to call with \p result and True each time a phase of the operation (stop or start) has been admitted by the rate limiter, which (re)arms its timeout, and with False before waiting for admission, which suspends it
+        """
+        tunnel = result.tunnel
+        if result.operation in ['stop', 'restart']:
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            admitted(result, True)
+            if timeout is not None:
+                tunnel.stop(timeout = timeout)    # SIGKILL is sent to vtund if it has not exitted in time
+            else:
+                tunnel.stop()
+        if result.operation in ['start', 'restart']:
+            if self._rate_limiter is not None:
+                admitted(result, False)
+                self._rate_limiter.acquire()
+            admitted(result, True)
+            if isinstance(tunnel, ServerVtunTunnel) and timeout is not None:
+                tunnel.start(timeout = timeout)   # Let vtund be cleaned up by start() itself if it is not ready in time
+            else:
+                tunnel.start()
+
+    def _run(self, operation, tunnels, timeout):
+        """ Run \p operation on \p tunnels on the worker pool, and wait until each operation completed or timed out
+
+        The timeout of an operation only runs once it has been admitted by the rate limiter (waiting for admission does not count). Operations that time out cannot be interrupted: they are reported as failed with an Exception('TunnelOperationTimeout') but keep running in their worker thread (see TunnelFleetResult.finished)
+        Once every worker is blocked on an operation that timed out, the operations still waiting for a worker are also reported as timed out if no worker became available within the timeout (they are then never run)
+
+        \return A list of TunnelFleetResult objects, in the same order as \p tunnels
+        """
+        if tunnels is None:
+            tunnels = self._tunnels
+        if timeout is None:
+            timeout = self.operation_timeout
+        results = [TunnelFleetResult(tunnel, operation) for tunnel in tunnels]
+        if not results:
+            return results
+
+        pending = queue.Queue()
+        for result in results:
+            pending.put(result)
+        done = threading.Condition()
+        deadlines = []  # Heap of (deadline, sequence number, result), entries whose deadline is not the current one of their result are stale
+        workers = min(self.max_workers, len(results))
+        state = {'remaining': len(results), 'sequence': 0, 'blocked': 0, 'stalled_at': None} # blocked is the number of workers still running an operation that timed out, stalled_at the time all workers became blocked
+
+        def admitted(result, is_admitted):
+            with done:
+                if not is_admitted:
+                    result._deadline = None # Waiting for admission does not count
+                    return
+                now = time.time()
+                if result._started_at is None:
+                    result._started_at = now
+                if timeout is not None and not result.completed:
+                    result._deadline = now + timeout
+                    state['sequence'] += 1
+                    heapq.heappush(deadlines, (result._deadline, state['sequence'], result))
+                    done.notify_all()   # The new deadline may be the nearest one
+
+        def worker():
+            while True:
+                try:
+                    result = pending.get_nowait()
+                except queue.Empty:
+                    return
+                error = None
+                try:
+                    self._run_operation(result, timeout, admitted)
+                except Exception as e:
+                    error = e
+                with done:
+                    result.finished = True
+                    result.final_error = error
+                    if result.timed_out:
+                        state['blocked'] -= 1   # This worker is available again
+                    if not result.completed: # The result may already have been reported as timed out
+                        result.error = error
+                        result.duration = time.time() - (result._started_at or time.time())
+                        result.completed = True
+                        state['remaining'] -= 1
+                    done.notify_all()
+
+        for i in range(workers):
+            thread = threading.Thread(target = worker)
+            thread.daemon = True    # A worker stuck on a timed out operation should not prevent the main program from exiting
+            thread.start()
+
+        with done:
+            while state['remaining'] > 0:
+                now = time.time()
+                while deadlines and deadlines[0][0] <= now:
+                    (deadline, sequence, result) = heapq.heappop(deadlines)
+                    if result.completed or result._deadline != deadline:
+                        continue    # Stale entry
+                    result.error = Exception('TunnelOperationTimeout')
+                    result.duration = now - result._started_at
+                    result.completed = True
+                    result.timed_out = True
+                    state['remaining'] -= 1
+                    state['blocked'] += 1
+                if state['blocked'] < workers:
+                    state['stalled_at'] = None
+                elif state['stalled_at'] is None:
+                    state['stalled_at'] = now
+                elif now >= state['stalled_at'] + timeout:  # No worker will run the operations still queued anytime soon
+                    while True:
+                        try:
+                            result = pending.get_nowait()
+                        except queue.Empty:
+                            break
+                        result.error = Exception('TunnelOperationTimeout')
+                        result.final_error = result.error
+                        result.completed = True
+                        result.timed_out = True
+                        result.finished = True  # The operation will never be run
+                        state['remaining'] -= 1
+                if state['remaining'] == 0:
+                    break
+                wake_up_at = [deadlines[0][0]] if deadlines else []
+                if state['stalled_at'] is not None:
+                    wake_up_at.append(state['stalled_at'] + timeout)
+                if wake_up_at:
+                    done.wait(max(0, min(wake_up_at) - now))
+                else:
+                    done.wait()
+        return results
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import array
+import base64
+import json
+import os
+import threading
+
+import ipaddr
+
+class TunnelIpAllocator(object):
+    """ Class carving an IPv4 network into point-to-point subnets (/30 or /31) to be used as tunnel_ip_network for tunnels
+
+    Allocation state is kept in a bitmap (one bit per subnet). Released subnets are reused first (from a stack), untouched subnets are then handed out in increasing order, so that allocate() and release() are O(1) whatever the size of the pool
+    With autosave, each operation is appended to a journal (the persistence file name followed by JOURNAL_SUFFIX) rather than rewriting the whole state, which is only rewritten (compacted) once the journal has as many entries as the bitmap has bytes, so that saving also costs O(1) per operation on average
+    """
+
+    JOURNAL_SUFFIX = '.journal'
+    COMPACT_MIN_ENTRIES = 1024  # Minimum number of journal entries before the state is compacted
+
+    # Operations recorded in the journal, each line being '<operation> <index> <sequence number>'
+    _OP_ALLOCATE = 'A'
+    _OP_RESERVE = 'R'
+    _OP_RELEASE = 'F'
+
+    def __init__(self, network, prefixlen = 30, **kwargs):
+        """ Constructor
+
+        \param network A string or an ipaddr.IPv4Network object containing the IP network range to carve tunnel subnets from
+        \param prefixlen The prefix length of each tunnel subnet (30 or 31)
+        \param persistence_file (optional) The path of a file in which the allocation state is saved by save(). If this file (or its journal) exists, the state is loaded from it
+        \param autosave (optional) If True, each allocation, reservation or release is saved right away, in the journal of \p persistence_file (False by default)
+        """
+        self.network = ipaddr.IPv4Network(str(network))
+        if not prefixlen in [30, 31]:
+            raise Exception('UnsupportedPrefixLength:' + str(prefixlen))
+        if self.network.prefixlen > prefixlen:
+            raise Exception('NetworkTooSmall:' + str(self.network))
+        self.prefixlen = prefixlen
+        self.persistence_file = kwargs.get('persistence_file', None)
+        self.autosave = kwargs.get('autosave', False)
+        if self.autosave and self.persistence_file is None:
+            raise Exception('AutosaveRequiresPersistenceFile')
+
+        self._base = int(self.network.network)
+        self._host_bits = 32 - prefixlen
+        self._size = 1 << (prefixlen - self.network.prefixlen)  # Number of tunnel subnets in the pool
+        self._bitmap = bytearray((self._size + 7) // 8)
+        self._allocated_count = 0
+        self._released = array.array('L')   # Indexes of released subnets, reused first (may contain indexes reserved since, that are skipped)
+        self._cursor = 0    # All subnets from this index are untouched since the pool was created (or loaded), apart from reserved ones
+        self._lock = threading.Lock()
+        self._sequence = 0  # Number of operations applied since the pool was created, numbering the journal entries
+        self._journal_file = None
+        self._journal_entries = 0
+
+        if self.persistence_file is not None:
+            if os.path.exists(self.persistence_file):
+                self._load()
+            self._replay_journal()
+
+    def _is_set(self, index):
+        return self._bitmap[index >> 3] & (1 << (index & 7))
+
+    def _to_index(self, tunnel_ip_network):
+        """ Get the index in the pool of a tunnel subnet
+        """
+        tunnel_ip_network = ipaddr.IPv4Network(str(tunnel_ip_network))
+        if tunnel_ip_network.prefixlen != self.prefixlen or not tunnel_ip_network in self.network:
+            raise Exception('NetworkNotInPool:' + str(tunnel_ip_network))
+        offset = int(tunnel_ip_network.network) - self._base
+        if offset & ((1 << self._host_bits) - 1):
+            raise Exception('NetworkNotInPool:' + str(tunnel_ip_network))
+        return offset >> self._host_bits
+
+    def _to_addresses(self, index):
+        """ Get the tunnel subnet at \p index in the pool
+
+        \return A tuple (tunnel_ip_network, first_ip, second_ip) of ipaddr objects
+        """
+        network_ip = self._base + (index << self._host_bits)
+        if self.prefixlen == 31:    # RFC 3021, both addresses are usable
+            first_ip = network_ip
+        else:
+            first_ip = network_ip + 1
+        return (ipaddr.IPv4Network(str(ipaddr.IPv4Address(network_ip)) + '/' + str(self.prefixlen)), ipaddr.IPv4Address(first_ip), ipaddr.IPv4Address(first_ip + 1))
+
+    def allocate(self):
+        """ Allocate a tunnel subnet
+
+        \return A tuple (tunnel_ip_network, first_ip, second_ip) of ipaddr objects. By convention, the server end of the tunnel uses first_ip. If the pool is exhausted, a 'TunnelIpPoolExhausted' exception is raised
+        """
+        with self._lock:
+            index = None
+            while self._released:
+                candidate = self._released.pop()
+                if not self._is_set(candidate):
+                    index = candidate
+                    break
+            if index is None:
+                while self._cursor < self._size and self._is_set(self._cursor):   # Skip subnets reserved ahead of the cursor
+                    if self._bitmap[self._cursor >> 3] == 0xff:
+                        self._cursor = (self._cursor | 7) + 1
+                    else:
+                        self._cursor += 1
+                if self._cursor >= self._size:
+                    raise Exception('TunnelIpPoolExhausted')
+                index = self._cursor
+                self._cursor += 1
+            self._bitmap[index >> 3] |= (1 << (index & 7))
+            self._allocated_count += 1
+            self._record(TunnelIpAllocator._OP_ALLOCATE, index)
+        return self._to_addresses(index)
+
+    def reserve(self, tunnel_ip_network):
+        """ Mark a tunnel subnet as used (for example for tunnels configured before the allocator was created)
+
+        \param tunnel_ip_network A string or an ipaddr.IPv4Network object containing the tunnel subnet. If it is already allocated, a 'NetworkAlreadyAllocated' exception is raised
+        """
+        index = self._to_index(tunnel_ip_network)
+        with self._lock:
+            if self._is_set(index):
+                raise Exception('NetworkAlreadyAllocated:' + str(tunnel_ip_network))
+            self._bitmap[index >> 3] |= (1 << (index & 7))
+            self._allocated_count += 1
+            self._record(TunnelIpAllocator._OP_RESERVE, index)
+
+    def release(self, tunnel_ip_network):
+        """ Give a tunnel subnet back to the pool
+
+        \param tunnel_ip_network A string or an ipaddr.IPv4Network object containing a tunnel subnet previously returned by allocate(). If it is not allocated, a 'NetworkNotAllocated' exception is raised
+        """
+        index = self._to_index(tunnel_ip_network)
+        with self._lock:
+            if not self._is_set(index):
+                raise Exception('NetworkNotAllocated:' + str(tunnel_ip_network))
+            self._bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+            self._allocated_count -= 1
+            self._released.append(index)
+            self._record(TunnelIpAllocator._OP_RELEASE, index)
+
+    def is_allocated(self, tunnel_ip_network):
+        """ Check if a tunnel subnet is in use
+
+        \param tunnel_ip_network A string or an ipaddr.IPv4Network object containing the tunnel subnet
+
+        \return True if \p tunnel_ip_network is allocated or reserved
+        """
+        return bool(self._is_set(self._to_index(tunnel_ip_network)))
+
+    def get_free_count(self):
+        """ Get the number of tunnel subnets that can still be allocated
+
+        \return An int
+        """
+        return self._size - self._allocated_count
+
+    def get_tunnel_kwargs(self):
+        """ Allocate a tunnel subnet and get it as keyword arguments for the constructor of a server tunnel (ServerVtunTunnel or ServerVtunTunnelPool tunnels)
+
+        Client tunnels created with ClientVtunTunnel(from_server=...) automatically get the reverse addressing
+
+        \return A dict containing the tunnel_ip_network, tunnel_near_end_ip and tunnel_far_end_ip keys
+        """
+        (tunnel_ip_network, first_ip, second_ip) = self.allocate()
+        return {'tunnel_ip_network': tunnel_ip_network, 'tunnel_near_end_ip': first_ip, 'tunnel_far_end_ip': second_ip}
+
+    def assign_to(self, tunnel):
+        """ Allocate a tunnel subnet and set it as the addressing of an existing tunnel
+
+        \param tunnel A VtunTunnel object (the near end gets the first address if it is a server, the second one otherwise)
+        """
+        from server_vtun_tunnel import ServerVtunTunnel    # Imported here, as server_vtun_tunnel does not depend on this module
+        (tunnel_ip_network, first_ip, second_ip) = self.allocate()
+        tunnel.tunnel_ip_network = tunnel_ip_network
+        if isinstance(tunnel, ServerVtunTunnel):
+            (tunnel.tunnel_near_end_ip, tunnel.tunnel_far_end_ip) = (first_ip, second_ip)
+        else:
+            (tunnel.tunnel_near_end_ip, tunnel.tunnel_far_end_ip) = (second_ip, first_ip)
+
+    def release_from(self, tunnel):
+        """ Give the tunnel subnet of a tunnel back to the pool
+
+        \param tunnel A VtunTunnel object whose addressing has been allocated from this pool
+        """
+        self.release(tunnel.tunnel_ip_network)
+
+    def save(self):
+        """ Save the allocation state to the persistence file (atomically, the previous state is kept if we fail), and empty its journal
+        """
+        if self.persistence_file is None:
+            raise Exception('NoPersistenceFile')
+        with self._lock:
+            self._save()
+
+    def close(self):
+        """ Close the journal (it is reopened by the next operation if autosave is enabled)
+        """
+        with self._lock:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+    def _record(self, operation, index):
+        """ Count an operation, and append it to the journal if autosave is enabled (called with the lock held)
+        """
+        self._sequence += 1
+        if not self.autosave:
+            return
+        if self._journal_entries >= max(TunnelIpAllocator.COMPACT_MIN_ENTRIES, len(self._bitmap)):
+            self._save()
+            return
+        try:
+            if self._journal_file is None:
+                self._journal_file = open(self.persistence_file + TunnelIpAllocator.JOURNAL_SUFFIX, 'a')
+            self._journal_file.write(operation + ' ' + str(index) + ' ' + str(self._sequence) + '\n')
+            self._journal_file.flush()
+        except (IOError, OSError):
+            raise Exception('PersistenceFileWritingIssue')
+        self._journal_entries += 1
+
+    def _save(self):
+        state = {'network': str(self.network), 'prefixlen': self.prefixlen, 'bitmap': base64.b64encode(bytes(self._bitmap)).decode('ascii'), 'cursor': self._cursor, 'released': self._released.tolist(), 'sequence': self._sequence}
+        tmp_filename = self.persistence_file + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_filename, self.persistence_file)
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            open(self.persistence_file + TunnelIpAllocator.JOURNAL_SUFFIX, 'w').close() # Entries up to our sequence number are now part of the state (they would be skipped anyway if we crash before truncating)
+        except (IOError, OSError):
+            raise Exception('PersistenceFileWritingIssue')
+        self._journal_entries = 0
+
+    def _load(self):
+        try:
+            with open(self.persistence_file, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            raise Exception('PersistenceFileReadingIssue')
+        if ipaddr.IPv4Network(state['network']) != self.network or state['prefixlen'] != self.prefixlen:
+            raise Exception('PersistenceFileMismatch:' + str(self.persistence_file))
+        bitmap = bytearray(base64.b64decode(state['bitmap'].encode('ascii')))
+        if len(bitmap) != len(self._bitmap):
+            raise Exception('PersistenceFileMismatch:' + str(self.persistence_file))
+        self._bitmap = bitmap
+        self._allocated_count = sum(bin(byte).count('1') for byte in bitmap)
+        self._cursor = state.get('cursor', 0)   # Files saved by previous versions only contain the bitmap
+        self._released = array.array('L', state.get('released', []))
+        self._sequence = state.get('sequence', 0)
+
+    def _replay_journal(self):
+        """ Apply the journal entries that are more recent than the loaded state
+        """
+        try:
+            f = open(self.persistence_file + TunnelIpAllocator.JOURNAL_SUFFIX, 'r')
+        except IOError:
+            return  # No journal
+        with f:
+            for line in f:
+                fields = line.split()
+                if not line.endswith('\n') or len(fields) != 3:
+                    break   # Last line partially written before a crash
+                try:
+                    (operation, index, sequence) = (fields[0], int(fields[1]), int(fields[2]))
+                except ValueError:
+                    raise Exception('PersistenceFileReadingIssue')
+                if sequence <= self._sequence:
+                    continue    # Already part of the state
+                mask = 1 << (index & 7)
+                if operation == TunnelIpAllocator._OP_RELEASE:
+                    self._bitmap[index >> 3] &= ~mask & 0xff
+                    self._allocated_count -= 1
+                    self._released.append(index)
+                else:
+                    if operation == TunnelIpAllocator._OP_ALLOCATE:
+                        if index >= self._cursor:   # Allocated from the untouched subnets
+                            self._cursor = index + 1
+                        else:   # Allocated from the released ones, allocate() popped the stack until it found it
+                            while self._released and self._released.pop() != index:
+                                pass
+                    self._bitmap[index >> 3] |= mask
+                    self._allocated_count += 1
+                self._sequence = sequence
+                self._journal_entries += 1
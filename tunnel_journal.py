@@ -0,0 +1,326 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" On-disk journal of the running tunnels, allowing a restarted program to take over the vtund processes still running instead of restarting them all
+
+The journal is a file of JSON lines, one line being appended for each tunnel start or stop. It is compacted (rewritten atomically with only the running tunnels) once it contains too many stale lines.
+As it contains the tunnel definitions (including shared secrets), it is only readable by its owner
+"""
+
+from __future__ import print_function
+
+from client_vtun_tunnel import ClientVtunTunnel
+from server_vtun_tunnel import ServerVtunTunnel
+from process_teardown import get_process_identity, AdoptedProcess
+from vtund_config_delivery import adopt_vtund_config
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+_CONSTRUCTOR_KEYS = ['vtund_exec', 'vtund_use_sudo', 'vtund_config_delivery', 'vtun_tunnel_name', 'vtun_shared_secret', 'vtun_server_tcp_port', 'mtu']    # Tunnel attributes given as is to the constructor
+_IP_KEYS = ['tunnel_ip_network', 'tunnel_near_end_ip', 'tunnel_far_end_ip']
+_ATTRIBUTE_KEYS = ['tuning_profile', 'interface_name', 'up_additional_commands', 'down_additional_commands']  # Tunnel attributes set after construction (the tuning profile is only recorded by name, its settings are part of the constructor attributes)
+_SERVER_CONSTRUCTOR_KEYS = ['vtun_protocol', 'vtun_compression', 'vtun_encryption', 'vtun_keepalive', 'vtund_start_timeout']
+_SERVER_ATTRIBUTE_KEYS = ['restricted_iface']
+_CLIENT_CONSTRUCTOR_KEYS = ['vtun_server_hostname', 'vtun_protocol', 'vtun_compression', 'vtun_encryption', 'vtun_keepalive', 'vtun_connection_timeout', 'vtund_output_max_size']
+
+def get_tunnel_kind(tunnel):
+    """ Get the kind of a tunnel, as recorded in the journal
+
+    \return 'client' or 'server'
+    """
+    if isinstance(tunnel, ClientVtunTunnel):
+        return 'client'
+    elif isinstance(tunnel, ServerVtunTunnel):
+        return 'server'
+    else:
+        raise Exception('WrongTunnelObject')
+
+def get_tunnel_key(tunnel):
+    """ Get the key identifying a tunnel in the journal (clients are also identified by the server they connect to, as the same tunnel name may be used with several servers)
+
+    \return A string
+    """
+    kind = get_tunnel_kind(tunnel)
+    if kind == 'client':
+        return kind + ':' + str(tunnel.vtun_tunnel_name) + '@' + str(tunnel.vtun_server_hostname) + ':' + str(tunnel.vtun_server_tcp_port)
+    return kind + ':' + str(tunnel.vtun_tunnel_name)
+
+def get_tunnel_definition(tunnel):
+    """ Get the attributes defining a tunnel, in a form that can be serialized in JSON (the vtund_helper and vtund_output_reactor attributes are not part of it)
+
+    \return A dict
+    """
+    kind = get_tunnel_kind(tunnel)
+    keys = _CONSTRUCTOR_KEYS + _ATTRIBUTE_KEYS
+    if kind == 'server':
+        keys = keys + _SERVER_CONSTRUCTOR_KEYS + _SERVER_ATTRIBUTE_KEYS
+    else:
+        keys = keys + _CLIENT_CONSTRUCTOR_KEYS
+    definition = {}
+    for key in keys:
+        definition[key] = getattr(tunnel, key)
+    definition['mode'] = str(tunnel.tunnel_mode)
+    for key in _IP_KEYS:
+        value = getattr(tunnel, '_' + key)  # Raw value, without creating ipaddr objects
+        definition[key] = str(value) if value is not None else None
+    return definition
+
+def make_tunnel(kind, definition, server_class = ServerVtunTunnel, client_class = ClientVtunTunnel, **kwargs):
+    """ Create a tunnel object from a definition returned by get_tunnel_definition()
+
+    \param kind 'client' or 'server'
+    \param definition The dict returned by get_tunnel_definition()
+    \param server_class (optional) The class of server tunnel objects
+    \param client_class (optional) The class of client tunnel objects
+    \param kwargs Other constructor arguments (for example vtund_helper)
+
+    \return The tunnel object
+    """
+    if kind == 'server':
+        tunnel_class = server_class
+        attribute_keys = _ATTRIBUTE_KEYS + _SERVER_ATTRIBUTE_KEYS
+    elif kind == 'client':
+        tunnel_class = client_class
+        attribute_keys = _ATTRIBUTE_KEYS
+    else:
+        raise Exception('UnknownTunnelKind:' + str(kind))
+    tunnel_kwargs = dict(kwargs)
+    for (key, value) in definition.items():
+        if not key in attribute_keys:
+            tunnel_kwargs[str(key)] = value
+    tunnel = tunnel_class(**tunnel_kwargs)
+    for key in attribute_keys:
+        if key in definition:
+            setattr(tunnel, key, definition[key])
+    return tunnel
+
+class TunnelStateJournal(object):
+    """ Class recording the running tunnels (their definition, the identity of their vtund process and the path of its configuration) in a file, so that they can be recovered by recover() after our program restarted """
+
+    COMPACT_MIN_RECORDS = 256   # Never compact journals smaller than this number of lines
+
+    def __init__(self, path, **kwargs):
+        """ Constructor (the journal file is read if it exists, or created)
+
+        \param path The path of the journal file
+        \param fsync (optional) If True, each record is flushed to disk (fsync()) before returning, so that it survives a crash of the whole system (False by default, records then only survive a crash of our program)
+        """
+        self.path = path
+        self._fsync = kwargs.get('fsync', False)
+        self._lock = threading.Lock()
+        self._entries = {}  # Records of the running tunnels, indexed by tunnel key
+        self._record_count = 0  # Number of lines in the journal file
+        self._file = None
+        with self._lock:
+            if self._load():
+                self._open()
+            else:
+                self._compact()  # Last line has been truncated (crash while writing it), do not append after it
+
+    def _load(self):
+        """ Read the journal file
+
+        \return False if the file ended with a truncated record
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = f.read()
+        except IOError:
+            return True
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+                op = record['op']
+                key = record['key']
+            except (ValueError, KeyError, TypeError):
+                continue    # Truncated or corrupted record
+            self._record_count += 1
+            if op == 'start':
+                self._entries[key] = record
+            elif op == 'stop':
+                self._entries.pop(key, None)
+        return not data or data.endswith('\n')
+
+    def _open(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, 'a')
+
+    def _write(self, f, record):
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def _append(self, record):
+        """ Append a record to the journal file, compacting it if it contains too many stale records (lock must be held)
+        """
+        if self._file is None:
+            raise Exception('JournalClosed')
+        self._write(self._file, record)
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+        self._record_count += 1
+        if self._record_count > max(TunnelStateJournal.COMPACT_MIN_RECORDS, 4 * len(self._entries)):
+            self._compact()
+
+    def _compact(self):
+        """ Rewrite the journal file with only the records of the running tunnels (lock must be held)
+        """
+        (fd, tmp_path) = tempfile.mkstemp(prefix='.' + os.path.basename(self.path) + '.', dir=os.path.dirname(self.path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for record in self._entries.values():
+                    self._write(f, record)
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self._file is not None:
+            self._file.close()
+        self._record_count = len(self._entries)
+        self._open()
+
+    def compact(self):
+        """ Rewrite the journal file with only the records of the running tunnels
+        """
+        with self._lock:
+            self._compact()
+
+    def close(self):
+        """ Close the journal file (records cannot be added anymore)
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record_start(self, tunnel):
+        """ Record that a tunnel has been started (or restarted)
+
+        \param tunnel A running ClientVtunTunnel or ServerVtunTunnel object
+        """
+        pid = tunnel._vtun_pid
+        if pid is None:
+            raise Exception('VtundNotRunning')
+        identity = get_process_identity(pid)
+        if identity is None:    # vtund has already exitted, there will be nothing to recover
+            self.record_stop(tunnel)
+            return
+        config_file = tunnel._vtund_config_file
+        record = {
+            'op': 'start',
+            'key': get_tunnel_key(tunnel),
+            'kind': get_tunnel_kind(tunnel),
+            'tunnel': get_tunnel_definition(tunnel),
+            'pid': pid,
+            'start_time': identity[0],
+            'cmdline': identity[1],
+            'config_path': config_file.path if config_file is not None else None,
+            'time': time.time(),
+        }
+        with self._lock:
+            self._entries[record['key']] = record
+            self._append(record)
+
+    def record_stop(self, tunnel):
+        """ Record that a tunnel has been stopped
+
+        \param tunnel A ClientVtunTunnel or ServerVtunTunnel object
+        """
+        key = get_tunnel_key(tunnel)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._append({'op': 'stop', 'key': key})
+
+    def start_tunnel(self, tunnel, **kwargs):
+        """ Start a tunnel and record it
+
+        \param tunnel A ClientVtunTunnel or ServerVtunTunnel object
+        \param kwargs Arguments for the start() method of \p tunnel
+        """
+        tunnel.start(**kwargs)
+        self.record_start(tunnel)
+
+    def stop_tunnel(self, tunnel, **kwargs):
+        """ Stop a tunnel and record it
+
+        \param tunnel A ClientVtunTunnel or ServerVtunTunnel object
+        \param kwargs Arguments for the stop() method of \p tunnel
+        """
+        try:
+            tunnel.stop(**kwargs)
+        finally:
+            self.record_stop(tunnel)
+
+    def get_records(self):
+        """ Get the records of the tunnels recorded as running
+
+        \return A list of dicts (with keys 'key', 'kind', 'tunnel' for the tunnel definition, 'pid', 'start_time', 'cmdline' and 'config_path')
+        """
+        with self._lock:
+            return [dict(record) for record in self._entries.values()]
+
+    def recover(self, start_gone = True, **kwargs):
+        """ Recreate the tunnel objects recorded as running, and take over their vtund processes
+
+        A vtund process is only taken over if a process with its PID still exists, with the same start time and command line (PIDs are reused).
+        Tunnels whose vtund process is gone are started again (or only recorded as stopped if \p start_gone is False)
+        Client vtund processes are never taken over: their console output (from which the connection state is read) was piped to the previous instance of our program, so they would get SIGPIPE on their next message. They are stopped instead, and handled like the tunnels whose vtund process is gone
+
+        \param start_gone (optional) If False, tunnels whose vtund process is gone are not started
+        \param kwargs Arguments for make_tunnel() (server_class, client_class, and other constructor arguments common to all tunnels, for example vtund_helper)
+
+        \return A tuple (reattached, gone, errors) containing the list of the tunnel objects whose vtund process has been taken over, the list of the tunnel objects whose vtund process was gone or stopped (started again if \p start_gone is True), and a list of (key, exception) tuples for the records that could not be recovered
+        """
+        reattached = []
+        gone = []
+        errors = []
+        for record in self.get_records():
+            try:
+                tunnel = make_tunnel(record['kind'], record['tunnel'], **kwargs)
+            except Exception as e:
+                errors.append((record['key'], e))
+                with self._lock:
+                    self._entries.pop(record['key'], None)
+                continue
+            identity = get_process_identity(record['pid'])
+            if identity is not None and identity[0] == record['start_time'] and identity[1] == record['cmdline']:
+                vtund_config_file = adopt_vtund_config(tunnel.vtund_config_delivery, record['config_path'])
+                tunnel._reattach(AdoptedProcess(record['pid'], record['start_time']), vtund_config_file)
+                if record['kind'] == 'client':
+                    try:
+                        tunnel.stop()
+                    except Exception as e:
+                        errors.append((record['key'], e))
+                        with self._lock:
+                            self._entries.pop(record['key'], None)
+                        continue
+                    gone.append(tunnel)
+                else:
+                    reattached.append(tunnel)
+            else:
+                gone.append(tunnel)
+        with self._lock:
+            for tunnel in gone:
+                self._entries.pop(get_tunnel_key(tunnel), None)
+            self._compact()
+        if start_gone:
+            started = []
+            for tunnel in gone:
+                try:
+                    self.start_tunnel(tunnel)
+                except Exception as e:
+                    errors.append((get_tunnel_key(tunnel), e))
+                    continue
+                started.append(tunnel)
+            gone = started
+        return (reattached, gone, errors)
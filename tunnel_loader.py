@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from vtun_tunnel import parse_tundev_shell_config
+
+class TunnelLoadError(object):
+    """ Class describing a record that could not be turned into a tunnel object by load_tunnels() """
+
+    def __init__(self, record_number, record, error):
+        """ Constructor
+
+        \param record_number The number of the record in the source (starting at 1)
+        \param record A list of strings containing the lines of the record
+        \param error The exception raised while parsing or validating the record
+        """
+        self.record_number = record_number
+        self.record = record
+        self.error = error
+
+    def __repr__(self):
+        return '<TunnelLoadError record ' + str(self.record_number) + ': ' + str(self.error) + '>'
+
+def iter_tundev_shell_records(source):
+    """ Split a stream into tundev shell config records (see vtun_tunnel.parse_tundev_shell_config())
+
+    \param source A file object (or any iterable of lines ending with a newline) in which records are separated by empty lines, or an iterable of strings each containing one whole record. Both forms can be mixed: a string that contains several lines, or that does not end with a newline, ends the current record
+
+    \return A generator of records, each record being a list of lines (without their trailing newline)
+    """
+    record = []
+    for item in source:
+        if item.endswith('\n') and item.count('\n') == 1:  # One line of a file
+            line = item.rstrip('\r\n')
+            if line.strip():
+                record.append(line)
+            elif record:
+                yield record
+                record = []
+        else:   # One whole record
+            if record:
+                yield record
+            record = [line for line in item.splitlines() if line.strip()]
+            if record:
+                yield record
+            record = []
+    if record:
+        yield record
+
+def iter_tunnels(source, tunnel_class, **kwargs):
+    """ Turn a stream of tundev shell config records into tunnel objects, one record at a time
+
+    \param source The records (see iter_tundev_shell_records())
+    \param tunnel_class The class of the tunnel objects to create (ClientVtunTunnel or ServerVtunTunnel for example)
+    \param kwargs Constructor arguments common to all tunnels (for example mode, vtund_exec or vtun_server_hostname). Values found in records override them
+
+    \return A generator of tuples (record_number, tunnel, error): \p tunnel is the tunnel object, or None if the record is invalid, in which case \p error is a TunnelLoadError object
+    """
+    record_number = 0
+    for record in iter_tundev_shell_records(source):
+        record_number += 1
+        try:
+            tunnel_kwargs = dict(kwargs)
+            tunnel_kwargs.update(parse_tundev_shell_config(record))
+            tunnel = tunnel_class(**tunnel_kwargs)
+            if not tunnel.is_valid():
+                raise Exception('InvalidTunnel')
+        except Exception as e:
+            yield (record_number, None, TunnelLoadError(record_number, record, e))
+            continue
+        yield (record_number, tunnel, None)
+
+def load_tunnels(source, tunnel_class, **kwargs):
+    """ Turn all tundev shell config records of a stream into tunnel objects, in one pass, without stopping on invalid records
+
+    \param source The records (see iter_tundev_shell_records())
+    \param tunnel_class The class of the tunnel objects to create
+    \param kwargs Constructor arguments common to all tunnels (see iter_tunnels())
+
+    \return A tuple (tunnels, errors) containing the list of the tunnel objects created from the valid records, and the list of TunnelLoadError objects describing the invalid ones
+    """
+    tunnels = []
+    errors = []
+    for (record_number, tunnel, error) in iter_tunnels(source, tunnel_class, **kwargs):
+        if error is None:
+            tunnels.append(tunnel)
+        else:
+            errors.append(error)
+    return (tunnels, errors)
@@ -0,0 +1,353 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Optional timing instrumentation of the tunnel lifecycle (start, stop, restart), aggregated into counters and histograms that can be exported (see PrometheusExporter)
+
+Instrumentation is disabled by default: until enable_metrics() is called, start_timer() returns a shared timer object whose methods do nothing, and count() returns right away, so instrumented code paths only pay for a few function calls.
+Once enabled, each start() and stop() of ServerVtunTunnel, ClientVtunTunnel and ServerVtunTunnelPool objects records the duration of each of its phases:
+- start: 'render' (configuration generation), 'deliver' (configuration file write, see vtund_config_delivery.py), 'spawn' (launching vtund, or sudo), 'sudo' (until sudo has forked vtund, only with vtund_use_sudo), 'ready' (until the vtund server listens, servers only)
+- stop: 'terminate' (signalling vtund and waiting for it to exit), 'reap' (collecting the exit value of our process), 'release' (removing the configuration)
+"""
+
+from __future__ import print_function
+
+import bisect
+import math
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]   # Upper bounds (in seconds) of the histogram buckets (an additional +Inf bucket is always present)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# Metrics recorded by the instrumented code, with their type and help text
+METRICS = {
+    'tunnel_start_seconds': (HISTOGRAM, 'Duration of successful tunnel starts'),
+    'tunnel_stop_seconds': (HISTOGRAM, 'Duration of successful tunnel stops'),
+    'tunnel_phase_seconds': (HISTOGRAM, 'Duration of each phase of tunnel starts and stops'),
+    'tunnel_connect_seconds': (HISTOGRAM, 'Time between a client tunnel start and the opening of its session'),
+    'tunnel_starts_total': (COUNTER, 'Successful tunnel starts'),
+    'tunnel_start_failures_total': (COUNTER, 'Failed tunnel starts, by error'),
+    'tunnel_stops_total': (COUNTER, 'Successful tunnel stops'),
+    'tunnel_stop_failures_total': (COUNTER, 'Failed tunnel stops, by error'),
+    'tunnel_connections_total': (COUNTER, 'Outcome of the first connection attempt of client tunnels'),
+    'tunnel_reloads_total': (COUNTER, 'Reloads of running server tunnels and pools, by action'),
+    'tunnel_exits_total': (COUNTER, 'Exits of supervised vtund processes'),
+    'tunnel_restarts_total': (COUNTER, 'Restarts of supervised tunnels'),
+    'tunnel_restart_failures_total': (COUNTER, 'Failed restarts of supervised tunnels, by error'),
+}
+
+def get_error_code(error):
+    """ Get a short identifier of an exception, suitable as a label value (the number of distinct values must stay small)
+
+    \param error An exception object
+
+    \return The code of exceptions raised by this library (for example 'VtundStartTimeout' for Exception('VtundStartTimeout') or 'InvalidTcpPort' for Exception('InvalidTcpPort:0')), or the class name of other exceptions
+    """
+    if type(error) is Exception and error.args:
+        return str(error.args[0]).split(':', 1)[0]
+    return type(error).__name__
+
+class _Histogram(object):
+    """ Cumulative distribution of observed values over fixed buckets """
+
+    __slots__ = ['bucket_counts', 'count', 'sum']
+
+    def __init__(self, nbuckets):
+        self.bucket_counts = [0] * (nbuckets + 1)   # Non-cumulative counts, the last one being the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+class TunnelMetrics(object):
+    """ Class aggregating counters and histograms of the tunnel lifecycle, indexed by metric name and labels
+
+    It is thread-safe, one single object is usually shared by all tunnels (see enable_metrics())
+    """
+
+    def __init__(self, **kwargs):
+        """ Constructor
+
+        \param buckets (optional) A sorted list of the upper bounds (in seconds) of the histogram buckets (defaults to DEFAULT_BUCKETS)
+        """
+        self.buckets = list(kwargs.get('buckets', DEFAULT_BUCKETS))
+        if self.buckets != sorted(self.buckets) or not self.buckets:
+            raise Exception('InvalidHistogramBuckets')
+        self._lock = threading.Lock()
+        self._counters = {} # Values indexed by (name, labels) tuples, labels being a sorted tuple of (label, value) tuples
+        self._histograms = {}   # _Histogram objects indexed by (name, labels) tuples
+
+    @staticmethod
+    def _get_key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value = 1, **labels):
+        """ Increment a counter
+
+        \param name The name of the counter (see METRICS)
+        \param value (optional) The increment (1 by default)
+        \param labels The labels of the counter, as strings
+        """
+        key = self._get_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add a value to a histogram
+
+        \param name The name of the histogram (see METRICS)
+        \param value The observed value (a duration in seconds)
+        \param labels The labels of the histogram, as strings
+        """
+        key = self._get_key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key, None)
+            if histogram is None:
+                histogram = _Histogram(len(self.buckets))
+                self._histograms[key] = histogram
+            histogram.bucket_counts[index] += 1
+            histogram.count += 1
+            histogram.sum += value
+
+    def get_counter(self, name, **labels):
+        """ Get the value of a counter
+
+        \return The value (0 if the counter has never been incremented)
+        """
+        with self._lock:
+            return self._counters.get(self._get_key(name, labels), 0)
+
+    def get_histogram(self, name, **labels):
+        """ Get the content of a histogram
+
+        \return A dict with keys 'count', 'sum' and 'buckets' (a list of (upper bound, cumulative count) tuples, the last upper bound being float('inf')), or None if nothing has been observed
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._get_key(name, labels), None)
+            if histogram is None:
+                return None
+            return self._get_histogram_dict(histogram)
+
+    def _get_histogram_dict(self, histogram):
+        buckets = []
+        cumulative_count = 0
+        for (bound, count) in zip(self.buckets + [float('inf')], histogram.bucket_counts):
+            cumulative_count += count
+            buckets.append((bound, cumulative_count))
+        return {'count': histogram.count, 'sum': histogram.sum, 'buckets': buckets}
+
+    def get_samples(self):
+        """ Get a consistent snapshot of all metrics, for exporters
+
+        \return A list of (name, type, labels, value) tuples sorted by name and labels, where type is COUNTER (value is a number) or HISTOGRAM (value is a dict, see get_histogram()), and labels a tuple of (label, value) tuples
+        """
+        with self._lock:
+            samples = [(name, COUNTER, labels, value) for ((name, labels), value) in self._counters.items()]
+            samples += [(name, HISTOGRAM, labels, self._get_histogram_dict(histogram)) for ((name, labels), histogram) in self._histograms.items()]
+        samples.sort(key = lambda sample: (sample[0], sample[2]))
+        return samples
+
+    def reset(self):
+        """ Forget all recorded values
+        """
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+class PhaseTimer(object):
+    """ Class timing the phases of one operation (start or stop) of one tunnel, created by start_timer() """
+
+    __slots__ = ['_metrics', 'kind', 'operation', 'started', '_last']
+
+    def __init__(self, metrics, kind, operation):
+        self._metrics = metrics
+        self.kind = kind
+        self.operation = operation
+        self.started = time.time()
+        self._last = self.started
+
+    def phase(self, name):
+        """ Record the end of a phase (that started when the previous phase ended, or when the timer was created)
+
+        \param name The name of the phase, for example 'render'
+        """
+        now = time.time()
+        self._metrics.observe('tunnel_phase_seconds', now - self._last, kind=self.kind, operation=self.operation, phase=name)
+        self._last = now
+
+    def done(self, error = None):
+        """ Record the end of the operation
+
+        \param error (optional) The exception that made the operation fail (its duration is then not recorded, only a failure counted with its error code, see get_error_code())
+        """
+        if error is None:
+            self._metrics.observe('tunnel_' + self.operation + '_seconds', time.time() - self.started, kind=self.kind)
+            self._metrics.inc('tunnel_' + self.operation + 's_total', kind=self.kind)
+        else:
+            self._metrics.inc('tunnel_' + self.operation + '_failures_total', kind=self.kind, error=get_error_code(error))
+
+    def watch_connection(self, tunnel):
+        """ Record the time until the session of a client tunnel is opened (or fails), via a state listener that is removed after the first outcome
+
+        \param tunnel The ClientVtunTunnel object that has just been started
+        """
+        metrics = self._metrics
+        started = self.started
+        def on_state_change(tunnel, old_state, new_state):
+            if new_state == 'connecting':
+                return
+            tunnel.remove_state_listener(on_state_change)
+            if new_state == 'connected':
+                metrics.observe('tunnel_connect_seconds', time.time() - started, kind='client')
+            metrics.inc('tunnel_connections_total', kind='client', result=new_state)
+        tunnel.add_state_listener(on_state_change)
+
+class _NullPhaseTimer(object):
+    """ Timer returned by start_timer() when instrumentation is disabled """
+
+    __slots__ = []
+
+    def phase(self, name):
+        pass
+
+    def done(self, error = None):
+        pass
+
+    def watch_connection(self, tunnel):
+        pass
+
+NULL_TIMER = _NullPhaseTimer()
+
+_metrics = None # The TunnelMetrics object recording instrumented operations (None when instrumentation is disabled)
+
+def enable_metrics(metrics = None):
+    """ Enable instrumentation of all tunnels
+
+    \param metrics (optional) The TunnelMetrics object to record into (a new one is created by default)
+
+    \return The TunnelMetrics object
+    """
+    global _metrics
+    if metrics is None:
+        metrics = TunnelMetrics()
+    _metrics = metrics
+    return metrics
+
+def disable_metrics():
+    """ Disable instrumentation (the TunnelMetrics object keeps the values recorded so far)
+    """
+    global _metrics
+    _metrics = None
+
+def get_metrics():
+    """ Get the TunnelMetrics object instrumentation records into
+
+    \return The TunnelMetrics object, or None if instrumentation is disabled
+    """
+    return _metrics
+
+def start_timer(kind, operation):
+    """ Start timing an operation of a tunnel
+
+    \param kind The kind of tunnel ('server', 'client' or 'pool')
+    \param operation 'start' or 'stop'
+
+    \return A PhaseTimer object, or NULL_TIMER if instrumentation is disabled
+    """
+    metrics = _metrics
+    if metrics is None:
+        return NULL_TIMER
+    return PhaseTimer(metrics, kind, operation)
+
+def count(name, **labels):
+    """ Increment a counter, if instrumentation is enabled
+
+    \param name The name of the counter (see METRICS)
+    \param labels The labels of the counter, as strings
+    """
+    metrics = _metrics
+    if metrics is not None:
+        metrics.inc(name, **labels)
+
+class MetricsExporter(object):
+    """ Base class of the exporters, rendering all metrics of a TunnelMetrics object in some text format (subclasses implement render()) """
+
+    def render(self, metrics):
+        """ Render all metrics
+
+        \param metrics A TunnelMetrics object
+
+        \return A string
+        """
+        pass    # 'virtual' method
+
+    def write(self, metrics, path):
+        """ Render all metrics into a file, atomically replacing it (so that a collector never reads a partial file)
+
+        \param metrics A TunnelMetrics object
+        \param path The path of the file
+        """
+        data = self.render(metrics)
+        (fd, tmp_path) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+class PrometheusExporter(MetricsExporter):
+    """ Exporter rendering metrics in the Prometheus text exposition format (version 0.0.4), to be served over HTTP or written for the node_exporter textfile collector (see write()) """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, **kwargs):
+        """ Constructor
+
+        \param prefix (optional) A prefix added to all metric names ('vtun_' by default)
+        \param labels (optional) A dict of labels added to all samples (for example {'instance': 'controller1'})
+        """
+        self.prefix = kwargs.get('prefix', 'vtun_')
+        self.labels = tuple(sorted(kwargs.get('labels', {}).items()))
+
+    @staticmethod
+    def _format_value(value):
+        if isinstance(value, float):
+            if math.isinf(value):
+                return '+Inf' if value > 0 else '-Inf'
+            return repr(value)
+        return str(value)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join([str(label) + '="' + str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') + '"' for (label, value) in labels]) + '}'
+
+    def render(self, metrics):
+        lines = []
+        last_name = None
+        for (name, metric_type, labels, value) in metrics.get_samples():
+            full_name = self.prefix + name
+            labels = self.labels + labels
+            if name != last_name:
+                lines.append('# HELP ' + full_name + ' ' + METRICS.get(name, (None, name))[1])
+                lines.append('# TYPE ' + full_name + ' ' + metric_type)
+                last_name = name
+            if metric_type == COUNTER:
+                lines.append(full_name + self._format_labels(labels) + ' ' + self._format_value(value))
+                continue
+            for (bound, cumulative_count) in value['buckets']:
+                lines.append(full_name + '_bucket' + self._format_labels(labels + (('le', self._format_value(float(bound))),)) + ' ' + str(cumulative_count))
+            lines.append(full_name + '_sum' + self._format_labels(labels) + ' ' + self._format_value(value['sum']))
+            lines.append(full_name + '_count' + self._format_labels(labels) + ' ' + str(value['count']))
+        return '\n'.join(lines) + '\n' if lines else ''
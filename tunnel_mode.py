@@ -5,6 +5,8 @@
 from __future__ import print_function
 
 class TunnelMode(object):
+    __slots__ = ['_mode']
+    
     def __init__(self, mode):
         """ Constructor
         \param mode A string representing the tunnel mode. Supported values are L2, L3 and L3_multi
@@ -37,4 +39,22 @@ class TunnelMode(object):
         
         
     def __str__(self):
-        return self.get_mode()
\ No newline at end of file
+        return self.get_mode()
+
+_shared_tunnel_modes = {}   # Shared TunnelMode objects, indexed by mode string
+
+def get_tunnel_mode(mode):
+    """ Get a TunnelMode object shared by all tunnels using the same mode (there are only a few modes, so tunnels do not need their own object)
+    
+    Warning: the returned object must not be modified with set_mode()
+    
+    \param mode A string representing the tunnel mode. Supported values are L2, L3 and L3_multi
+    
+    \return A TunnelMode object
+    """
+    try:
+        return _shared_tunnel_modes[mode]
+    except KeyError:
+        tunnel_mode = TunnelMode(mode)  # Raises if mode is invalid
+        _shared_tunnel_modes[mode] = tunnel_mode
+        return tunnel_mode
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from vtund_output_reactor import get_default_reactor
+
+import array
+import math
+import threading
+import time
+
+try:
+    _string_types = basestring
+except NameError:   # Python 3
+    _string_types = str
+
+COUNTERS = ['rx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped', 'tx_bytes', 'tx_packets', 'tx_errors', 'tx_dropped']
+
+_PROC_NET_DEV_COLUMNS = [0, 1, 2, 3, 8, 9, 10, 11]   # Columns of COUNTERS in /proc/net/dev (after the interface name)
+_NAN = float('nan')
+
+def _read_sysfs_statistics(interface):
+    counters = []
+    for counter in COUNTERS:
+        try:
+            with open('/sys/class/net/' + interface + '/statistics/' + counter, 'r') as f:
+                counters.append(int(f.read()))
+        except (IOError, ValueError):
+            return None
+    return tuple(counters)
+
+def read_interface_statistics(interfaces = None):
+    """ Read the traffic counters of network interfaces, for all interfaces in one single pass over /proc/net/dev
+
+    If /proc/net/dev cannot be read, /sys/class/net/<interface>/statistics is read instead (in which case \p interfaces is required)
+
+    \param interfaces (optional) A set (or any container) of interface names to restrict the result to
+
+    \return A dict containing interface names as keys, and tuples of int (in the order of COUNTERS) as values. Interfaces that do not exist (tunnel not up) are missing from the dict
+    """
+    statistics = {}
+    try:
+        f = open('/proc/net/dev', 'r')
+    except IOError:
+        if interfaces is None:
+            raise Exception('InterfaceStatisticsNotAvailable')
+        for interface in interfaces:
+            counters = _read_sysfs_statistics(interface)
+            if counters is not None:
+                statistics[interface] = counters
+        return statistics
+    try:
+        f.readline()    # Skip the two header lines
+        f.readline()
+        for line in f:
+            (interface, sep, values) = line.partition(':')
+            if not sep:
+                continue
+            interface = interface.strip()
+            if interfaces is not None and not interface in interfaces:
+                continue
+            fields = values.split()
+            statistics[interface] = tuple([int(fields[column]) for column in _PROC_NET_DEV_COLUMNS])
+    finally:
+        f.close()
+    return statistics
+
+class TunnelStatsCollector(object):
+    """ Class sampling the traffic counters of the network interfaces of many tunnels, and keeping their history
+
+    All interfaces are sampled in one batched read (see read_interface_statistics()), periodically from the shared VtundOutputReactor thread (see start()) or on demand with sample().
+    History is kept in fixed size arrays of floats (one ring of \p history_size samples per interface), so that rates and percentiles are computed without creating one Python object per sample
+    """
+
+    def __init__(self, **kwargs):
+        """ Constructor
+
+        \param interval (optional) The sampling interval (in seconds) used by start() (10 by default)
+        \param history_size (optional) The number of samples kept for each interface (360 by default, meaning one hour at the default interval)
+        \param reactor (optional) The VtundOutputReactor object scheduling the periodic sampling (defaults to the one shared by all tunnels)
+        """
+        self.interval = float(kwargs.get('interval', 10))
+        if self.interval <= 0:
+            raise Exception('InvalidSamplingInterval:' + str(self.interval))
+        self.history_size = int(kwargs.get('history_size', 360))
+        if self.history_size < 2:
+            raise Exception('InvalidHistorySize:' + str(self.history_size))
+        self._reactor = kwargs.get('reactor', None)
+        self._lock = threading.Lock()
+        self._times = array.array('d', [_NAN]) * self.history_size
+        self._history = {}  # One array of history_size * len(COUNTERS) floats (NaN when the interface did not exist) per interface name
+        self._next_slot = 0
+        self._sample_count = 0
+        self._generation = 0    # Incremented by start() and stop(), so that periodic samplings scheduled before are dropped
+
+    @staticmethod
+    def _get_interface_name(tunnel):
+        if tunnel is None or isinstance(tunnel, _string_types):
+            interface = tunnel
+        else:
+            interface = tunnel.interface_name
+        if interface is None:
+            raise Exception('NoInterfaceName')
+        return interface
+
+    def add_tunnel(self, tunnel):
+        """ Start collecting the traffic counters of a tunnel
+
+        \param tunnel A VtunTunnel object (with an interface_name attribute) or an interface name
+        """
+        interface = self._get_interface_name(tunnel)
+        with self._lock:
+            if not interface in self._history:
+                self._history[interface] = array.array('d', [_NAN]) * (self.history_size * len(COUNTERS))
+
+    def add_tunnels(self, tunnels):
+        """ Start collecting the traffic counters of several tunnels
+
+        \param tunnels A list of VtunTunnel objects or interface names
+        """
+        for tunnel in tunnels:
+            self.add_tunnel(tunnel)
+
+    def remove_tunnel(self, tunnel):
+        """ Stop collecting the traffic counters of a tunnel, and forget its history
+
+        \param tunnel A VtunTunnel object or an interface name
+        """
+        with self._lock:
+            self._history.pop(self._get_interface_name(tunnel), None)
+
+    def sample(self):
+        """ Read the traffic counters of all tunnels now, and add them to the history
+
+        \return The time of the sample
+        """
+        with self._lock:
+            interfaces = set(self._history.keys())
+        statistics = read_interface_statistics(interfaces)
+        now = time.time()
+        ncounters = len(COUNTERS)
+        with self._lock:
+            slot = self._next_slot
+            offset = slot * ncounters
+            self._times[slot] = now
+            for (interface, history) in self._history.items():
+                counters = statistics.get(interface, None)
+                if counters is None:
+                    history[offset:offset + ncounters] = array.array('d', [_NAN]) * ncounters
+                else:
+                    history[offset:offset + ncounters] = array.array('d', counters)
+            self._next_slot = (slot + 1) % self.history_size
+            self._sample_count = min(self._sample_count + 1, self.history_size)
+        return now
+
+    def start(self):
+        """ Sample all tunnels every \p interval seconds (from the reactor thread), until stop() is called
+        """
+        if self._reactor is None:
+            self._reactor = get_default_reactor()
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self._reactor.call_later(0, lambda: self._periodic_sample(generation))
+
+    def stop(self):
+        """ Stop periodic sampling (the history is kept)
+        """
+        with self._lock:
+            self._generation += 1
+
+    def _periodic_sample(self, generation):
+        if generation != self._generation:
+            return  # stop() (or start() again) has been called in the meantime
+        started = time.time()
+        try:
+            self.sample()
+        finally:
+            if generation == self._generation:
+                delay = max(0, self.interval - (time.time() - started))
+                self._reactor.call_later(delay, lambda: self._periodic_sample(generation))
+
+    def _get_slots(self, window):
+        """ Get the history slots, oldest first, restricted to the samples of the last \p window seconds if \p window is not None (lock must be held)
+        """
+        if self._sample_count < self.history_size:
+            slots = list(range(self._sample_count))
+        else:
+            slots = list(range(self._next_slot, self.history_size)) + list(range(self._next_slot))
+        if window is not None and slots:
+            oldest = self._times[slots[-1]] - window
+            slots = [slot for slot in slots if self._times[slot] >= oldest]
+        return slots
+
+    def _get_history(self, tunnel):
+        history = self._history.get(self._get_interface_name(tunnel), None)
+        if history is None:
+            raise Exception('TunnelNotCollected:' + str(self._get_interface_name(tunnel)))
+        return history
+
+    def get_counters(self, tunnel):
+        """ Get the last sampled traffic counters of a tunnel
+
+        \param tunnel A VtunTunnel object or an interface name
+
+        \return A dict containing counter names (see COUNTERS) as keys and int as values, or None if the interface did not exist at the last sample (or nothing has been sampled yet)
+        """
+        with self._lock:
+            history = self._get_history(tunnel)
+            if self._sample_count == 0:
+                return None
+            offset = ((self._next_slot - 1) % self.history_size) * len(COUNTERS)
+            values = history[offset:offset + len(COUNTERS)]
+        if math.isnan(values[0]):
+            return None
+        return dict(zip(COUNTERS, [int(value) for value in values]))
+
+    def get_rates(self, tunnel, counter, window = None):
+        """ Get the rates of one counter of a tunnel between each pair of consecutive samples
+
+        Intervals during which the interface did not exist, or during which the counter was reset (interface recreated), are skipped
+
+        \param tunnel A VtunTunnel object or an interface name
+        \param counter One of COUNTERS
+        \param window (optional) Only use the samples of the last \p window seconds (all samples in history by default)
+
+        \return An array of float (per second rates), oldest first
+        """
+        index = COUNTERS.index(counter)
+        ncounters = len(COUNTERS)
+        rates = array.array('d')
+        with self._lock:
+            history = self._get_history(tunnel)
+            slots = self._get_slots(window)
+            for (previous, current) in zip(slots, slots[1:]):
+                delta = history[current * ncounters + index] - history[previous * ncounters + index]
+                duration = self._times[current] - self._times[previous]
+                if delta >= 0 and duration > 0:  # False if either sample is NaN
+                    rates.append(delta / duration)
+        return rates
+
+    def get_rate(self, tunnel, counter, window = None):
+        """ Get the average rate of one counter of a tunnel
+
+        \param tunnel A VtunTunnel object or an interface name
+        \param counter One of COUNTERS (for example 'rx_bytes' for the received throughput in bytes per second)
+        \param window (optional) Only use the samples of the last \p window seconds
+
+        \return A float (per second), or None if there are not enough samples
+        """
+        index = COUNTERS.index(counter)
+        ncounters = len(COUNTERS)
+        total = 0.0
+        total_duration = 0.0
+        with self._lock:
+            history = self._get_history(tunnel)
+            slots = self._get_slots(window)
+            for (previous, current) in zip(slots, slots[1:]):
+                delta = history[current * ncounters + index] - history[previous * ncounters + index]
+                duration = self._times[current] - self._times[previous]
+                if delta >= 0 and duration > 0:
+                    total += delta
+                    total_duration += duration
+        if total_duration == 0:
+            return None
+        return total / total_duration
+
+    def get_rate_percentile(self, tunnel, counter, percentile, window = None):
+        """ Get a percentile of the rates of one counter of a tunnel (see get_rates())
+
+        \param tunnel A VtunTunnel object or an interface name
+        \param counter One of COUNTERS
+        \param percentile A number between 0 and 100 (for example 95)
+        \param window (optional) Only use the samples of the last \p window seconds
+
+        \return A float (per second, using the nearest-rank method), or None if there are not enough samples
+        """
+        if percentile < 0 or percentile > 100:
+            raise Exception('InvalidPercentile:' + str(percentile))
+        rates = sorted(self.get_rates(tunnel, counter, window))
+        if not rates:
+            return None
+        rank = max(0, int(math.ceil(percentile / 100.0 * len(rates))) - 1)
+        return rates[rank]
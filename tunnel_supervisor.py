@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from vtund_output_reactor import get_default_reactor
+from client_vtun_tunnel import ClientVtunTunnel
+from tunnel_metrics import count, get_error_code
+
+import random
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+def _get_kind(tunnel):
+    """ Get the kind label of a tunnel in metrics (see tunnel_metrics.py)
+    """
+    return 'client' if isinstance(tunnel, ClientVtunTunnel) else 'server'
+
+class TunnelSupervisorEvent(object):
+    """ Class describing something that happened to a tunnel watched by a TunnelSupervisor """
+
+    EXIT = 'exit'   # vtund exitted
+    RESTARTED = 'restarted' # vtund has been restarted
+    RESTART_FAILED = 'restart_failed'   # Restarting vtund failed (another attempt is scheduled)
+
+    def __init__(self, kind, tunnel, pid, **kwargs):
+        """ Constructor
+
+        \param kind One of EXIT, RESTARTED or RESTART_FAILED
+        \param tunnel The tunnel object
+        \param pid The PID of the vtund process that exitted (EXIT), that has been started (RESTARTED), or None (RESTART_FAILED)
+        \param exit_value (optional) The exit value of the process we launched for vtund, if known (EXIT)
+        \param expected (optional) True if the exit was caused by stop() (EXIT)
+        \param error (optional) The exception raised by start() (RESTART_FAILED)
+        \param restart_delay (optional) The delay (in seconds) before the next restart attempt, or None if the tunnel will not be restarted (EXIT and RESTART_FAILED)
+        \param restart_count (optional) The number of consecutive restarts of this tunnel
+        """
+        self.kind = kind
+        self.tunnel = tunnel
+        self.pid = pid
+        self.exit_value = kwargs.get('exit_value', None)
+        self.expected = kwargs.get('expected', False)
+        self.error = kwargs.get('error', None)
+        self.restart_delay = kwargs.get('restart_delay', None)
+        self.restart_count = kwargs.get('restart_count', 0)
+        self.time = time.time()
+
+    def __repr__(self):
+        return '<TunnelSupervisorEvent ' + self.kind + ' ' + str(self.tunnel.vtun_tunnel_name) + ' pid=' + str(self.pid) + '>'
+
+class _SupervisedTunnel(object):
+    """ Supervision state of one tunnel """
+
+    __slots__ = ['tunnel', 'pid', 'on_exit', 'started_at', 'failures', 'restart', 'stopping', 'restarting']
+
+    def __init__(self, tunnel, restart):
+        self.tunnel = tunnel
+        self.pid = None # The PID of the vtund process we watch
+        self.on_exit = None # The exit callback registered in the reactor for this PID
+        self.started_at = None
+        self.failures = 0   # Number of consecutive restarts since vtund last ran for at least stable_time
+        self.restart = restart
+        self.stopping = False
+        self.restarting = False # True while the restart thread runs start() on the tunnel
+
+class TunnelSupervisor(object):
+    """ Class watching the vtund processes of many tunnels, publishing their exits and restarting them
+
+    Exits are detected by the shared VtundOutputReactor thread (one pidfd per vtund process in its poll), and restarts are run by one single worker thread, so supervising any number of tunnels costs two threads.
+    Consecutive restarts of a tunnel are delayed with an exponential backoff (with random jitter, so that tunnels that failed together do not restart all at once).
+    Warning: supervised tunnels should be stopped with stop_tunnel() (or removed with remove_tunnel() first), otherwise a stopped server tunnel may be restarted
+    """
+
+    def __init__(self, **kwargs):
+        """ Constructor
+
+        \param restart_delay (optional) The delay (in seconds) before the first restart of a tunnel (1 by default)
+        \param max_restart_delay (optional) The maximum delay (in seconds) between restarts (60 by default)
+        \param backoff_factor (optional) The factor applied to the delay after each consecutive restart (2 by default)
+        \param jitter (optional) The maximum relative random variation applied to delays (0.1 by default, meaning +/-10%)
+        \param stable_time (optional) The time (in seconds) vtund must run for its restart delay to be reset (60 by default)
+        \param reactor (optional) The VtundOutputReactor object watching the processes (defaults to the one shared by all tunnels)
+        \param journal (optional) A tunnel_journal.TunnelStateJournal object in which starts, restarts and stops are recorded
+        """
+        self.restart_delay = float(kwargs.get('restart_delay', 1))
+        self.max_restart_delay = float(kwargs.get('max_restart_delay', 60))
+        self.backoff_factor = float(kwargs.get('backoff_factor', 2))
+        self.jitter = float(kwargs.get('jitter', 0.1))
+        self.stable_time = float(kwargs.get('stable_time', 60))
+        self._reactor = kwargs.get('reactor', None)
+        if self._reactor is None:
+            self._reactor = get_default_reactor()
+        self._journal = kwargs.get('journal', None)
+        self._lock = threading.Lock()
+        self._restart_done = threading.Condition(self._lock)    # Notified each time the restart thread is done with a tunnel
+        self._supervised = {}   # _SupervisedTunnel objects indexed by id() of the tunnel
+        self._listeners = []
+        self._restart_queue = queue.Queue()
+        self._worker = None
+
+    def add_listener(self, listener):
+        """ Register a function to be called with each TunnelSupervisorEvent
+
+        Warning: \p listener is called from the reactor thread or the restart thread, so it should return quickly
+
+        \param listener A function taking a TunnelSupervisorEvent object as argument
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Unregister a function previously registered with add_listener()
+        """
+        self._listeners.remove(listener)
+
+    def add_tunnel(self, tunnel, restart = True):
+        """ Supervise a tunnel (if it is already running, its vtund process is watched right away)
+
+        \param tunnel A ClientVtunTunnel or ServerVtunTunnel object
+        \param restart (optional) If False, exits are only published, and the tunnel is not restarted
+        """
+        state = _SupervisedTunnel(tunnel, restart)
+        with self._lock:
+            if id(tunnel) in self._supervised:
+                raise Exception('TunnelAlreadySupervised:' + str(tunnel.vtun_tunnel_name))
+            self._supervised[id(tunnel)] = state
+        if tunnel._vtun_pid is not None:
+            self._watch(state)
+
+    def remove_tunnel(self, tunnel):
+        """ Stop supervising a tunnel (the tunnel is left running)
+
+        \param tunnel A tunnel previously given to add_tunnel()
+        """
+        with self._lock:
+            state = self._supervised.pop(id(tunnel), None)
+        if state is None:
+            raise Exception('TunnelNotSupervised:' + str(tunnel.vtun_tunnel_name))
+        self._unwatch(state)
+
+    def get_tunnels(self):
+        """ Get the supervised tunnels
+
+        \return A list of tunnel objects
+        """
+        with self._lock:
+            return [state.tunnel for state in self._supervised.values()]
+
+    def start_tunnel(self, tunnel, **kwargs):
+        """ Start a supervised tunnel and watch its vtund process
+
+        \param tunnel A tunnel previously given to add_tunnel()
+        \param kwargs Arguments for the start() method of \p tunnel
+        """
+        state = self._get_state(tunnel)
+        state.stopping = False
+        tunnel.start(**kwargs)
+        state.failures = 0
+        self._watch(state)
+        if self._journal is not None:
+            self._journal.record_start(tunnel)
+
+    def stop_tunnel(self, tunnel, **kwargs):
+        """ Stop a supervised tunnel (it will not be restarted until start_tunnel() is called)
+
+        If the tunnel is being restarted, we wait for the restart to complete and then stop the new vtund process
+
+        \param tunnel A tunnel previously given to add_tunnel()
+        \param kwargs Arguments for the stop() method of \p tunnel
+        """
+        state = self._get_state(tunnel)
+        with self._lock:
+            state.stopping = True
+            while state.restarting: # Wait for the restart in progress, so that we stop the vtund process it started
+                self._restart_done.wait()
+        self._unwatch(state)
+        tunnel.stop(**kwargs)
+        if self._journal is not None:
+            self._journal.record_stop(tunnel)
+
+    def _get_state(self, tunnel):
+        with self._lock:
+            state = self._supervised.get(id(tunnel), None)
+        if state is None:
+            raise Exception('TunnelNotSupervised:' + str(tunnel.vtun_tunnel_name))
+        return state
+
+    def _watch(self, state):
+        pid = state.tunnel._vtun_pid
+        state.pid = pid
+        state.on_exit = lambda: self._on_exit(state, pid)
+        state.started_at = time.time()
+        self._reactor.watch_exit(pid, state.on_exit)
+
+    def _unwatch(self, state):
+        if state.pid is not None:
+            self._reactor.unwatch_exit(state.pid, state.on_exit)
+            state.pid = None
+            state.on_exit = None
+
+    def _publish(self, event):
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception:
+                traceback.print_exc(file = sys.stderr)
+
+    def _is_supervised(self, state):
+        with self._lock:
+            return self._supervised.get(id(state.tunnel), None) is state
+
+    def _get_restart_delay(self, failures):
+        delay = min(self.max_restart_delay, self.restart_delay * (self.backoff_factor ** failures))
+        return max(0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def _on_exit(self, state, pid):
+        """ Handle the exit of the vtund process \p pid of a supervised tunnel (called from the reactor thread)
+        """
+        if state.pid != pid or not self._is_supervised(state):
+            return
+        state.pid = None
+        state.on_exit = None
+        tunnel = state.tunnel
+        proc = tunnel._vtun_process
+        exit_value = proc.poll() if proc is not None else None
+        expected = state.stopping or tunnel._vtun_pid != pid    # stop() has been called (and may even have completed)
+        if isinstance(tunnel, ClientVtunTunnel) and tunnel._vtun_process_exit_expected is not None and tunnel._vtun_process_exit_expected.is_set():
+            expected = True
+        restart_delay = None
+        if not expected and state.restart:
+            if time.time() - state.started_at >= self.stable_time:
+                state.failures = 0
+            restart_delay = self._get_restart_delay(state.failures)
+        count('tunnel_exits_total', kind=_get_kind(tunnel), expected='true' if expected else 'false')
+        self._publish(TunnelSupervisorEvent(TunnelSupervisorEvent.EXIT, tunnel, pid, exit_value=exit_value, expected=expected, restart_delay=restart_delay, restart_count=state.failures))
+        if restart_delay is not None:
+            self._schedule_restart(state, restart_delay)
+
+    def _schedule_restart(self, state, delay):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target = self._run_restarts)
+                self._worker.daemon = True
+                self._worker.start()
+        self._reactor.call_later(delay, lambda: self._restart_queue.put(state))
+
+    def _run_restarts(self):
+        """ Restart tunnels (restart worker thread), as start() may block until vtund is ready """
+        while True:
+            state = self._restart_queue.get()
+            with self._lock:
+                if state.stopping or self._supervised.get(id(state.tunnel), None) is not state:
+                    continue
+                state.restarting = True
+            try:
+                self._restart(state)
+            finally:
+                with self._lock:
+                    state.restarting = False
+                    self._restart_done.notify_all()
+
+    def _restart(self, state):
+        """ Restart the tunnel of \p state (called from the restart thread) """
+        tunnel = state.tunnel
+        state.failures += 1
+        try:
+            try:
+                tunnel.stop()   # Reap the process that exitted, and release its resources
+            except Exception:
+                pass
+            tunnel.start()
+        except Exception as e:
+            restart_delay = self._get_restart_delay(state.failures)
+            count('tunnel_restart_failures_total', kind=_get_kind(tunnel), error=get_error_code(e))
+            self._publish(TunnelSupervisorEvent(TunnelSupervisorEvent.RESTART_FAILED, tunnel, None, error=e, restart_delay=restart_delay, restart_count=state.failures))
+            self._schedule_restart(state, restart_delay)
+            return
+        if state.stopping or not self._is_supervised(state):    # stop_tunnel() (that stops the vtund we started, once we are done) or remove_tunnel() (that leaves it running) while we were restarting
+            return
+        self._watch(state)
+        if self._journal is not None:
+            self._journal.record_start(tunnel)
+        count('tunnel_restarts_total', kind=_get_kind(tunnel))
+        self._publish(TunnelSupervisorEvent(TunnelSupervisorEvent.RESTARTED, tunnel, state.pid, restart_count=state.failures))
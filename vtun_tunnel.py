@@ -6,21 +6,100 @@ from __future__ import print_function
 
 import ipaddr
 import re
-import subprocess
 
-from tunnel_mode import TunnelMode
+from tunnel_mode import get_tunnel_mode
+from process_teardown import get_child_pids
+from vtund_config_delivery import deliver_vtund_config, CONFIG_DELIVERIES
+from tunnel_profile import check_mtu, get_profile_name, resolve_profile_settings
+
+_IPV4_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+_IPV4_ADDRESS_RE = re.compile(r'^(?:' + _IPV4_OCTET + r'\.){3}' + _IPV4_OCTET + r'$')
+_IPV4_NETWORK_RE = re.compile(r'^(?:' + _IPV4_OCTET + r'\.){3}' + _IPV4_OCTET + r'/(?:3[0-2]|[12]?[0-9])$')
+_ONLY_DIGITS_RE = re.compile(r'^[0-9]+$')
+try:
+    _string_types = basestring
+except NameError:   # Python 3
+    _string_types = str
+
+_TUNDEV_SHELL_CONFIG_LINE_RE = re.compile(r'^\s*([A-Za-z0-9_]+)\s*:\s*(.*?)\s*$')
+
+# Keys of the devshell 'get_vtun_parameters' output, and the set_characteristics() argument (or VtunTunnel kwarg) each one maps to
+_TUNDEV_SHELL_CONFIG_KEYS = {
+    'tunnel_mode': 'mode',
+    'tunnel_ip_network': 'tunnel_ip_network',
+    'tunnel_ip_prefix': 'tunnel_ip_prefix',
+    'tunnel_ip_netmask': 'tunnel_ip_netmask',
+    'tunnel_near_end_ip': 'tunnel_near_end_ip',
+    'tunnel_far_end_ip': 'tunnel_far_end_ip',
+    'tunnel_vtun_server_tcp_port': 'vtun_server_tcp_port',
+    'tunnel_name': 'vtun_tunnel_name',
+    'tunnel_secret': 'vtun_shared_secret',
+}
+_TUNDEV_SHELL_CONFIG_EXCLUSIVE_ARGS = ['mode', 'tunnel_ip_network', 'tunnel_near_end_ip', 'tunnel_far_end_ip', 'vtun_server_tcp_port', 'vtun_tunnel_name', 'vtun_shared_secret', 'mtu', 'tuning_profile']    # Constructor arguments not allowed together with tundev_shell_config
+
+class _LazyIpAttribute(object):
+    """ Descriptor storing an IP address (or network) attribute as a string, and converting it to an ipaddr object only when it is first read
+    
+    Strings in the usual dotted (and prefix length) notation are validated with a precompiled regular expression, other notations are converted (and thus validated) by ipaddr right away
+    """
+    
+    __slots__ = ['_slot', '_ip_class', '_fast_re']
+    
+    def __init__(self, slot, ip_class, fast_re):
+        """ Constructor
+        
+        \param slot The name of the slot in which the value is stored
+        \param ip_class The ipaddr class to convert the value to (ipaddr.IPv4Address or ipaddr.IPv4Network)
+        \param fast_re A compiled regular expression matching the strings that are known to be valid for \p ip_class
+        """
+        self._slot = slot
+        self._ip_class = ip_class
+        self._fast_re = fast_re
+    
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self
+        value = getattr(obj, self._slot)
+        if value is not None and not isinstance(value, self._ip_class):
+            value = self._ip_class(value)
+            setattr(obj, self._slot, value)
+        return value
+    
+    def __set__(self, obj, value):
+        if value is not None and not isinstance(value, self._ip_class):
+            value = str(value)
+            if not self._fast_re.match(value):
+                value = self._ip_class(value)
+        setattr(obj, self._slot, value)
+
+def _get_ip_value(value, ip_class):
+    """ Get the value to assign to an IP address (or network) attribute: ipaddr objects (already validated) are shared as is, other values are converted to strings (see _LazyIpAttribute)
+    """
+    if isinstance(value, ip_class):
+        return value
+    return str(value)
 
 class VtunTunnel(object):
     """ Class representing a vtun tunnel """
     
+    # Tunnel objects may be created by tens of thousands, so they do not have a per-instance __dict__ (subclasses declare their own __slots__ as well)
+    __slots__ = ['_vtun_pid', '_vtun_process', 'vtund_exec', 'vtund_use_sudo', 'vtund_helper', 'vtund_config_delivery', '_vtund_config_file', 'vtun_tunnel_name', 'vtun_shared_secret', 'tunnel_mode', '_tunnel_ip_network', '_tunnel_near_end_ip', '_tunnel_far_end_ip', 'vtun_server_tcp_port', 'mtu', 'tuning_profile', 'interface_name', 'up_additional_commands', 'down_additional_commands', '__weakref__']
+    
     VTUND_EXEC = 'vtund'
+    DEFAULT_MTU = 1450
+    
+    tunnel_ip_network = _LazyIpAttribute('_tunnel_ip_network', ipaddr.IPv4Network, _IPV4_NETWORK_RE)
+    tunnel_near_end_ip = _LazyIpAttribute('_tunnel_near_end_ip', ipaddr.IPv4Address, _IPV4_ADDRESS_RE)
+    tunnel_far_end_ip = _LazyIpAttribute('_tunnel_far_end_ip', ipaddr.IPv4Address, _IPV4_ADDRESS_RE)
     
     def __init__(self, **kwargs):
         """ Constructor for VtunTunnel class.
         
         \param vtund_exec (optional) The exec name for the vtund utility (it is recommended to provide an absolute PATH here)
         \param vtund_use_sudo (optional) A boolean indicating whether the vtund_exec needs to be run via sudo to get root access (False by default)
-        \param tundev_shell_config A string directly coming from the devshell command 'get_vtun_parameters', that will allow to set all the attributes of this object. Warning if tundev_shell_config is provided, no other argument below is allowed (or a 'SimultaneousConfigAndAgumentsNotAllowed' exception will be raised)
+        \param vtund_helper (optional) A vtund_helper.VtundHelperClient object used to spawn and signal vtund as root instead of running sudo for each operation (vtund_use_sudo is then ignored)
+        \param vtund_config_delivery (optional) How the configuration is handed over to vtund: 'file' (default, a file in /tmp), 'memfd' (an in-memory file, nothing is written on disk) or 'private_dir' (a private directory removed when the tunnel stops), see vtund_config_delivery.py
+        \param tundev_shell_config A string directly coming from the devshell command 'get_vtun_parameters', that will allow to set all the attributes of this object. Warning if tundev_shell_config is provided, no other argument below is allowed (or a 'SimultaneousConfigAndAgumentsNotAllowed' exception will be raised), the string must then contain at least the tunnel_mode, tunnel_name and tunnel_secret lines
         \param mode A string or a TunnelMode object representing the tunnel mode. Supported values are L2, L3 and L3_multi
         \param tunnel_ip_network A string or an ipaddr.IPv4Network object containing the IP network range in use within the tunnel
         \param tunnel_near_end_ip A string or an ipaddr.IPv4Address object containing our IP address inside the tunnel (near end of the tunnel)
@@ -28,9 +107,24 @@ class VtunTunnel(object):
         \param vtun_server_tcp_port (optional, can be set to None if unknown) a string or an int describing the outer TCP port of the process handling the tunnel
         \param vtun_tunnel_name A string containing the name of the vtun tunnel.
         \param vtun_shared_secret A string containing the password for the vtun session. 
+        \param mtu (optional) The MTU of the tunnel network interface (DEFAULT_MTU by default)
+        \param tuning_profile (optional) The name of a tuning profile, or a tunnel_profile.TunnelProfile object, setting mtu and the other performance related attributes (see tunnel_profile.py). A 'TuningProfileConflict' exception is raised if one of these attributes is also given with a different value
         """
         self._vtun_pid = None    # The PID of the slave vtun process handling this tunnel
         self._vtun_process = None    # The python process object handling this tunnel
+        self.tunnel_mode = None
+        self._tunnel_ip_network = None
+        self._tunnel_near_end_ip = None
+        self._tunnel_far_end_ip = None
+        self.vtun_server_tcp_port = None
+        
+        arg_tundev_shell_config = kwargs.get('tundev_shell_config', None)  # Check if there is a tundev_shell_config argument
+        if arg_tundev_shell_config:    # If so, our attributes are taken from the config only
+            for key in _TUNDEV_SHELL_CONFIG_EXCLUSIVE_ARGS:
+                if kwargs.get(key, None) is not None:   # We also have a specific argument
+                    raise Exception('SimultaneousConfigAndAgumentsNotAllowed:' + key)
+            kwargs = dict(kwargs)
+            kwargs.update(parse_tundev_shell_config(arg_tundev_shell_config))   # Parsed first, so that the checks below also apply to the values of the config
         
         arg_vtund_exec = kwargs.get('vtund_exec', None)
         if arg_vtund_exec is None:
@@ -39,6 +133,14 @@ class VtunTunnel(object):
             self.vtund_exec = arg_vtund_exec
         
         self.vtund_use_sudo = kwargs.get('vtund_use_sudo', False)  # Do we use sudo to run subprocess vtund?
+        self.vtund_helper = kwargs.get('vtund_helper', None)  # Do we use a privileged helper to run subprocess vtund?
+        self.vtund_config_delivery = kwargs.get('vtund_config_delivery', None)
+        if not (self.vtund_config_delivery is None or self.vtund_config_delivery in CONFIG_DELIVERIES):
+            raise Exception('InvalidConfigDelivery:' + str(self.vtund_config_delivery))
+        self._vtund_config_file = None  # The VtundConfigFile object containing the configuration of the running vtund
+        arg_tuning_profile = kwargs.get('tuning_profile', None)
+        self.tuning_profile = get_profile_name(arg_tuning_profile)    # Only the name of the profile is kept, its settings are copied to our attributes
+        self.mtu = check_mtu(resolve_profile_settings(arg_tuning_profile, kwargs).get('mtu', kwargs.get('mtu', VtunTunnel.DEFAULT_MTU)))
         
         arg_vtun_tunnel_name = kwargs.get('vtun_tunnel_name', None)
         if arg_vtun_tunnel_name is None:
@@ -60,14 +162,7 @@ class VtunTunnel(object):
         self.up_additional_commands = None     #up_additional_commands A list of commands to add to the up {} section of the configuration file
         self.down_additional_commands = None   #down_additional_commands A list of commands to add to the down {} section of the configuration file
         
-        arg_tundev_shell_config = kwargs.get('tundev_shell_config', None)  # Check if there is a tundev_shell_config argument
-        if arg_tundev_shell_config:    # If so, we will generate set our attributes according to the config
-            if not (arg_tunnel_ip_network is None and arg_tunnel_near_end_ip is None and arg_tunnel_far_end_ip is None and vtun_server_tcp_port is None):    # We also have a specific argument
-                raise Exception('SimultaneousConfigAndAgumentsNotAllowed') 
-            else:
-                self.set_characteristics_from_string(arg_tundev_shell_config)
-        else:
-            self.set_characteristics(str(arg_mode), arg_tunnel_ip_network, arg_tunnel_near_end_ip, arg_tunnel_far_end_ip, arg_vtun_server_tcp_port)
+        self.set_characteristics(arg_mode, arg_tunnel_ip_network, arg_tunnel_near_end_ip, arg_tunnel_far_end_ip, arg_vtun_server_tcp_port)
 
     def set_characteristics(self, mode, tunnel_ip_network, tunnel_near_end_ip, tunnel_far_end_ip, vtun_server_tcp_port):
         """ Set this object tunnel parameters
@@ -80,13 +175,13 @@ class VtunTunnel(object):
         """
         if mode is None:
             raise Exception('TunnelModeCannotBeNone')
-        elif mode is 'L3_multi':
+        elif str(mode) == 'L3_multi':
             raise Exception('TunnelModeL3_MultiNotSupportedYet')
         
-        self.tunnel_mode = TunnelMode(str(mode))
-        self.tunnel_ip_network = ipaddr.IPv4Network(str(tunnel_ip_network))
-        self.tunnel_near_end_ip = ipaddr.IPv4Address(str(tunnel_near_end_ip))
-        self.tunnel_far_end_ip = ipaddr.IPv4Address(str(tunnel_far_end_ip))
+        self.tunnel_mode = get_tunnel_mode(str(mode))
+        self.tunnel_ip_network = _get_ip_value(tunnel_ip_network, ipaddr.IPv4Network)    # ipaddr objects are only created when these attributes are read (see _LazyIpAttribute)
+        self.tunnel_near_end_ip = _get_ip_value(tunnel_near_end_ip, ipaddr.IPv4Address)
+        self.tunnel_far_end_ip = _get_ip_value(tunnel_far_end_ip, ipaddr.IPv4Address)
         
         if vtun_server_tcp_port is None:
             self.vtun_server_tcp_port = None   # Undefined TCP ports are allowed, but we will need to specify the port before starting the tunnel!
@@ -101,12 +196,27 @@ class VtunTunnel(object):
             else:
                 raise Exception('InvalidTcpPort:' + str(tcp_port))
 
+    def set_characteristics_from_string(self, tundev_shell_config, mode = None):
+        """ Set this object tunnel parameters from the output of the devshell command 'get_vtun_parameters'
+        
+        \param tundev_shell_config A string containing 'key: value' lines (see parse_tundev_shell_config() for the supported keys)
+        \param mode (optional) A string or a TunnelMode object representing the tunnel mode, used if \p tundev_shell_config does not contain any tunnel_mode line
+        """
+        characteristics = parse_tundev_shell_config(tundev_shell_config)
+        if 'mode' in characteristics:
+            mode = characteristics['mode']
+        if 'vtun_tunnel_name' in characteristics:
+            self.set_tunnel_name(characteristics['vtun_tunnel_name'])
+        if 'vtun_shared_secret' in characteristics:
+            self.set_shared_secret(characteristics['vtun_shared_secret'])
+        self.set_characteristics(str(mode), characteristics.get('tunnel_ip_network', None), characteristics.get('tunnel_near_end_ip', None), characteristics.get('tunnel_far_end_ip', None), characteristics.get('vtun_server_tcp_port', None))
+    
     def set_shared_secret(self, key):
         """ Set the shared secret for the tunnel
         
         \param key A string containing the shared secret for the tunnel
         """
-        if re.compile(r'^[0-9]+$').search(str(key)):
+        if _ONLY_DIGITS_RE.search(str(key)):
             raise Exception('SessionSharedSecretCannotBeOnlyDigits')
         self.vtun_shared_secret = key
     
@@ -133,11 +243,11 @@ class VtunTunnel(object):
         """
         if self.tunnel_mode is None:
             return False
-        if self.tunnel_ip_network is None:
+        if self._tunnel_ip_network is None:   # Check the stored values, so that ipaddr objects are not created
             return False
-        if self.tunnel_near_end_ip is None:
+        if self._tunnel_near_end_ip is None:
             return False
-        if self.tunnel_far_end_ip is None:
+        if self._tunnel_far_end_ip is None:
             return False
         if self.vtun_shared_secret is None:
             return False
@@ -156,16 +266,46 @@ class VtunTunnel(object):
         """
         pass #Virtual
     
-    def stop(self):
-        """ Start the vtund exec (generic for server or client)
+    def stop(self, timeout = None):
+        """ Stop the vtund exec (generic for server or client)
+        
+        \param timeout (optional) The maximum time (in seconds) to wait for vtund to exit before killing it
         """
         pass #Virtual
 
+    def _deliver_vtund_config(self, vtund_config_filename, vtund_config):
+        """ Hand the configuration over to vtund, using the vtund_config_delivery method
+        
+        \param vtund_config_filename The path of the configuration file (used as is for the 'file' delivery)
+        \param vtund_config A string containing the vtund configuration
+        
+        \return The path of the configuration to provide to vtund
+        """
+        self._release_vtund_config()
+        self._vtund_config_file = deliver_vtund_config(self.vtund_config_delivery, vtund_config_filename, vtund_config)
+        return self._vtund_config_file.path
+    
+    def _release_vtund_config(self):
+        """ Release the configuration handed over to vtund (to be called once vtund has exitted)
+        """
+        if self._vtund_config_file is not None:
+            self._vtund_config_file.close()
+            self._vtund_config_file = None
+    
+    def _reattach(self, process, vtund_config_file):
+        """ Take over a vtund process handling this tunnel, that has been started by a previous instance of our program (see tunnel_journal.py)
+        
+        \param process A process_teardown.AdoptedProcess object for the vtund process
+        \param vtund_config_file The VtundConfigFile object for the configuration of this vtund process (see vtund_config_delivery.adopt_vtund_config()), or None if it could not be taken over
+        """
+        if not (self._vtun_pid is None and self._vtun_process is None):
+            raise Exception('VtundAlreadyRunning')
+        self._vtun_pid = process.pid
+        self._vtun_process = process
+        self._vtund_config_file = vtund_config_file
+    
     def get_child_of(self, pid):
-        p = subprocess.Popen('pgrep -P %d'%pid,stdout=subprocess.PIPE,shell=True)
-        children_pid  = [x for x in p.communicate()[0].split("\n") if x and x != str(p.pid)]
-        p.wait()
-        return children_pid
+        return get_child_of(pid)
 
     def set_interface_name(self, interface_name):
         self.interface_name = interface_name
@@ -186,4 +326,55 @@ class VtunTunnel(object):
         if self._vtun_process is None:
             raise Exception('VtunProcessNotLaunched')
         
-        return self._vtun_process
\ No newline at end of file
+        return self._vtun_process
+
+def get_child_of(pid):
+    """ Get the list of the children of a process
+    
+    \param pid The PID of the parent process
+    
+    \return A list of strings containing the PIDs of the children processes
+    """
+    return [str(child) for child in get_child_pids(pid)]
+
+def parse_tundev_shell_config(tundev_shell_config):
+    """ Parse the output of the devshell command 'get_vtun_parameters'
+    
+    Each non-empty line has the form 'key: value'. Supported keys are tunnel_mode, tunnel_ip_network, tunnel_ip_prefix (for example '/30'), tunnel_ip_netmask, tunnel_near_end_ip, tunnel_far_end_ip, tunnel_vtun_server_tcp_port, tunnel_name and tunnel_secret. Unknown keys are ignored
+    When tunnel_ip_network does not contain any prefix length, it is taken from tunnel_ip_prefix or tunnel_ip_netmask
+    
+    \param tundev_shell_config A string (or a list of lines)
+    
+    \return A dict of VtunTunnel constructor arguments (mode, tunnel_ip_network, tunnel_near_end_ip, tunnel_far_end_ip, vtun_server_tcp_port, vtun_tunnel_name, vtun_shared_secret), containing only the keys that were found. An 'InvalidTundevShellConfigLine' or 'InconsistentTundevShellConfig' exception is raised if \p tundev_shell_config is malformed
+    """
+    if isinstance(tundev_shell_config, _string_types) or not hasattr(tundev_shell_config, '__iter__'):
+        lines = str(tundev_shell_config).splitlines()
+    else:
+        lines = tundev_shell_config
+    values = {}
+    for line in lines:
+        match = _TUNDEV_SHELL_CONFIG_LINE_RE.match(line)
+        if match is None:
+            if line.strip():
+                raise Exception('InvalidTundevShellConfigLine:' + line.strip())
+            continue
+        argument = _TUNDEV_SHELL_CONFIG_KEYS.get(match.group(1), None)
+        if argument is not None:
+            values[argument] = match.group(2)
+    
+    prefix = values.pop('tunnel_ip_prefix', None)
+    netmask = values.pop('tunnel_ip_netmask', None)
+    if prefix is not None:
+        prefix = prefix.lstrip('/')
+        if netmask is not None and ipaddr.IPv4Network('0.0.0.0/' + netmask).prefixlen != ipaddr.IPv4Network('0.0.0.0/' + prefix).prefixlen:
+            raise Exception('InconsistentTundevShellConfig:tunnel_ip_netmask')
+    elif netmask is not None:
+        prefix = netmask
+    network = values.get('tunnel_ip_network', None)
+    if network is not None and prefix is not None:
+        if '/' in network:
+            if ipaddr.IPv4Network(network).prefixlen != ipaddr.IPv4Network('0.0.0.0/' + prefix).prefixlen:
+                raise Exception('InconsistentTundevShellConfig:tunnel_ip_network')
+        else:
+            values['tunnel_ip_network'] = network + '/' + prefix
+    return values
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Ways of handing its configuration over to vtund (see the vtund_config_delivery argument of tunnel objects)
+
+'file' (the default) writes a configuration file with a fixed name in /tmp, that is kept after vtund exits.
+'memfd' keeps the configuration in an anonymous memory file (Linux 3.17 or later), that vtund reads via /proc/<our PID>/fd/<fd>: nothing is written on disk.
+'private_dir' writes the configuration in a private directory (on /dev/shm when available), that is removed once the tunnel is stopped
+"""
+
+from __future__ import print_function
+
+from vtund_config_renderer import write_config_file
+
+import ctypes
+import ctypes.util
+import os
+import shutil
+import tempfile
+
+CONFIG_DELIVERY_FILE = 'file'
+CONFIG_DELIVERY_MEMFD = 'memfd'
+CONFIG_DELIVERY_PRIVATE_DIR = 'private_dir'
+
+CONFIG_DELIVERIES = [CONFIG_DELIVERY_FILE, CONFIG_DELIVERY_MEMFD, CONFIG_DELIVERY_PRIVATE_DIR]
+
+_MFD_CLOEXEC = 1
+
+_libc = None
+
+def _memfd_create(name):
+    """ Create an anonymous memory file
+
+    \return A file descriptor (to close with os.close()). A 'MemfdNotSupported' exception is raised if memfd_create() is not available
+    """
+    if hasattr(os, 'memfd_create'):
+        try:
+            return os.memfd_create(name, _MFD_CLOEXEC)
+        except OSError:
+            raise Exception('MemfdNotSupported')
+    global _libc
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = _libc.memfd_create(name.encode('utf-8'), _MFD_CLOEXEC)
+    except (OSError, AttributeError):   # libc older than glibc 2.27
+        raise Exception('MemfdNotSupported')
+    if fd < 0:
+        raise Exception('MemfdNotSupported')
+    return fd
+
+class VtundConfigFile(object):
+    """ Class representing the configuration of one vtund process, as delivered to vtund (base class, for the 'file' delivery) """
+
+    def __init__(self, filename, config):
+        """ Constructor
+
+        \param filename The path of the configuration file
+        \param config A string containing the vtund configuration
+        """
+        self.path = filename   # The path to provide to vtund (-f)
+        self.config = None  # The configuration currently delivered
+        self.update(config)
+
+    def update(self, config):
+        """ Replace the configuration (before sending SIGHUP to vtund for example)
+
+        \param config A string containing the vtund configuration
+        """
+        try:
+            write_config_file(self.path, config)
+        except Exception:
+            raise Exception('ConfigurationFileWritingIssue')
+        self.config = config
+
+    def close(self):
+        """ Release the resources used by the configuration, once vtund has exitted (the 'file' delivery keeps the file, so that it can be reused on next start)
+        """
+        pass
+
+    @classmethod
+    def _adopt(cls, path, config):
+        """ Create an object for a configuration that has already been delivered (see adopt_vtund_config())
+        """
+        config_file = cls.__new__(cls)
+        config_file.path = path
+        config_file.config = config
+        return config_file
+
+class MemfdVtundConfigFile(VtundConfigFile):
+    """ Class representing a vtund configuration kept in an anonymous memory file """
+
+    def __init__(self, name, config):
+        """ Constructor
+
+        \param name A name for the memory file (only used for debugging, it shows in /proc/<PID>/fd)
+        \param config A string containing the vtund configuration
+        """
+        self._fd = _memfd_create(name)
+        self.path = '/proc/' + str(os.getpid()) + '/fd/' + str(self._fd)  # Not /proc/self, that would be vtund's own fd table
+        self.config = None
+        try:
+            self.update(config)
+        except Exception:
+            self.close()
+            raise
+
+    def update(self, config):
+        data = config.encode('utf-8') if not isinstance(config, bytes) else config
+        os.ftruncate(self._fd, 0)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+        self.config = config
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class PrivateDirVtundConfigFile(VtundConfigFile):
+    """ Class representing a vtund configuration written in a private directory, removed on close() """
+
+    def __init__(self, name, config):
+        """ Constructor
+
+        \param name The basename of the configuration file
+        \param config A string containing the vtund configuration
+        """
+        tmpfs = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self._dir = tempfile.mkdtemp(prefix='vtund-', dir=tmpfs) # Only accessible to us (and root)
+        try:
+            super(PrivateDirVtundConfigFile, self).__init__(os.path.join(self._dir, name), config)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    @classmethod
+    def _adopt(cls, path, config):
+        config_file = super(PrivateDirVtundConfigFile, cls)._adopt(path, config)
+        config_file._dir = os.path.dirname(path)
+        return config_file
+
+def deliver_vtund_config(delivery, filename, config):
+    """ Hand a vtund configuration over using the delivery method \p delivery
+
+    \param delivery One of CONFIG_DELIVERIES (None means CONFIG_DELIVERY_FILE)
+    \param filename The path of the configuration file for the 'file' delivery (its basename is used to name the configuration for the other deliveries)
+    \param config A string containing the vtund configuration
+
+    \return A VtundConfigFile object, whose path attribute is to be provided to vtund. Its close() method is to be called once vtund has exitted
+    """
+    if delivery is None or delivery == CONFIG_DELIVERY_FILE:
+        return VtundConfigFile(filename, config)
+    elif delivery == CONFIG_DELIVERY_MEMFD:
+        return MemfdVtundConfigFile(os.path.basename(filename), config)
+    elif delivery == CONFIG_DELIVERY_PRIVATE_DIR:
+        return PrivateDirVtundConfigFile(os.path.basename(filename), config)
+    else:
+        raise Exception('InvalidConfigDelivery:' + str(delivery))
+
+def adopt_vtund_config(delivery, path):
+    """ Take over a configuration handed over to a vtund process that is still running, by a previous instance of our program (see tunnel_journal.py)
+
+    \param delivery One of CONFIG_DELIVERIES (None means CONFIG_DELIVERY_FILE)
+    \param path The path that was provided to vtund
+
+    \return A VtundConfigFile object (see deliver_vtund_config()), or None if the configuration cannot be taken over. This is always the case for the 'memfd' delivery, as the memory file was closed when our previous instance exitted
+    """
+    if delivery == CONFIG_DELIVERY_MEMFD or path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            config = f.read().decode('utf-8')
+    except IOError:
+        return None
+    if delivery is None or delivery == CONFIG_DELIVERY_FILE:
+        return VtundConfigFile._adopt(path, config)
+    elif delivery == CONFIG_DELIVERY_PRIVATE_DIR:
+        return PrivateDirVtundConfigFile._adopt(path, config)
+    else:
+        raise Exception('InvalidConfigDelivery:' + str(delivery))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Rendering of vtund configuration files, shared by ClientVtunTunnel, ServerVtunTunnel and ServerVtunTunnelPool
+
+The invariant parts of the configuration are kept in templates filled in with one single formatting operation, and rendered sections are cached by parameters, so that restarting many tunnels does not render their configuration again.
+Shared secrets are never cached: sections are cached as the parts before and after the secret, which is inserted on each call.
+Configuration files are only rewritten (atomically) when their content changes
+"""
+
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+_SERVER_OPTIONS_TEMPLATE = 'options {\n\tport %(port)s;\n%(bindaddr)s\tsyslog daemon;\n\tppp /usr/sbin/pppd;\n\tifconfig /sbin/ifconfig;\n\troute /sbin/route;\n\tip /sbin/ip;\n}\n'
+_CLIENT_OPTIONS_TEMPLATE = 'options {\n\tport %(port)s;\n\ttimeout %(timeout)s;\n\tppp /usr/sbin/pppd;\n\tifconfig /sbin/ifconfig;\n\troute /sbin/route;\n\tip /sbin/ip;\n}\n'
+_BINDADDR_TEMPLATE = '\tbindaddr { iface %s; };\n'
+_SECTION_HEAD_TEMPLATE = '%(name)s {\n%(device)s\tpasswd '    # Sections are rendered as the part before the shared secret and the part after it
+_SERVER_SECTION_TAIL_TEMPLATE = ';\n\ttype %(type)s;\n\tproto %(proto)s;\n\tcompress %(compress)s;\n\tencrypt %(encrypt)s;\n\tkeepalive %(keepalive)s;\n \n%(up_down)s}\n'
+_CLIENT_SECTION_TAIL_TEMPLATE = ';\n%(tuning)s\tpersist no;\n\n%(up_down)s}\n'
+_DEVICE_TEMPLATE = '\tdevice %s;\n'
+_UP_DOWN_TEMPLATE = '\tup {\n\t\tifconfig "%%%% %(near)s pointopoint %(far)s mtu %(mtu)s";\n%(up)s\t};\n\tdown {\n%(down)s\t};\n'
+_PROGRAM_TEMPLATE = '\t\tprogram %s;\n'
+_CLIENT_TUNING_TEMPLATES = ['\tproto %s;\n', '\tcompress %s;\n', '\tencrypt %s;\n', '\tkeepalive %s;\n']  # Lines written for the protocol, compression, encryption and keepalive of clients (when they are set)
+
+RENDER_CACHE_MAX_SIZE = 4096    # Maximum number of rendered sections kept in cache (the least recently used ones are evicted first)
+
+_render_cache = collections.OrderedDict()   # Rendered sections, from the least to the most recently used
+_render_cache_lock = threading.Lock()
+_written_files = {}  # Digest and (size, mtime) of the configuration files we wrote, indexed by filename
+_written_files_lock = threading.Lock()
+
+def _cached(key, render):
+    """ Get a rendered string from the cache, or render it with \p render() and cache it
+    """
+    with _render_cache_lock:
+        rendered = _render_cache.pop(key, None)
+        if rendered is not None:
+            _render_cache[key] = rendered   # Now the most recently used
+            return rendered
+    rendered = render()
+    with _render_cache_lock:
+        _render_cache[key] = rendered
+        while len(_render_cache) > RENDER_CACHE_MAX_SIZE:
+            _render_cache.popitem(last=False)
+    return rendered
+
+def _render_programs(commands):
+    if not commands:
+        return ''
+    programs = []
+    for command in commands:
+        if command[0] != '/':
+            raise Exception('NotAFullPathCommand')
+        programs.append(_PROGRAM_TEMPLATE % command)
+    return ''.join(programs)
+
+def _render_up_down(near_end_ip, far_end_ip, mtu, up_commands, down_commands):
+    return _UP_DOWN_TEMPLATE % {'near': near_end_ip, 'far': far_end_ip, 'mtu': mtu, 'up': _render_programs(up_commands), 'down': _render_programs(down_commands)}
+
+def _optional_yes_no(value):
+    if value is None:
+        return None
+    return 'yes' if value else 'no'
+
+def _render_client_tuning(tuning):
+    return ''.join([template % value for (template, value) in zip(_CLIENT_TUNING_TEMPLATES, tuning) if value is not None])
+
+def _render_section_head(tunnel):
+    return _SECTION_HEAD_TEMPLATE % {'name': tunnel.vtun_tunnel_name, 'device': _DEVICE_TEMPLATE % tunnel.interface_name if tunnel.interface_name is not None else ''}
+
+def render_server_options(port, restricted_iface = None):
+    """ Render the global options {} section of a vtund server configuration
+
+    \param port The TCP port the server listens on
+    \param restricted_iface (optional) The network interface the server is restricted to
+
+    \return A string
+    """
+    key = ('server_options', str(port), restricted_iface)
+    return _cached(key, lambda: _SERVER_OPTIONS_TEMPLATE % {'port': port, 'bindaddr': _BINDADDR_TEMPLATE % restricted_iface if restricted_iface else ''})
+
+def render_client_options(port, timeout):
+    """ Render the global options {} section of a vtund client configuration
+
+    \param port The TCP port of the server
+    \param timeout The connection timeout (in seconds)
+
+    \return A string
+    """
+    key = ('client_options', str(port), str(timeout))
+    return _cached(key, lambda: _CLIENT_OPTIONS_TEMPLATE % {'port': port, 'timeout': timeout})
+
+def render_server_section(tunnel):
+    """ Render the section of a tunnel (named after its vtun_tunnel_name) in a vtund server configuration
+
+    \param tunnel A ServerVtunTunnel object
+
+    \return A string
+    """
+    up_commands = tuple(tunnel.up_additional_commands) if tunnel.up_additional_commands else None
+    down_commands = tuple(tunnel.down_additional_commands) if tunnel.down_additional_commands else None
+    key = ('server_section', tunnel.vtun_tunnel_name, tunnel.interface_name, str(tunnel.tunnel_mode), tunnel.vtun_protocol, tunnel.vtun_compression, bool(tunnel.vtun_encryption), bool(tunnel.vtun_keepalive), str(tunnel.mtu), str(tunnel._tunnel_near_end_ip), str(tunnel._tunnel_far_end_ip), up_commands, down_commands)
+    def render():
+        return (_render_section_head(tunnel), _SERVER_SECTION_TAIL_TEMPLATE % {
+            'type': tunnel.tunnel_mode.get_equivalent_vtun_type(),
+            'proto': tunnel.vtun_protocol,
+            'compress': tunnel.vtun_compression,
+            'encrypt': 'yes' if tunnel.vtun_encryption else 'no',
+            'keepalive': 'yes' if tunnel.vtun_keepalive else 'no',
+            'up_down': _render_up_down(tunnel._tunnel_near_end_ip, tunnel._tunnel_far_end_ip, tunnel.mtu, up_commands, down_commands),
+        })
+    (head, tail) = _cached(key, render)
+    return head + str(tunnel.vtun_shared_secret) + tail
+
+def render_client_section(tunnel, use_cache = True):
+    """ Render the section of a tunnel (named after its vtun_tunnel_name) in a vtund client configuration
+
+    \param tunnel A ClientVtunTunnel object
+    \param use_cache (optional) If False, the section is rendered without being looked up or stored in the cache (for configurations rendered only once, see client_config_bundle.py)
+
+    \return A string
+    """
+    up_commands = tuple(tunnel.up_additional_commands) if tunnel.up_additional_commands else None
+    down_commands = tuple(tunnel.down_additional_commands) if tunnel.down_additional_commands else None
+    tuning = (tunnel.vtun_protocol, tunnel.vtun_compression, _optional_yes_no(tunnel.vtun_encryption), _optional_yes_no(tunnel.vtun_keepalive))   # Only the values that are set (not None) are written
+    key = ('client_section', str(tunnel.vtun_tunnel_name), tunnel.interface_name, tuning, str(tunnel.mtu), str(tunnel._tunnel_near_end_ip), str(tunnel._tunnel_far_end_ip), up_commands, down_commands)
+    def render():
+        return (_render_section_head(tunnel), _CLIENT_SECTION_TAIL_TEMPLATE % {
+            'tuning': _render_client_tuning(tuning),
+            'up_down': _render_up_down(tunnel._tunnel_near_end_ip, tunnel._tunnel_far_end_ip, tunnel.mtu, up_commands, down_commands),
+        })
+    if not use_cache:
+        (head, tail) = render()
+    else:
+        (head, tail) = _cached(key, render)
+    return head + str(tunnel.vtun_shared_secret) + tail
+
+def clear_cache():
+    """ Forget all rendered sections, and the configuration files we know to be up to date
+    """
+    with _render_cache_lock:
+        _render_cache.clear()
+    with _written_files_lock:
+        _written_files.clear()
+
+def write_config_file(filename, config):
+    """ Save a vtund configuration to a file, unless this file already has the same content
+
+    The file is written to a temporary file in the same directory (readable by its owner only, as the configuration contains the shared secret), then renamed, so that vtund never reads a partially written configuration
+
+    \param filename The path of the file to write
+    \param config A string containing the vtund configuration
+
+    \return True if the file has been written, False if it was already up to date
+    """
+    data = config.encode('utf-8') if not isinstance(config, bytes) else config
+    digest = hashlib.sha1(data).digest()
+    try:
+        st = os.stat(filename)
+        file_id = (st.st_size, st.st_mtime)
+    except OSError:
+        file_id = None
+    if file_id is not None:
+        with _written_files_lock:
+            known = _written_files.get(filename, None)
+        if known is not None and known[1] == file_id:   # File has not been modified since we wrote it
+            if known[0] == digest:
+                return False
+        elif file_id[0] == len(data):   # File written by another process (or before we were started), compare its content
+            try:
+                with open(filename, 'rb') as f:
+                    if f.read() == data:
+                        with _written_files_lock:
+                            _written_files[filename] = (digest, file_id)
+                        return False
+            except IOError:
+                pass
+
+    (fd, tmp_filename) = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', dir=os.path.dirname(filename) or '.')
+    try:
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmp_filename, filename)
+    except Exception:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+    st = os.stat(filename)
+    with _written_files_lock:
+        _written_files[filename] = (digest, (st.st_size, st.st_mtime))
+    return True
@@ -0,0 +1,376 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Privileged helper spawning, signalling and reaping vtund processes on behalf of unprivileged tunnel objects
+
+The helper is a long-lived process run as root (for example 'sudo python vtund_helper.py --socket /run/vtund-helper.sock --uid 1000 --allow-exec /usr/sbin/vtund').
+Tunnel objects given a VtundHelperClient (vtund_helper argument) talk to it over a local Unix socket instead of running sudo for each operation.
+
+The protocol is one JSON object per line. Each request contains a batch of commands ({"commands": [...]}), and gets one response with a result per command ({"results": [...]})
+"""
+
+from __future__ import print_function
+
+from process_teardown import wait_for_exit
+
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_O_PATH = getattr(os, 'O_PATH', 0o10000000)  # Linux value (os.O_PATH only exists in Python 3.4+)
+
+class _HelperConnection(object):
+    """ Class representing a client connection to a VtundHelperServer """
+
+    def __init__(self, sock, uid):
+        self.sock = sock
+        self.uid = uid  # The UID of the peer
+        self.input_buf = b''    # Received data not forming a whole request line yet
+        self.output_buf = b''   # Responses not sent yet
+
+class VtundHelperServer(object):
+    """ Class implementing the privileged side of the helper (to be run as root) """
+
+    def __init__(self, socket_path, allowed_uids, allowed_execs):
+        """ Constructor
+
+        \param socket_path The path of the Unix socket to listen on
+        \param allowed_uids A list of int containing the UIDs allowed to connect (root is always allowed)
+        \param allowed_execs A list of strings containing the absolute paths of the executables the helper accepts to spawn (typically only vtund)
+        """
+        self.socket_path = socket_path
+        self.allowed_uids = set(allowed_uids) | set([0])
+        self.allowed_execs = set(allowed_execs)
+        self._processes = {}    # subprocess.Popen objects spawned by the helper, indexed by PID
+        self._exit_values = {}  # Exit values of spawned processes that have not been reported yet, indexed by PID
+
+    MAX_BUFFER_SIZE = 1048576   # Maximum size (in bytes) of the pending input or output of one connection, above which the connection is dropped
+
+    def serve_forever(self):
+        """ Listen on the socket and handle requests (this method never returns)
+
+        Connections are non-blocking: a client that resets its connection, or that does not read its responses, only gets its own connection dropped
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o666) # Access control is done on the peer credentials of each connection
+        listener.listen(16)
+        connections = {}    # _HelperConnection objects, indexed by socket
+        while True:
+            try:
+                (readable, writable, exceptional) = select.select([listener] + list(connections.keys()), [sock for (sock, conn) in connections.items() if conn.output_buf], [], 1)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                if sock is listener:
+                    self._accept(listener, connections)
+                elif sock in connections:
+                    self._receive(connections[sock], connections)
+            for sock in writable:
+                if sock in connections:
+                    self._send(connections[sock], connections)
+            self._reap()
+
+    def _accept(self, listener, connections):
+        try:
+            (sock, addr) = listener.accept()
+        except socket.error:
+            return
+        try:
+            uid = self._get_peer_uid(sock)
+        except socket.error:
+            uid = None
+        if not uid in self.allowed_uids:
+            sock.close()
+            return
+        sock.setblocking(False)
+        connections[sock] = _HelperConnection(sock, uid)
+
+    def _drop(self, conn, connections):
+        del connections[conn.sock]
+        conn.sock.close()
+
+    def _receive(self, conn, connections):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return
+            data = b''  # Connection reset
+        if not data:
+            self._drop(conn, connections)
+            return
+        buf = conn.input_buf + data
+        while b'\n' in buf:
+            (line, buf) = buf.split(b'\n', 1)
+            conn.output_buf += self._handle_request(line, conn.uid) + b'\n'
+        conn.input_buf = buf
+        if len(conn.input_buf) > VtundHelperServer.MAX_BUFFER_SIZE or len(conn.output_buf) > VtundHelperServer.MAX_BUFFER_SIZE:
+            self._drop(conn, connections)
+            return
+        self._send(conn, connections)   # Most of the time, the response can be sent right away
+
+    def _send(self, conn, connections):
+        try:
+            sent = conn.sock.send(conn.output_buf)
+        except socket.error as e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return
+            self._drop(conn, connections)   # Broken pipe or connection reset
+            return
+        conn.output_buf = conn.output_buf[sent:]
+
+    def _get_peer_uid(self, conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_PEERCRED', 17), struct.calcsize('3i'))
+        (pid, uid, gid) = struct.unpack('3i', creds)
+        return uid
+
+    def _reap(self):
+        """ Collect the exit values of the spawned processes that have exitted
+        """
+        for (pid, proc) in list(self._processes.items()):
+            exit_value = proc.poll()
+            if exit_value is not None:
+                del self._processes[pid]
+                self._exit_values[pid] = exit_value
+
+    def _handle_request(self, line, uid):
+        try:
+            commands = json.loads(line.decode('utf-8'))['commands']
+        except (ValueError, KeyError, TypeError):
+            return json.dumps({'error': 'InvalidRequest'}).encode('utf-8')
+        results = []
+        for command in commands:
+            try:
+                result = self._handle_command(command, uid)
+                result['ok'] = True
+            except Exception as e:
+                result = {'ok': False, 'error': str(e)}
+            results.append(result)
+        return json.dumps({'results': results}).encode('utf-8')
+
+    def _handle_command(self, command, uid):
+        cmd = command.get('cmd', None)
+        if cmd == 'spawn':
+            return self._spawn(command['args'], command.get('stdout', None), uid)
+        elif cmd == 'signal':
+            target = int(command['pid'])
+            try:
+                pgid = os.getpgid(target)
+            except OSError:
+                return {'found': False}
+            if not pgid in self._processes:  # Only processes spawned by ourselves (session leaders) and their descendants can be signalled
+                raise Exception('UnknownProcess:' + str(target))
+            if command.get('group', False):
+                os.killpg(target, int(command['signal']))   # Spawned processes are session (thus process group) leaders
+            else:
+                os.kill(target, int(command['signal']))
+            return {'found': True}
+        elif cmd == 'poll':
+            pid = int(command['pid'])
+            self._reap()
+            if pid in self._processes:
+                return {'exit_value': None}
+            if pid in self._exit_values:
+                return {'exit_value': self._exit_values.pop(pid)}
+            raise Exception('UnknownProcess:' + str(pid))
+        else:
+            raise Exception('UnknownCommand:' + str(cmd))
+
+    def _spawn(self, args, stdout_path, uid):
+        """ Spawn a process in a new session
+
+        \param args The command line (as a list). Its first element must be one of the allowed executables
+        \param stdout_path The path of a FIFO on which the process stdout and stderr are sent (or None to discard output). It must be owned by \p uid
+        \param uid The UID of the client requesting the spawn
+
+        \return A dict containing the PID of the new process
+        """
+        if not args or not args[0] in self.allowed_execs:
+            raise Exception('ExecNotAllowed:' + str(args[0] if args else None))
+        if stdout_path is None:
+            stdout_fd = os.open(os.devnull, os.O_WRONLY)
+        else:
+            stdout_fd = self._open_stdout_fifo(stdout_path, uid)
+        try:
+            proc = subprocess.Popen(args, shell=False, close_fds=True, stdin=open(os.devnull, 'r'), stdout=stdout_fd, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        finally:
+            os.close(stdout_fd)
+        self._processes[proc.pid] = proc
+        return {'pid': proc.pid}
+
+    def _open_stdout_fifo(self, path, uid):
+        """ Open the write end of a FIFO created by a client
+
+        We run as root: the path is first opened with O_PATH (which does not open the file itself, so a device node given instead of a FIFO has no side effect), checked, and only then reopened for writing through /proc/self/fd, so that it cannot be replaced in the meantime
+
+        \return A file descriptor (in blocking mode). A 'StdoutIsNotAFifo' exception is raised if \p path is not a FIFO owned by \p uid
+        """
+        path_fd = os.open(path, _O_PATH | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            st = os.fstat(path_fd)
+            if not stat.S_ISFIFO(st.st_mode) or st.st_uid != uid:
+                raise Exception('StdoutIsNotAFifo')
+            stdout_fd = os.open('/proc/self/fd/' + str(path_fd), os.O_WRONLY | os.O_NONBLOCK)  # Does not block, as the client has already opened the read end
+        finally:
+            os.close(path_fd)
+        flags = fcntl.fcntl(stdout_fd, fcntl.F_GETFL)
+        fcntl.fcntl(stdout_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return stdout_fd
+
+class VtundHelperProcess(object):
+    """ Class representing a process spawned by the helper, with the subset of the subprocess.Popen interface used by tunnel objects """
+
+    def __init__(self, helper, pid, stdout = None, fifo_dir = None):
+        self._helper = helper
+        self.pid = pid
+        self.stdout = stdout    # A file object reading the process output (if captured)
+        self.returncode = None
+        self._fifo_dir = fifo_dir
+        self._poll_lock = threading.Lock()  # The helper reports the exit value only once, while we may be polled from several threads
+
+    def poll(self):
+        with self._poll_lock:
+            if self.returncode is None:
+                self.returncode = self._helper.call([{'cmd': 'poll', 'pid': self.pid}])[0]['exit_value']
+                if self.returncode is not None:
+                    self._cleanup_fifo()
+            return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            wait_for_exit(self.pid, 1)
+            time.sleep(0.001) # The helper reaps the process as soon as we poll it again
+        return self.returncode
+
+    def send_signal(self, sig):
+        self._helper.send_signals([self.pid], sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def _cleanup_fifo(self):
+        if self._fifo_dir is not None:
+            try:
+                os.remove(os.path.join(self._fifo_dir, 'stdout'))
+                os.rmdir(self._fifo_dir)
+            except OSError:
+                pass
+            self._fifo_dir = None
+
+class VtundHelperClient(object):
+    """ Class implementing the unprivileged side of the helper: a persistent connection to a VtundHelperServer """
+
+    def __init__(self, socket_path):
+        """ Constructor
+
+        \param socket_path The path of the Unix socket the VtundHelperServer listens on
+        """
+        self.socket_path = socket_path
+        self._sock = None
+        self._buf = b''
+        self._lock = threading.Lock()
+
+    def call(self, commands):
+        """ Send a batch of commands to the helper in one single request
+
+        \param commands A list of dicts, each describing one command ('spawn', 'signal' or 'poll')
+
+        \return A list of dicts containing the results. An Exception is raised if one of the commands failed
+        """
+        request = json.dumps({'commands': commands}).encode('utf-8') + b'\n'
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._sock.connect(self.socket_path)
+                    self._buf = b''
+                self._sock.sendall(request)
+                while not b'\n' in self._buf:
+                    data = self._sock.recv(65536)
+                    if not data:
+                        raise socket.error(errno.ECONNRESET, 'Helper closed the connection')
+                    self._buf += data
+            except socket.error:
+                self.close()
+                raise Exception('VtundHelperUnreachable:' + str(self.socket_path))
+            (line, self._buf) = self._buf.split(b'\n', 1)
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise Exception(response['error'])
+        for result in response['results']:
+            if not result['ok']:
+                raise Exception(result['error'])
+        return response['results']
+
+    def popen(self, args, capture_output = False):
+        """ Spawn a process (as root) via the helper
+
+        \param args The command line (as a list)
+        \param capture_output If True, the stdout and stderr of the process can be read from the stdout attribute of the returned object (via a private FIFO)
+
+        \return A VtundHelperProcess object
+        """
+        if not capture_output:
+            pid = self.call([{'cmd': 'spawn', 'args': args}])[0]['pid']
+            return VtundHelperProcess(self, pid)
+        fifo_dir = tempfile.mkdtemp(prefix='vtund-helper-')
+        fifo_path = os.path.join(fifo_dir, 'stdout')
+        os.mkfifo(fifo_path, 0o600)  # The helper runs as root, so it can open it for writing anyway
+        stdout_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            pid = self.call([{'cmd': 'spawn', 'args': args, 'stdout': fifo_path}])[0]['pid']
+        except Exception:
+            os.close(stdout_fd)
+            os.remove(fifo_path)
+            os.rmdir(fifo_dir)
+            raise
+        return VtundHelperProcess(self, pid, os.fdopen(stdout_fd, 'rb'), fifo_dir)
+
+    def send_signals(self, targets, sig):
+        """ Signal processes spawned by the helper, in one single request
+
+        \param targets A list of int: positive values are PIDs, negative values are process groups
+        \param sig The signal number to send
+        """
+        self.call([{'cmd': 'signal', 'pid': abs(target), 'group': target < 0, 'signal': int(sig)} for target in targets])
+
+    def close(self):
+        """ Close the connection to the helper (it will be reopened on next call)
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+def main(argv):
+    import optparse
+    parser = optparse.OptionParser(usage='%prog --socket PATH --uid UID --allow-exec PATH')
+    parser.add_option('--socket', dest='socket_path', help='The path of the Unix socket to listen on')
+    parser.add_option('--uid', dest='uids', type='int', action='append', default=[], help='An UID allowed to connect (may be repeated)')
+    parser.add_option('--allow-exec', dest='execs', action='append', default=[], help='An executable the helper accepts to spawn (may be repeated)')
+    (options, args) = parser.parse_args(argv)
+    if options.socket_path is None or not options.execs:
+        parser.error('--socket and --allow-exec are mandatory')
+    VtundHelperServer(options.socket_path, options.uids, options.execs).serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from process_teardown import pidfd_open, _is_process_gone
+
+import errno
+import fcntl
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+
+class VtundOutputReactor(object):
+    """ Class multiplexing the console output pipes of many vtund processes in one single thread (using epoll, or poll when epoll is not available)
+
+    For each registered pipe, a data callback is called with each chunk of output, and an EOF callback is called once the pipe is closed (process exitting).
+    Process exits can also be watched with watch_exit() (via pidfds, in the same poll), and callbacks can be scheduled with call_later(). All callbacks are run from the reactor thread, so they should return quickly
+    """
+
+    READ_SIZE = 65536
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {} # (on_data, on_eof) tuples indexed by file descriptor (on_data is None for pidfds, that are not read)
+        self._exit_watches = {} # [pidfd (or None when polling /proc instead), callbacks] lists indexed by watched PID
+        self._timers = []   # Heap of (time, sequence, callback) tuples
+        self._timer_sequence = 0
+        self._thread = None
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._poll_flags = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self._poll_timeout_scale = 1    # epoll.poll() timeout is in seconds
+        else:
+            self._poller = select.poll()
+            self._poll_flags = select.POLLIN | select.POLLHUP | select.POLLERR
+            self._poll_timeout_scale = 1000 # poll.poll() timeout is in milliseconds
+        (self._wakeup_read_fd, self._wakeup_write_fd) = os.pipe()   # Allows to interrupt a blocking poll when timers or handlers change
+        _set_nonblocking(self._wakeup_read_fd)
+        _set_nonblocking(self._wakeup_write_fd)
+        self._poller.register(self._wakeup_read_fd, self._poll_flags)
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run)
+                self._thread.daemon = True   # The reactor should be forced to terminate when main program exits
+                self._thread.start()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write_fd, b'\0')
+        except OSError:
+            pass    # Pipe is full, the reactor will wake up anyway
+
+    def register(self, fd, on_data, on_eof):
+        """ Start watching a pipe
+
+        \param fd The file descriptor (as an int) to read from. It will be switched to non-blocking mode
+        \param on_data A function called with each chunk of data read from \p fd (a string, or bytes under Python 3)
+        \param on_eof A function (without arguments) called once EOF is reached on \p fd. \p fd is unregistered (but not closed) before the call
+        """
+        _set_nonblocking(fd)
+        with self._lock:
+            if fd in self._handlers:
+                raise Exception('FileDescriptorAlreadyRegistered:' + str(fd))
+            self._handlers[fd] = (on_data, on_eof)
+            self._poller.register(fd, self._poll_flags)
+        self._ensure_running()
+        self._wakeup()
+
+    def unregister(self, fd):
+        """ Stop watching a pipe (the EOF callback will not be called)
+
+        \param fd The file descriptor previously given to register()
+        """
+        with self._lock:
+            if self._handlers.pop(fd, None) is not None:
+                try:
+                    self._poller.unregister(fd)
+                except (IOError, OSError, KeyError, ValueError):
+                    pass    # fd has already been closed
+        self._wakeup()
+
+    def watch_exit(self, pid, callback):
+        """ Start watching the exit of a process (that does not need to be our child)
+
+        A pidfd is registered in the poll when supported (Linux 5.3 or later), /proc is otherwise checked with a backoff from 1ms to 500ms.
+        Several callbacks can watch the same process
+
+        \param pid The PID of the process
+        \param callback A function (without arguments) called once the process has exitted (the watch is then removed)
+        """
+        pid = int(pid)
+        with self._lock:
+            watch = self._exit_watches.get(pid, None)
+            if watch is not None:
+                watch[1].append(callback)
+                return
+        pidfd = pidfd_open(pid)
+        watch = [pidfd, [callback]]
+        with self._lock:
+            if pid in self._exit_watches:   # Watched concurrently
+                self._exit_watches[pid][1].append(callback)
+                if pidfd is not None:
+                    os.close(pidfd)
+                return
+            self._exit_watches[pid] = watch
+            if pidfd is not None:
+                self._handlers[pidfd] = (None, lambda: self._on_exit(pid, watch))
+                self._poller.register(pidfd, self._poll_flags)
+        if pidfd is None:
+            self.call_later(0.001, lambda: self._check_exit(pid, watch, 0.001))
+        else:
+            self._ensure_running()
+            self._wakeup()
+
+    def unwatch_exit(self, pid, callback = None):
+        """ Stop watching the exit of a process (the callback will not be called)
+
+        \param pid The PID previously given to watch_exit()
+        \param callback (optional) The callback previously given to watch_exit() (all callbacks watching \p pid are removed if None)
+        """
+        pid = int(pid)
+        with self._lock:
+            watch = self._exit_watches.get(pid, None)
+            if watch is None:
+                return
+            if callback is not None:
+                if callback in watch[1]:
+                    watch[1].remove(callback)
+                if watch[1]:
+                    return  # Still watched by other callbacks
+            del self._exit_watches[pid]
+        if watch[0] is not None:
+            self.unregister(watch[0])
+            os.close(watch[0])
+
+    def _on_exit(self, pid, watch):
+        with self._lock:
+            if self._exit_watches.get(pid, None) is not watch:
+                return  # Unwatched in the meantime
+            del self._exit_watches[pid]
+        os.close(watch[0])
+        for callback in watch[1]:
+            _run_callback(callback)
+
+    def _check_exit(self, pid, watch, interval):
+        with self._lock:
+            if self._exit_watches.get(pid, None) is not watch:
+                return  # Unwatched in the meantime
+            exitted = _is_process_gone(pid)
+            if exitted:
+                del self._exit_watches[pid]
+        if exitted:
+            for callback in watch[1]:
+                _run_callback(callback)
+        else:
+            next_interval = min(interval * 2, 0.5)
+            self.call_later(next_interval, lambda: self._check_exit(pid, watch, next_interval))
+
+    def call_later(self, delay, callback):
+        """ Schedule a function to be called from the reactor thread
+
+        \param delay The delay (in seconds) after which \p callback should be called
+        \param callback A function without arguments
+        """
+        with self._lock:
+            self._timer_sequence += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._timer_sequence, callback))
+        self._ensure_running()
+        self._wakeup()
+
+    def get_registered_count(self):
+        """ Get the number of pipes (and pidfds) currently watched
+
+        \return The number of registered file descriptors
+        """
+        return len(self._handlers)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._timers:
+                    timeout = max(0, self._timers[0][0] - time.time()) * self._poll_timeout_scale
+                else:
+                    timeout = -1 if self._poll_timeout_scale == 1 else None
+            try:
+                events = self._poller.poll(timeout)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for (fd, event) in events:
+                if fd == self._wakeup_read_fd:
+                    try:
+                        while os.read(self._wakeup_read_fd, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._handle_readable(fd)
+            self._run_due_timers()
+
+    def _handle_readable(self, fd):
+        with self._lock:
+            handler = self._handlers.get(fd, None)
+        if handler is None:
+            return  # Unregistered in the meantime
+        (on_data, on_eof) = handler
+        if on_data is None: # pidfd, readable once the process has exitted
+            with self._lock:
+                if self._handlers.get(fd, None) is not handler:
+                    return  # Unwatched in the meantime (and fd maybe reused)
+                del self._handlers[fd]
+                self._poller.unregister(fd)
+            _run_callback(on_eof)
+            return
+        try:
+            data = os.read(fd, VtundOutputReactor.READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''  # Consider read errors as EOF
+        if data:
+            _run_callback(on_data, data)
+        else:
+            self.unregister(fd)
+            _run_callback(on_eof)
+
+    def _run_due_timers(self):
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > time.time():
+                    return
+                (when, sequence, callback) = heapq.heappop(self._timers)
+            _run_callback(callback)
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _run_callback(callback, *args):
+    """ Run a callback, reporting (but not propagating) its exceptions, so that one tunnel cannot stop the reactor for all others """
+    try:
+        callback(*args)
+    except Exception:
+        traceback.print_exc(file = sys.stderr)
+
+_default_reactor = None
+_default_reactor_lock = threading.Lock()
+
+def get_default_reactor():
+    """ Get the VtundOutputReactor shared by all tunnels of this process (created on first call)
+
+    \return A VtundOutputReactor object
+    """
+    global _default_reactor
+    with _default_reactor_lock:
+        if _default_reactor is None:
+            _default_reactor = VtundOutputReactor()
+        return _default_reactor